@@ -0,0 +1,302 @@
+"""
+Conversion benchmarks.
+
+`run` generates a corpus and benchmarks every mode and worker count in a
+fresh process, so the peak RSS of that process and its pool workers can be
+measured, and writes the results as JSON. `compare` reports the differences
+between two result files, e.g. from two commits.
+
+    python -m benchmarks.bench run --workers 1,2,4 -o results.json
+    python -m benchmarks.bench compare baseline.json results.json
+"""
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+import click
+
+from .corpus import Document, generate
+
+PATH = Path(__file__).parent
+STUB_PANDOC = PATH / 'stub' / 'pandoc'
+
+DEFAULT_PAIRS = 'markdown:html,markdown:docx,markdown:latex'
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def drive(task: Callable[[], Awaitable[Any]], requests: int, concurrency: int) -> Dict[str, Any]:
+    """Runs `task` `requests` times, at most `concurrency` at once, and summarizes the latencies."""
+    limit = asyncio.Semaphore(concurrency)
+    latencies = []  # type: List[float]
+    errors = []  # type: List[str]
+
+    async def timed_task() -> None:
+        async with limit:
+            start = time.perf_counter()
+            try:
+                await task()
+            except Exception as err:
+                errors.append(str(err))
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[timed_task() for _ in range(requests)])
+    elapsed = time.perf_counter() - start
+
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'seconds': round(elapsed, 4),
+        'throughput': round(len(latencies) / elapsed, 3) if elapsed else None,
+        'latency_mean': round(sum(latencies) / len(latencies), 4) if latencies else None,
+        'latency_p50': round(percentile(latencies, 50), 4),
+        'latency_p99': round(percentile(latencies, 99), 4),
+    }
+
+
+def _copy_input(document: Document) -> str:
+    from pandocserver.worker import DEFAULT_TEMP_DIR
+
+    ext = "".join(document.path.suffixes)
+    with tempfile.NamedTemporaryFile(suffix=ext, dir=DEFAULT_TEMP_DIR, delete=False) as fobj:
+        with document.path.open('rb') as src:
+            shutil.copyfileobj(src, fobj)
+    return fobj.name
+
+
+async def bench_direct(workers: int, documents: List[Document], pairs: List[Tuple[str, str]],
+                       requests: int, concurrency: int) -> List[Dict[str, Any]]:
+    """Drives worker.convert on a process pool, without the http front-end."""
+    from pandocserver.services import get_formats
+    from pandocserver.utils import DocumentConfig, clean_up_result, clean_up_tempfile
+    from pandocserver.worker import clean, convert, warm
+
+    loop = asyncio.get_event_loop()
+    run = loop.run_in_executor
+    executor = ProcessPoolExecutor(max_workers=workers)
+    formats = await run(None, get_formats)
+    await asyncio.gather(*[run(executor, warm, DocumentConfig(), 'subprocess', None, formats)
+                           for _ in range(workers)])
+
+    results = []
+    try:
+        for document in documents:
+            for from_format, to_format in pairs:
+                async def task() -> None:
+                    in_file = await run(None, _copy_input, document)
+                    try:
+                        stem = document.name.split('.')[0]
+                        out_file = await run(executor, convert, stem, in_file, from_format, to_format)
+                        await run(None, clean_up_result, out_file)
+                    finally:
+                        await run(None, clean_up_tempfile, in_file)
+
+                summary = await drive(task, requests, concurrency)
+                results.append(dict(summary, document=document.name, kind=document.kind, size=document.size,
+                                    from_format=from_format, to_format=to_format))
+    finally:
+        await asyncio.gather(*[run(executor, clean) for _ in range(workers)])
+        executor.shutdown(wait=True)
+    return results
+
+
+async def bench_http(workers: int, documents: List[Document], pairs: List[Tuple[str, str]],
+                     requests: int, concurrency: int) -> List[Dict[str, Any]]:
+    """Drives the aiohttp application end-to-end over a local socket."""
+    import aiohttp
+    from aiohttp.test_utils import TestServer
+
+    from pandocserver.app import init_app
+    from pandocserver.utils import config_from_dict
+
+    conf = config_from_dict({
+        'app': {'host': '127.0.0.1', 'port': 0},
+        'workers': {'max_workers': workers},
+        'document': {},
+    })
+    app = await init_app(conf)
+
+    results = []
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        url = str(server.make_url('/convert'))
+        for document in documents:
+            data = document.path.read_bytes()
+            for from_format, to_format in pairs:
+                async def task() -> None:
+                    form = aiohttp.FormData()
+                    form.add_field('from', from_format)
+                    form.add_field('to', to_format)
+                    form.add_field('file', data, filename=document.name)
+                    async with session.post(url, data=form) as response:
+                        body = await response.read()
+                        if response.status != 200:
+                            raise RuntimeError(f"HTTP {response.status}: {body[:200]!r}")
+
+                summary = await drive(task, requests, concurrency)
+                results.append(dict(summary, document=document.name, kind=document.kind, size=document.size,
+                                    from_format=from_format, to_format=to_format))
+    return results
+
+
+MODES = {
+    'direct': bench_direct,
+    'http': bench_http,
+}
+
+
+def _parse_pairs(pairs: str) -> List[Tuple[str, str]]:
+    return [tuple(pair.split(':', 1)) for pair in pairs.split(',') if pair]  # type: ignore
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(PATH), stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option('--mode', type=click.Choice(sorted(MODES)), required=True)
+@click.option('--workers', type=int, required=True)
+@click.option('--corpus-dir', type=click.Path(file_okay=False), required=True)
+@click.option('--documents', default='', help="Comma separated corpus documents, all by default.")
+@click.option('--pairs', default=DEFAULT_PAIRS)
+@click.option('--requests', type=int, default=20)
+@click.option('--concurrency', type=int, default=None)
+@click.option('--chapters', type=int, default=20)
+def case(mode, workers, corpus_dir, documents, pairs, requests, concurrency, chapters):
+    """Benchmarks one mode and worker count, prints the results as JSON."""
+    logging.getLogger('asyncio').setLevel(logging.WARNING)
+    corpus = generate(corpus_dir, chapters=chapters)
+    if documents:
+        names = documents.split(',')
+        corpus = [document for document in corpus if document.name in names]
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = loop.run_until_complete(
+        MODES[mode](workers, corpus, _parse_pairs(pairs), requests, concurrency or workers * 2)
+    )
+    click.echo(json.dumps(results))
+
+
+@main.command()
+@click.option('--modes', default='direct,http')
+@click.option('--workers', 'worker_counts', default='1,2,4', help="Comma separated max_workers values.")
+@click.option('--documents', default='')
+@click.option('--pairs', default=DEFAULT_PAIRS)
+@click.option('--requests', type=int, default=20)
+@click.option('--concurrency', type=int, default=None, help="Concurrent requests, twice the workers by default.")
+@click.option('--chapters', type=int, default=20, help="Chapters in the archive documents.")
+@click.option('--stub/--no-stub', default=True, help="Use the stub pandoc instead of the installed one.")
+@click.option('-o', '--output', type=click.Path(dir_okay=False), default='-')
+def run(modes, worker_counts, documents, pairs, requests, concurrency, chapters, stub, output):
+    """Runs the benchmarks and writes machine readable results."""
+    env = dict(os.environ)
+    if stub:
+        env['PYPANDOC_PANDOC'] = str(STUB_PANDOC)
+
+    records = []
+    with tempfile.TemporaryDirectory(prefix='pandocserver-bench-') as corpus_dir:
+        for mode in modes.split(','):
+            for workers in (int(n) for n in worker_counts.split(',')):
+                click.echo(f"Benchmarking {mode} with {workers} worker(s)", err=True)
+                args = [sys.executable, '-m', 'benchmarks.bench', 'case', '--mode', mode, '--workers', str(workers),
+                        '--corpus-dir', corpus_dir, '--documents', documents, '--pairs', pairs,
+                        '--requests', str(requests), '--chapters', str(chapters)]
+                if concurrency:
+                    args += ['--concurrency', str(concurrency)]
+
+                process = subprocess.Popen(args, cwd=str(PATH.parent), env=env, stdout=subprocess.PIPE)
+                stdout = process.stdout.read()
+                # the rusage of a waited for process covers the pool workers it waited for
+                _, status, rusage = os.wait4(process.pid, 0)
+                process.returncode = status
+                if status != 0:
+                    raise click.ClickException(f"Benchmark {mode} with {workers} worker(s) failed")
+
+                for result in json.loads(stdout.decode('utf-8')):
+                    records.append(dict(result, mode=mode, workers=workers, peak_rss_kb=rusage.ru_maxrss))
+
+    version = subprocess.check_output(
+        [str(STUB_PANDOC) if stub else env.get('PYPANDOC_PANDOC', 'pandoc'), '--version'],
+        universal_newlines=True
+    ).splitlines()[0]
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'pandoc': version,
+            'stub': stub,
+        },
+        'results': records,
+    }
+    with click.open_file(output, 'w') as fobj:
+        json.dump(report, fobj, indent=2)
+        fobj.write('\n')
+
+
+def _key(result: Dict[str, Any]) -> Tuple:
+    return (result['mode'], result['workers'], result['document'], result['from_format'], result['to_format'])
+
+
+@main.command()
+@click.argument('baseline', type=click.File('r'))
+@click.argument('current', type=click.File('r'))
+@click.option('--threshold', type=float, default=0.1, help="Relative slowdown reported as a regression.")
+def compare(baseline, current, threshold):
+    """Compares two result files, exits non-zero on regressions."""
+    before = {_key(result): result for result in json.load(baseline)['results']}
+    after = {_key(result): result for result in json.load(current)['results']}
+
+    regressions = 0
+    click.echo(f"{'case':<60} {'p50':>9} {'p99':>9} {'req/s':>9}")
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        changes = []
+        for metric in ('latency_p50', 'latency_p99', 'throughput'):
+            if not old.get(metric) or new.get(metric) is None:
+                changes.append(float('nan'))
+                continue
+            changes.append(new[metric] / old[metric] - 1)
+        slower = changes[0] > threshold or changes[1] > threshold or changes[2] < -threshold
+        regressions += slower
+        name = "/".join(str(part) for part in key)
+        click.echo(f"{name:<60} {changes[0]:>+9.1%} {changes[1]:>+9.1%} {changes[2]:>+9.1%}"
+                   + ("  REGRESSION" if slower else ""))
+
+    if regressions:
+        raise click.ClickException(f"{regressions} case(s) regressed by more than {threshold:.0%}")
+
+
+if __name__ == '__main__':
+    main()
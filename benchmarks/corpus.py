@@ -0,0 +1,76 @@
+import io
+import random
+import tarfile
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Union
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut '
+         'labore et dolore magna aliqua pandoc server markdown convert document archive chapter').split()
+
+
+@dataclass(frozen=True)
+class Document:
+    name: str
+    path: Path
+    kind: str
+
+    @property
+    def size(self) -> int:
+        return self.path.stat().st_size
+
+
+def chapter(rnd: random.Random, title: str, size: int) -> str:
+    """Generates markdown with headings, paragraphs, lists, code and tables of roughly `size` bytes."""
+    parts = [f"# {title}\n"]
+    length = len(parts[0])
+    section = 0
+    while length < size:
+        section += 1
+        block = [f"\n## Section {section}\n\n"]
+        for _ in range(rnd.randint(2, 5)):
+            sentence = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(20, 60)))
+            block.append(f"{sentence.capitalize()}, *{rnd.choice(WORDS)}* and **{rnd.choice(WORDS)}**.\n\n")
+        block.extend(f"- {rnd.choice(WORDS)} `{rnd.choice(WORDS)}`\n" for _ in range(rnd.randint(2, 6)))
+        block.append("\n```python\nprint('%s')\n```\n\n" % rnd.choice(WORDS))
+        block.append("| a | b |\n|---|---|\n| %s | %s |\n" % (rnd.choice(WORDS), rnd.choice(WORDS)))
+        text = "".join(block)
+        parts.append(text)
+        length += len(text)
+    return "".join(parts)
+
+
+def _write_archive(path: Path, chapters: List[str]) -> None:
+    stem = path.name.split('.')[0]
+    members = [(f"{stem}/chapter-{i:03d}.md", text.encode('utf-8')) for i, text in enumerate(chapters)]
+    if path.suffix == '.zip':
+        with zipfile.ZipFile(str(path), 'w', compression=zipfile.ZIP_DEFLATED) as zip_obj:
+            for name, data in members:
+                zip_obj.writestr(name, data)
+    else:
+        with tarfile.open(str(path), 'w:gz') as tar_obj:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar_obj.addfile(info, io.BytesIO(data))
+
+
+def generate(directory: Union[str, Path], chapters: int = 20, seed: int = 42) -> List[Document]:
+    """Generates the benchmark corpus in `directory`, deterministic for a given seed."""
+    rnd = random.Random(seed)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    documents = []
+    for name, size in (('small.md', 2 * 1024), ('large.md', 1024 * 1024)):
+        path = directory / name
+        path.write_text(chapter(rnd, name, size), encoding='utf-8')
+        documents.append(Document(name, path, 'markdown'))
+
+    texts = [chapter(rnd, f"Chapter {i}", 8 * 1024) for i in range(chapters)]
+    for name in ('book.tar.gz', 'book.zip'):
+        path = directory / name
+        _write_archive(path, texts)
+        documents.append(Document(name, path, 'archive'))
+    return documents
@@ -0,0 +1,47 @@
+"""
+Minimal stand-in for `pandoc server`, started by the stub pandoc.
+
+Every conversion is answered with its input text, like the stub pandoc
+copies its input. Documents containing `PANDOC_STUB_FAIL` are answered with an error.
+"""
+import json
+import os
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import List
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self) -> None:
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if os.environ.get('PANDOC_STUB_DELAY'):
+            time.sleep(float(os.environ['PANDOC_STUB_DELAY']))
+        if 'PANDOC_STUB_FAIL' in payload.get('text', ''):
+            self._send(500, b'stub failure')
+        else:
+            self._send(200, json.dumps({'output': payload['text'], 'base64': False, 'messages': []}).encode())
+
+    def _send(self, status: int, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def main(args: List[str]) -> None:
+    port = 3030
+    for arg in args:
+        if arg.startswith('--port='):
+            port = int(arg.split('=', 1)[1])
+    HTTPServer(('127.0.0.1', port), Handler).serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,203 @@
+import asyncio
+import collections
+import logging
+import math
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from .metrics import QUEUE_WAIT
+
+logger = logging.getLogger('asyncio')
+
+
+class OverloadedError(Exception):
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# cost classes, cheap conversions are small single documents to text formats
+CHEAP = 'cheap'
+EXPENSIVE = 'expensive'
+COST_CLASSES = (CHEAP, EXPENSIVE)
+
+
+class AdmissionController(object):
+    """
+    Bounds and schedules the conversions running on and waiting for a worker pool.
+
+    At most `max_in_flight` conversions run at the same time, up to
+    `max_queued` more wait and anything beyond that is rejected with an
+    `OverloadedError` carrying a retry estimate.
+
+    Waiting conversions are queued by cost class and client. Freed slots are
+    shared between the classes by smooth weighted round robin, `weights`
+    giving the share of each, and between the clients of a class round robin,
+    so a client queueing many conversions only delays its own. `reserved`
+    slots are kept for cheap conversions, expensive ones never take them.
+    """
+
+    # smoothing factor of the moving averages
+    ALPHA = 0.2
+
+    def __init__(self, max_in_flight: int, max_queued: Optional[int] = None, reserved: int = 0,
+                 weights: Optional[Dict[str, int]] = None) -> None:
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        if reserved >= max_in_flight:
+            logger.warning(f"Can not reserve {reserved} of {max_in_flight} slots for cheap conversions, "
+                           f"reserving {max_in_flight - 1}")
+        self._reserved = reserved
+        self.reserved = min(reserved, max_in_flight - 1)
+        self.weights = dict({CHEAP: 3, EXPENSIVE: 1}, **(weights or {}))
+        self.in_flight = 0
+        self.rejected = 0
+        self.avg_wait = 0.0
+        self.avg_service = 0.0
+        self._running = dict.fromkeys(COST_CLASSES, 0)
+        self._avg_waits = dict.fromkeys(COST_CLASSES, 0.0)
+        self._credits = dict.fromkeys(COST_CLASSES, 0)
+        # per class the clients in round robin order, with their waiters in FIFO order
+        self._queues = {
+            cost: collections.OrderedDict() for cost in COST_CLASSES
+        }  # type: Dict[str, collections.OrderedDict]
+
+    @property
+    def queued(self) -> int:
+        return sum(self._queued(cost) for cost in COST_CLASSES)
+
+    def _queued(self, cost: str) -> int:
+        return sum(len(waiters) for waiters in self._queues[cost].values())
+
+    @property
+    def full(self) -> bool:
+        return (self.max_queued is not None and self.in_flight >= self.max_in_flight
+                and self.queued >= self.max_queued)
+
+    def retry_after(self) -> int:
+        """Estimates in seconds when a slot frees up, for the Retry-After header."""
+        backlog = (self.queued + 1) / self.max_in_flight
+        return max(1, math.ceil(backlog * self.avg_service))
+
+    def reject(self) -> OverloadedError:
+        self.rejected += 1
+        logger.warning(f"Rejected conversion, {self.in_flight} running and {self.queued} queued")
+        return OverloadedError("Server is overloaded, try again later", self.retry_after())
+
+    def _eligible(self, cost: str) -> bool:
+        if self.in_flight >= self.max_in_flight:
+            return False
+        return cost == CHEAP or self._running[cost] < self.max_in_flight - self.reserved
+
+    def _run(self, cost: str) -> None:
+        self.in_flight += 1
+        self._running[cost] += 1
+
+    async def acquire(self, block: bool = False, cost: str = CHEAP, client: str = '') -> float:
+        """Waits for a slot and returns the time waited, `block` ignores the queue bound."""
+        start = time.monotonic()
+        # freed slots are handed to waiters right away, so a free slot means none can take it
+        if self._eligible(cost):
+            self._run(cost)
+        else:
+            if self.full and not block:
+                raise self.reject()
+            waiter = asyncio.get_event_loop().create_future()
+            self._queues[cost].setdefault(client, collections.deque()).append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if not waiter.done() or waiter.cancelled():
+                    self._remove(cost, client, waiter)
+                else:
+                    # the slot was handed over already
+                    self.release(cost)
+                raise
+
+        waited = time.monotonic() - start
+        self.avg_wait += self.ALPHA * (waited - self.avg_wait)
+        self._avg_waits[cost] += self.ALPHA * (waited - self._avg_waits[cost])
+        QUEUE_WAIT.observe(waited, cost_class=cost)
+        if waited >= 0.001:
+            logger.info(f"Started {cost} conversion of '{client}' after {waited:.3f}s in the queue")
+        return waited
+
+    def _remove(self, cost: str, client: str, waiter: asyncio.Future) -> None:
+        waiters = self._queues[cost].get(client)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._queues[cost][client]
+
+    def _next_class(self) -> Optional[str]:
+        """Picks the class getting the next free slot, by smooth weighted round robin."""
+        costs = [cost for cost in COST_CLASSES if self._queues[cost] and self._eligible(cost)]
+        if not costs:
+            return None
+        for cost in costs:
+            self._credits[cost] += self.weights[cost]
+        cost = max(costs, key=lambda cost: self._credits[cost])
+        self._credits[cost] -= sum(self.weights[cost] for cost in costs)
+        return cost
+
+    def _dispatch(self) -> None:
+        """Hands the free slots over to waiters."""
+        while True:
+            cost = self._next_class()
+            if cost is None:
+                return
+            clients = self._queues[cost]
+            client, waiters = clients.popitem(last=False)
+            waiter = waiters.popleft()
+            if waiters:
+                # the client goes to the back of its class
+                clients[client] = waiters
+            if not waiter.done():
+                self._run(cost)
+                waiter.set_result(None)
+
+    def resize(self, max_in_flight: int) -> None:
+        """Changes the number of slots, conversions running beyond a smaller one finish first."""
+        self.max_in_flight = max_in_flight
+        self.reserved = min(self._reserved, max_in_flight - 1)
+        self._dispatch()
+
+    def release(self, cost: str = CHEAP) -> None:
+        self.in_flight -= 1
+        self._running[cost] -= 1
+        self._dispatch()
+
+    @contextmanager
+    def _timed(self, cost: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.avg_service += self.ALPHA * (time.monotonic() - start - self.avg_service)
+            self.release(cost)
+
+    async def slot(self, block: bool = False, cost: str = CHEAP, client: str = '') -> Any:
+        """Acquires a slot, use the returned context manager to release it."""
+        await self.acquire(block, cost, client)
+        return self._timed(cost)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'max_in_flight': self.max_in_flight,
+            'max_queued': self.max_queued,
+            'reserved': self.reserved,
+            'rejected': self.rejected,
+            'avg_wait_seconds': round(self.avg_wait, 4),
+            'avg_service_seconds': round(self.avg_service, 4),
+            'classes': {
+                cost: {
+                    'in_flight': self._running[cost],
+                    'queued': self._queued(cost),
+                    'clients_queued': len(self._queues[cost]),
+                    'avg_wait_seconds': round(self._avg_waits[cost], 4),
+                } for cost in COST_CLASSES
+            },
+        }
@@ -1,4 +1,4 @@
-import asyncio
+from functools import partial
 from pathlib import Path
 
 import aiohttp_jinja2
@@ -9,13 +9,18 @@ import logging
 import jinja2
 
 from pandocserver.middlewares import init_middlewares
+from .jobs import init_jobs
+from .node import init_node
 from .routes import init_routes
-from .utils import init_config, Config, init_workers, TrafaretYaml, CONFIG_TRAFARET
+from .tracing import install_log_records
+from .utils import init_cache, init_config, Config, init_traces, init_workers, TrafaretYaml, CONFIG_TRAFARET
 from .views import SiteHandler
 
 from aiohttp import web
 
-LOGGER_FORMAT = "%(asctime)-12s %(levelname)-8s %(message)s"
+LOGGER_FORMAT = "%(asctime)-12s %(levelname)-8s %(trace_id)s %(message)s"
+ACCESS_LOG_FORMAT = '%a %t "%r" %s %b "%{Referer}i" "%{User-Agent}i" %{X-Trace-Id}o %Tf'
+install_log_records()
 logging.basicConfig(format=LOGGER_FORMAT, datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger('asyncio')
 
@@ -37,10 +42,14 @@ def init_jinja2(app: web.Application) -> None:
 
 async def init_app(conf: Config) -> web.Application:
     app = web.Application()
-    executor = await init_workers(app, conf.workers, conf.document)
     init_config(app, conf)
+    cache = init_cache(app, conf.cache)
+    traces = init_traces(app, conf.traces)
+    executor = await init_workers(app, conf.workers, conf.document, cache, conf.pdf, conf.filters,
+                                  scheduling=conf.scheduling, traces=traces, options=conf.options)
     init_jinja2(app)
     handler = SiteHandler(conf, executor)
+    init_jobs(app, conf.jobs, partial(handler.run, app, block=True))
     init_routes(app, handler)
     init_middlewares(app)
     return app
@@ -71,6 +80,26 @@ def run(config, verbose):
     logger.setLevel(level)
     logger.info(f"Loglevel is: {logging.getLevelName(level)}")
 
-    loop = asyncio.get_event_loop()
-    app = loop.run_until_complete(init_app(config))
-    web.run_app(app, host=config.app.host, port=config.app.port)
+    # the app is set up on the loop serving it
+    web.run_app(init_app(config), host=config.app.host, port=config.app.port,
+                access_log_format=ACCESS_LOG_FORMAT)
+
+
+@main.command()
+@click.argument("config", envvar='PANDOC_SERVER_CONFIG', type=TrafaretYaml(CONFIG_TRAFARET))
+@click.option('--host', default='127.0.0.1', show_default=True,
+              help="Address to listen on, only front-ends on this host reach the node by default.")
+@click.option('--port', type=int, default=None, help="Defaults to the app port of the configuration.")
+@click.option('-v', '--verbose', count=True)
+def worker(config, host, port, verbose):
+    """Run a worker node converting for front-ends configured with `workers.nodes`."""
+    logging.basicConfig(level=logging.DEBUG)
+    verbosity = logging.ERROR - verbose * 10
+    level = sorted((logging.DEBUG, verbosity, logging.ERROR))[1]
+    logger.setLevel(level)
+    logger.info("Version: %s", __version__)
+
+    if not config.workers.node_secret:
+        raise click.ClickException("'workers.node_secret' must be set, the same as on the front-ends")
+    web.run_app(init_node(config), host=host, port=port or config.app.port,
+                access_log_format=ACCESS_LOG_FORMAT)
@@ -0,0 +1,81 @@
+import json
+from collections import OrderedDict
+from typing import Any, Iterator, List, NamedTuple, Tuple, Union
+
+from .services import BINARY_FORMATS, get_formats
+
+
+class InvalidBatchError(ValueError):
+    pass
+
+
+class BatchItem(NamedTuple):
+    id: Union[str, int]
+    from_format: str
+    to_format: str
+    content: str
+
+
+class BatchError(NamedTuple):
+    """An item which can not be converted, reported in the results without failing the batch."""
+    id: Any
+    error: str
+
+
+def _items(body: bytes) -> List[Any]:
+    text = body.decode('utf-8')
+    if text.lstrip().startswith('['):
+        items = json.loads(text)
+        if not isinstance(items, list):
+            raise InvalidBatchError("Not a JSON array")
+        return items
+    # NDJSON, one item per line
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def parse_batch(body: bytes, max_items: int, max_item_size: int) -> List[Union[BatchItem, BatchError]]:
+    """
+    Reads a JSON array or NDJSON lines of `{"id", "from", "to", "content"}` items.
+
+    Raises an `InvalidBatchError` when the body can not be read, items which
+    are not valid are returned as `BatchError`s.
+    """
+    try:
+        items = _items(body)
+    except (UnicodeDecodeError, ValueError) as err:
+        raise InvalidBatchError(f"Not a JSON array or NDJSON: {err}")
+    if len(items) > max_items:
+        raise InvalidBatchError(f"More than {max_items} items")
+
+    formats = get_formats()
+    parsed = []  # type: List[Union[BatchItem, BatchError]]
+    for item in items:
+        if not isinstance(item, dict):
+            parsed.append(BatchError(None, "Not an object"))
+            continue
+        item_id = item.get('id')
+        from_format, to_format, content = item.get('from'), item.get('to'), item.get('content')
+        if not isinstance(item_id, (str, int)) or isinstance(item_id, bool):
+            error = "Missing or invalid 'id'"
+        elif from_format not in formats.input:
+            error = f"Unknown input format: '{from_format}'"
+        elif to_format not in formats.output or to_format in BINARY_FORMATS:
+            error = f"Unknown or binary output format: '{to_format}'"
+        elif not isinstance(content, str):
+            error = "Missing or invalid 'content'"
+        elif len(content) > max_item_size:
+            error = f"Content larger than {max_item_size} characters"
+        else:
+            error = None
+        parsed.append(BatchError(item_id, error) if error else BatchItem(item_id, from_format, to_format, content))
+    return parsed
+
+
+def chunk_items(items: List[BatchItem], chunk_size: int) -> Iterator[Tuple[Tuple[str, str], List[BatchItem]]]:
+    """Groups items by their formats, yields the formats with chunks of up to `chunk_size` items."""
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault((item.from_format, item.to_format), []).append(item)
+    for formats, group in groups.items():
+        for i in range(0, len(group), chunk_size):
+            yield formats, group[i:i + chunk_size]
@@ -0,0 +1,177 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from .metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger('asyncio')
+
+
+def cache_key(*parts: Any) -> str:
+    """Returns a stable hex digest for the given json-serializable parts."""
+    blob = json.dumps(parts, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Content addressed on-disk cache of conversion results.
+
+    Every entry is a directory named after its key holding a single result
+    file, the directory mtime is used as last access time for LRU eviction.
+    Entries are published with an atomic rename and all mutations are done
+    under an exclusive lock file, so several processes can share one cache dir.
+    The total size is kept in a size file next to it, the entries are only
+    walked once it exceeds `max_size`, to evict down to `LOW_WATER` of it.
+    """
+
+    LOCK_FILE = '.lock'
+    SIZE_FILE = '.size'
+    TEMP_PREFIX = '.tmp-'
+    LOW_WATER = 0.9
+
+    def __init__(self, path: Union[str, Path], max_size: int) -> None:
+        self.path = Path(path).expanduser()
+        self.path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        with open(str(self.path / self.LOCK_FILE), 'a') as fobj:
+            fcntl.flock(fobj.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fobj.fileno(), fcntl.LOCK_UN)
+
+    def _entry(self, key: str) -> Path:
+        return self.path / key[:2] / key
+
+    @staticmethod
+    def _size(entry: Path) -> int:
+        return sum(f.stat().st_size for f in entry.iterdir())
+
+    def _entries(self) -> List[Tuple[float, int, Path]]:
+        entries = []
+        for entry in self.path.glob('??/*'):
+            try:
+                entries.append((entry.stat().st_mtime, self._size(entry), entry))
+            except OSError:
+                continue
+        return entries
+
+    def _read_total(self) -> Optional[int]:
+        try:
+            return int((self.path / self.SIZE_FILE).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _write_total(self, total: int) -> None:
+        (self.path / self.SIZE_FILE).write_text(str(total))
+
+    def get(self, key: str) -> Optional[Path]:
+        entry = self._entry(key)
+        try:
+            result = next(entry.iterdir())
+            os.utime(str(entry))
+        except (OSError, StopIteration):
+            self.misses += 1
+            CACHE_LOOKUPS.inc(result='miss')
+            return None
+        self.hits += 1
+        CACHE_LOOKUPS.inc(result='hit')
+        logger.debug(f"Cache hit for '{key}'")
+        return result
+
+    def put(self, key: str, filepath: Union[str, Path]) -> Optional[Path]:
+        src = Path(filepath)
+        if src.stat().st_size > self.max_size:
+            logger.debug(f"Not caching '{src.name}', larger than the cache")
+            return None
+
+        tmp_dir = Path(tempfile.mkdtemp(prefix=self.TEMP_PREFIX, dir=str(self.path)))
+        try:
+            try:
+                os.link(str(src), str(tmp_dir / src.name))
+            except OSError:
+                shutil.copyfile(str(src), str(tmp_dir / src.name))
+            self._publish(key, tmp_dir)
+        finally:
+            shutil.rmtree(str(tmp_dir), ignore_errors=True)
+
+        logger.debug(f"Cached '{src.name}' as '{key}'")
+        return self.get_path(key)
+
+    def put_bytes(self, key: str, name: str, data: bytes) -> Optional[Path]:
+        if len(data) > self.max_size:
+            logger.debug(f"Not caching '{name}', larger than the cache")
+            return None
+
+        tmp_dir = Path(tempfile.mkdtemp(prefix=self.TEMP_PREFIX, dir=str(self.path)))
+        try:
+            (tmp_dir / name).write_bytes(data)
+            self._publish(key, tmp_dir)
+        finally:
+            shutil.rmtree(str(tmp_dir), ignore_errors=True)
+
+        logger.debug(f"Cached '{name}' as '{key}'")
+        return self.get_path(key)
+
+    def _publish(self, key: str, tmp_dir: Path) -> None:
+        entry = self._entry(key)
+        size = self._size(tmp_dir)
+        with self._lock():
+            entry.parent.mkdir(mode=0o700, exist_ok=True)
+            try:
+                os.rename(str(tmp_dir), str(entry))
+            except OSError:
+                # another process published the same key first
+                logger.debug(f"Cache entry '{key}' already exists")
+                return
+            total = self._read_total()
+            if total is None:
+                # a cache dir without a size file yet
+                total = sum(size for _, size, _ in self._entries())
+            else:
+                total += size
+            if total > self.max_size:
+                total = self._evict()
+            self._write_total(total)
+
+    def get_path(self, key: str) -> Optional[Path]:
+        """Returns the cached file for the key without counting a lookup."""
+        try:
+            return next(self._entry(key).iterdir())
+        except (OSError, StopIteration):
+            return None
+
+    def _evict(self) -> int:
+        """Evicts the least recently used entries down to the low water mark, returns the size left."""
+        entries = sorted(self._entries(), key=lambda entry: entry[0])
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_size * self.LOW_WATER:
+                break
+            shutil.rmtree(str(entry), ignore_errors=True)
+            total -= size
+            logger.debug(f"Evicted cache entry '{entry.name}'")
+        return total
+
+    def stats(self) -> Dict[str, int]:
+        entries = self._entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'size': sum(size for _, size, _ in entries),
+            'max_size': self.max_size,
+        }
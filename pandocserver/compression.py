@@ -0,0 +1,319 @@
+import bz2
+import collections
+import importlib
+import logging
+import lzma
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import IO, Any, FrozenSet, Optional, Tuple, Union
+
+logger = logging.getLogger('asyncio')
+
+GZIP_LEVEL = 6
+BZIP2_LEVEL = 9
+XZ_PRESET = 6
+ZSTD_LEVEL = 3
+
+# bytes of a tar stream compressed at once, larger blocks compress better but take more memory
+BLOCK_SIZES = {'gzip': 1024 ** 2, 'bzip2': 900 * 1024, 'xz': 4 * 1024 ** 2, 'lz4': 1024 ** 2}
+READ_SIZE = 256 * 1024
+# compressed zip entries up to this size are kept in memory until written
+SPOOL_SIZE = 8 * 1024 ** 2
+
+
+class CompressionError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Codec:
+    name: str
+    # of tar archives compressed with it, e.g. `.tar.gz`
+    suffix: str
+    # the method of zip entries compressed with it, None when zip archives can not use it
+    zip_method: Optional[int] = None
+    # the optional package providing it
+    module: Optional[str] = None
+
+
+CODECS = {
+    'store': Codec('store', '', zipfile.ZIP_STORED),
+    'gzip': Codec('gzip', '.gz', zipfile.ZIP_DEFLATED),
+    'bzip2': Codec('bzip2', '.bz2', zipfile.ZIP_BZIP2),
+    'xz': Codec('xz', '.xz'),
+    'zstd': Codec('zstd', '.zst', module='zstandard'),
+    'lz4': Codec('lz4', '.lz4', module='lz4.frame'),
+}
+
+
+@lru_cache(maxsize=None)
+def _module(name: str) -> Any:
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def available_codecs() -> FrozenSet[str]:
+    """Returns the codecs which can be used, zstd and lz4 need their packages installed."""
+    return frozenset(name for name, codec in CODECS.items() if codec.module is None or _module(codec.module))
+
+
+def get_codec(name: str) -> Codec:
+    if name not in available_codecs():
+        raise CompressionError(f"Compression '{name}' is not available")
+    return CODECS[name]
+
+
+_threads = os.cpu_count() or 1
+_pool = None  # type: Optional[ThreadPoolExecutor]
+
+
+def set_threads(threads: Optional[int]) -> None:
+    """Sets the threads compressing in this process, by default one per cpu."""
+    global _threads, _pool
+    _threads = threads or os.cpu_count() or 1
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+        _pool = None
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    # started on first use, so forked workers get threads of their own
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=_threads, thread_name_prefix='compress')
+    return _pool
+
+
+def _deflate_block(block: bytes) -> bytes:
+    # raw deflate ending byte aligned, so independently compressed blocks can be concatenated
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _lz4_block(block: bytes) -> bytes:
+    return _module('lz4.frame').compress(block)
+
+
+# every block is a stream of its own, concatenated streams are valid for these codecs
+COMPRESS_BLOCK = {
+    'gzip': _deflate_block,
+    'bzip2': lambda block: bz2.compress(block, BZIP2_LEVEL),
+    'xz': lambda block: lzma.compress(block, preset=XZ_PRESET),
+    'lz4': _lz4_block,
+}
+
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+class BlockWriter(object):
+    """
+    Compresses the data written to it on the compression threads, pigz style.
+
+    Data is cut into blocks compressed independently of each other, which are
+    written to `fobj` in order. gzip output is a single gzip member made of
+    the deflated blocks, other codecs write a stream per block, zstd uses the
+    threads of its own library. `fobj` is not closed.
+    """
+
+    def __init__(self, fobj: IO[bytes], codec: str) -> None:
+        self._fobj = fobj
+        self._codec = get_codec(codec).name
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._crc = 0
+        self._size = 0
+        self._blocks = 0
+        self._zstd = None  # type: Any
+        if self._codec == 'zstd':
+            compressor = _module('zstandard').ZstdCompressor(level=ZSTD_LEVEL, threads=_threads if _threads > 1 else 0)
+            self._zstd = compressor.stream_writer(fobj, closefd=False)
+        elif self._codec == 'gzip':
+            fobj.write(GZIP_HEADER)
+
+    def write(self, data: bytes) -> int:
+        if self._codec == 'store':
+            return self._fobj.write(data)
+        if self._zstd is not None:
+            return self._zstd.write(data)
+
+        self._buffer += data
+        block_size = BLOCK_SIZES[self._codec]
+        while len(self._buffer) >= block_size:
+            self._submit(bytes(self._buffer[:block_size]))
+            del self._buffer[:block_size]
+        return len(data)
+
+    def _submit(self, block: bytes) -> None:
+        if self._codec == 'gzip':
+            self._crc = zlib.crc32(block, self._crc)
+            self._size += len(block)
+        self._blocks += 1
+        self._pending.append(_get_pool().submit(COMPRESS_BLOCK[self._codec], block))
+        # bounds the memory held by blocks waiting to be written
+        while len(self._pending) > 2 * _threads:
+            self._fobj.write(self._pending.popleft().result())
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if self._zstd is not None:
+            self._zstd.close()
+            return
+        if self._buffer or not self._blocks and self._codec not in ('store', 'gzip'):
+            # empty data is still written as a stream of the codec
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._fobj.write(self._pending.popleft().result())
+        if self._codec == 'gzip':
+            # an empty final block, followed by the trailer
+            self._fobj.write(zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+            self._fobj.write(struct.pack('<LL', self._crc, self._size & 0xffffffff))
+
+
+class _Entry(object):
+
+    def __init__(self, arcname: str, mtime: float, crc: int, size: int, data: IO[bytes]) -> None:
+        self.arcname = arcname
+        self.mtime = mtime
+        self.crc = crc
+        self.size = size
+        self.data = data
+        self.compress_size = data.tell()
+        self.offset = 0
+
+
+def _compress_entry(filepath: str, arcname: str, method: int, remove: bool) -> _Entry:
+    if method == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)  # type: Any
+    elif method == zipfile.ZIP_BZIP2:
+        compressor = bz2.BZ2Compressor(BZIP2_LEVEL)
+    else:
+        compressor = None
+
+    data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    crc = size = 0
+    try:
+        with open(filepath, 'rb') as fobj:
+            mtime = os.fstat(fobj.fileno()).st_mtime
+            for chunk in iter(lambda: fobj.read(READ_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                data.write(compressor.compress(chunk) if compressor is not None else chunk)
+        if compressor is not None:
+            data.write(compressor.flush())
+    except BaseException:
+        data.close()
+        raise
+    if remove:
+        os.unlink(filepath)
+    return _Entry(arcname, mtime, crc, size, data)
+
+
+# sizes and offsets from ZIP64_LIMIT on and more than ZIP_MAX_ENTRIES entries are written to ZIP64 records
+ZIP64_LIMIT = 0xffffffff
+ZIP_MAX_ENTRIES = 0xffff
+ZIP_FILE_MODE = 0o100644
+
+
+def _zip32(value: int) -> int:
+    """Returns a size or offset, or the marker of one stored in a ZIP64 record."""
+    return value if value < ZIP64_LIMIT else 0xffffffff
+
+
+def _dos_datetime(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class ZipWriter(object):
+    """
+    Writes a zip archive entry by entry, compressing the entries on the compression threads.
+
+    Entries are compressed while the following ones are added and written in
+    the order they were added, with ZIP64 records where the sizes require it.
+    """
+
+    def __init__(self, filepath: Union[str, Path], codec: str = 'gzip') -> None:
+        method = get_codec(codec).zip_method
+        if method is None:
+            raise CompressionError(f"Compression '{codec}' is not supported in zip archives")
+        self._method = method
+        self._fobj = open(str(filepath), 'wb')
+        self._pending = collections.deque()
+        self._entries = []
+
+    def add(self, filepath: Union[str, Path], arcname: str, remove: bool = False) -> None:
+        """Adds a file, removed once it was compressed when `remove` is set."""
+        self._pending.append(_get_pool().submit(_compress_entry, str(filepath), arcname, self._method, remove))
+        while len(self._pending) > 2 * _threads:
+            self._write_entry(self._pending.popleft().result())
+
+    def _version(self, zip64: bool) -> int:
+        return max(45 if zip64 else 20, 46 if self._method == zipfile.ZIP_BZIP2 else 20)
+
+    def _write_entry(self, entry: _Entry) -> None:
+        entry.offset = self._fobj.tell()
+        name = entry.arcname.encode('utf-8')
+        zip64 = entry.size >= ZIP64_LIMIT or entry.compress_size >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 1, 16, entry.size, entry.compress_size) if zip64 else b''
+        dos_time, dos_date = _dos_datetime(entry.mtime)
+        self._fobj.write(struct.pack(
+            '<4s2B4HL2L2H', b'PK\x03\x04', self._version(zip64), 0, 0x800, self._method, dos_time, dos_date,
+            entry.crc, 0xffffffff if zip64 else entry.compress_size, 0xffffffff if zip64 else entry.size,
+            len(name), len(extra)
+        ) + name + extra)
+        with entry.data:
+            entry.data.seek(0)
+            shutil.copyfileobj(entry.data, self._fobj, READ_SIZE)
+        entry.data = None  # type: ignore
+        self._entries.append(entry)
+
+    def _write_central_directory(self) -> None:
+        start = self._fobj.tell()
+        for entry in self._entries:
+            name = entry.arcname.encode('utf-8')
+            fields = [value for value in (entry.size, entry.compress_size, entry.offset) if value >= ZIP64_LIMIT]
+            extra = struct.pack(f'<HH{len(fields)}Q', 1, 8 * len(fields), *fields) if fields else b''
+            dos_time, dos_date = _dos_datetime(entry.mtime)
+            version = self._version(bool(fields))
+            self._fobj.write(struct.pack(
+                '<4s4B4HL2L5H2L', b'PK\x01\x02', version, 3, version, 0, 0x800, self._method, dos_time, dos_date,
+                entry.crc, _zip32(entry.compress_size), _zip32(entry.size), len(name),
+                len(extra), 0, 0, 0, ZIP_FILE_MODE << 16, _zip32(entry.offset)
+            ) + name + extra)
+        end = self._fobj.tell()
+
+        count, size = len(self._entries), end - start
+        if count > ZIP_MAX_ENTRIES or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            self._fobj.write(struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count, size, start))
+            self._fobj.write(struct.pack('<4sLQL', b'PK\x06\x07', 0, end, 1))
+        entries = 0xffff if count > ZIP_MAX_ENTRIES else count
+        self._fobj.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, entries, entries,
+                                     _zip32(size), _zip32(start), 0))
+
+    def close(self) -> None:
+        try:
+            while self._pending:
+                self._write_entry(self._pending.popleft().result())
+            self._write_central_directory()
+        finally:
+            for future in self._pending:
+                if future.done() and not future.exception():
+                    future.result().data.close()
+            self._fobj.close()
@@ -0,0 +1,576 @@
+import abc
+import asyncio
+import collections
+import json
+import logging
+import os
+import shutil
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from pathlib import Path
+from tempfile import mkdtemp
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Set, Tuple, Union
+
+import aiohttp
+
+from . import tracing
+from .limits import ConversionTimeoutError, ResourceLimits
+from .metrics import (NODE_REDISPATCHES, REGISTRY, WORKER_NODES, WORKER_POOL_SIZE, WORKER_RECYCLES, WORKER_SCALING,
+                      decode_samples)
+from .options import ConversionOptions, InvalidOptionError, option_fields, parse_options
+from .services import get_formats
+from .worker import clean, convert, convert_batch, convert_inline, convert_many, retire, run_task, warm, DEFAULT_TEMP_DIR
+
+logger = logging.getLogger('asyncio')
+
+# tasks worker nodes run by name, with the position of their input file argument if they take one
+REMOTE_TASKS = {
+    'convert': (convert, 1),
+    'convert_many': (convert_many, 1),
+    'convert_inline': (convert_inline, 0),
+    'convert_batch': (convert_batch, None),
+}  # type: Dict[str, Tuple[Callable[..., Any], Optional[int]]]
+
+CHUNK_SIZE = 256 * 1024
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class NoWorkersError(Exception):
+    pass
+
+
+class WorkerLostError(Exception):
+    pass
+
+
+def encode_args(args: Sequence[Any], templates: Mapping[str, str], filters: Mapping[str, str]) -> List[Any]:
+    """
+    Returns task arguments in a JSON serializable form, to send them to a worker node.
+
+    Options are sent as the request fields naming them, never as paths.
+    """
+    return [{'options': option_fields(arg, templates, filters)} if isinstance(arg, ConversionOptions) else arg
+            for arg in args]
+
+
+def decode_args(args: Sequence[Any], templates: Mapping[str, str], filters: Mapping[str, str]) -> List[Any]:
+    """Returns the arguments of a task from a front-end, with its options checked against the whitelist."""
+    decoded = []
+    for arg in args:
+        if isinstance(arg, dict) and 'options' in arg:
+            fields = arg['options']
+            if not isinstance(fields, dict) or not all(
+                    isinstance(values, list) and all(isinstance(value, str) for value in values)
+                    for values in fields.values()):
+                raise InvalidOptionError("Options are not lists of strings by name")
+            arg = parse_options(fields, templates, filters)
+        decoded.append(arg)
+    return decoded
+
+
+class Executor(abc.ABC):
+    """
+    Runs the conversion tasks of the worker module for the front-end.
+
+    `submit` takes a task, the labels its metrics are recorded with and its
+    arguments, and returns the task's result once the metrics recorded while
+    running it are merged. `size` is the number of tasks run at the same time.
+    """
+
+    # whether tasks can hand each other paths, e.g. the members of a fanned out archive
+    shares_files = True
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def submit(self, fn: Callable[..., Any], labels: Dict[str, str], *args: Any) -> Any:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class WorkerProcess(object):
+    """A warm worker process, in a pool of its own so it can be replaced on its own."""
+
+    def __init__(self, initargs: Tuple[Any, ...]) -> None:
+        self.pool = ProcessPoolExecutor(max_workers=1, initializer=warm, initargs=initargs)
+        self.pid = None  # type: Optional[int]
+        self.tasks = 0
+        self.killed = False
+        # when it last became idle
+        self.idle_since = time.monotonic()
+
+    async def start(self) -> None:
+        # the process is started, and warmed, for its first task
+        self.pid = await asyncio.get_event_loop().run_in_executor(self.pool, os.getpid)
+
+    def rss(self) -> Optional[int]:
+        try:
+            with open(f'/proc/{self.pid}/statm') as fobj:
+                return int(fobj.read().split()[1]) * PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def kill(self) -> None:
+        """Kills the process together with its children, e.g. a pandoc which hangs."""
+        self.killed = True
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    async def stop(self, fn: Callable[[], None] = clean) -> None:
+        run = asyncio.get_event_loop().run_in_executor
+        if not self.killed:
+            try:
+                await run(self.pool, fn)
+            except BrokenProcessPool:
+                pass
+        await run(None, partial(self.pool.shutdown, wait=True))
+
+
+class LocalExecutor(Executor):
+    """
+    Runs tasks on warm worker processes on this host.
+
+    A task running `timeout` seconds is interrupted by its worker, one
+    running `KILL_GRACE` seconds longer is killed with the worker. Workers
+    are replaced by freshly warmed ones after `recycle_after` tasks, when
+    their RSS exceeds `recycle_max_rss` bytes, after a timeout or when they
+    died, without affecting the tasks running on other workers.
+
+    With `min_workers` below `max_workers` the pool starts with `min_workers`
+    and is grown, up to `max_workers`, while tasks wait more than
+    `scale_up_wait` seconds for a worker, and shrunk again by the workers
+    idle for `scale_down_after` seconds, checked every `scale_interval`
+    seconds. New workers are warmed before they take tasks.
+    """
+
+    KILL_GRACE = 5.0
+
+    def __init__(self, max_workers: int, doc: Any, engine: str = 'subprocess', engine_command: Optional[str] = None,
+                 cache: Optional[Any] = None, pdf: Optional[Any] = None, filters: Optional[Any] = None,
+                 limits: ResourceLimits = ResourceLimits(), recycle_after: Optional[int] = None,
+                 recycle_max_rss: Optional[int] = None, traces: Optional[Any] = None,
+                 compression_threads: Optional[int] = None, min_workers: Optional[int] = None,
+                 scale_up_wait: float = 0.5, scale_down_after: float = 60.0, scale_interval: float = 1.0) -> None:
+        super().__init__(max_workers)
+        self.limits = limits
+        self.recycle_after = recycle_after
+        self.recycle_max_rss = recycle_max_rss
+        self.recycled = collections.Counter()  # type: collections.Counter
+        self.min_workers = max_workers if min_workers is None else min(min_workers, max_workers)
+        self.scale_up_wait = scale_up_wait
+        self.scale_down_after = scale_down_after
+        self.scale_interval = scale_interval
+        self.scaled = collections.Counter()  # type: collections.Counter
+        self._warm_args = (doc, engine, engine_command)
+        self._cache = cache
+        self._pdf = pdf
+        self._filters = filters
+        self._traces = traces
+        self._compression_threads = compression_threads
+        self._initargs = ()  # type: Tuple[Any, ...]
+        self._workers = set()  # type: Set[WorkerProcess]
+        self._idle = None  # type: Optional[asyncio.Queue]
+        self._replacing = set()  # type: Set[asyncio.Future]
+        self._growing = set()  # type: Set[asyncio.Future]
+        self._shrinking = set()  # type: Set[asyncio.Future]
+        # when the tasks waiting for a worker started to, and the longest wait since the last check
+        self._waiting = {}  # type: Dict[int, float]
+        self._max_wait = 0.0
+        self._controller = None  # type: Optional[asyncio.Future]
+
+    async def start(self) -> None:
+        n = self.min_workers
+        self._idle = asyncio.Queue()
+
+        run = asyncio.get_event_loop().run_in_executor
+        start = time.monotonic()
+        formats = await run(None, get_formats)
+        self._initargs = self._warm_args + (formats, self._cache, self._pdf, self._filters, self.limits,
+                                             self._traces, self._compression_threads)
+        await asyncio.gather(*[self._spawn() for i in range(0, n)])
+        logger.info(f"Started {n} worker(s) in {time.monotonic() - start:.3f}s")
+        if self.min_workers < self.size:
+            logger.info(f"Scaling workers between {self.min_workers} and {self.size}")
+            self._controller = asyncio.ensure_future(self._control())
+
+    async def _spawn(self) -> None:
+        worker = WorkerProcess(self._initargs)
+        await worker.start()
+        self._workers.add(worker)
+        self._release(worker)
+
+    def _release(self, worker: WorkerProcess) -> None:
+        worker.idle_since = time.monotonic()
+        self._idle.put_nowait(worker)
+        WORKER_POOL_SIZE.set(len(self._workers))
+
+    async def stop(self) -> None:
+        if self._controller is not None:
+            self._controller.cancel()
+        for task in self._replacing | self._growing:
+            task.cancel()
+        fs = [worker.stop() for worker in self._workers]
+        await asyncio.shield(asyncio.gather(*fs, *self._shrinking))
+
+    async def _acquire(self) -> WorkerProcess:
+        key, start = id(asyncio.current_task()), time.monotonic()
+        self._waiting[key] = start
+        try:
+            return await self._idle.get()
+        finally:
+            del self._waiting[key]
+            self._max_wait = max(self._max_wait, time.monotonic() - start)
+
+    async def execute(self, fn: Callable[..., Any], labels: Dict[str, str], *args: Any) -> Tuple[Any, dict]:
+        """Runs a task, returns its result with the metrics it recorded instead of merging them."""
+        worker = await self._acquire()
+        task = partial(run_task, fn, labels, trace=tracing.context())
+        future = asyncio.get_event_loop().run_in_executor(worker.pool, task, *args)
+        # the worker is handed on once the task finished, even when the caller went away
+        future.add_done_callback(partial(self._done, worker))
+
+        timeout = self.limits.timeout + self.KILL_GRACE if self.limits.timeout else None
+        done, _ = await asyncio.wait([future], timeout=timeout)
+        if not done:
+            logger.error(f"Killing worker {worker.pid}, '{fn.__name__}' ran for more than {timeout}s")
+            worker.kill()
+            raise ConversionTimeoutError(f"Conversion did not finish within {self.limits.timeout}s")
+        return future.result()
+
+    async def submit(self, fn: Callable[..., Any], labels: Dict[str, str], *args: Any) -> Any:
+        result, samples = await self.execute(fn, labels, *args)
+        REGISTRY.merge(samples)
+        return result
+
+    def _done(self, worker: WorkerProcess, future: asyncio.Future) -> None:
+        worker.tasks += 1
+        err = None if future.cancelled() else future.exception()
+        reason = None
+        if worker.killed or isinstance(err, ConversionTimeoutError):
+            # an interrupted conversion may leave the worker's engines in any state
+            reason = 'timeout'
+        elif isinstance(err, BrokenProcessPool):
+            reason = 'died'
+        elif self.recycle_after is not None and worker.tasks >= self.recycle_after:
+            reason = 'tasks'
+        elif self.recycle_max_rss is not None and (worker.rss() or 0) > self.recycle_max_rss:
+            reason = 'memory'
+
+        if reason is None:
+            self._release(worker)
+            return
+
+        logger.info(f"Recycling worker {worker.pid} after {worker.tasks} task(s), reason: {reason}")
+        self.recycled[reason] += 1
+        WORKER_RECYCLES.inc(reason=reason)
+        self._workers.discard(worker)
+        task = asyncio.ensure_future(self._replace(worker))
+        self._replacing.add(task)
+        task.add_done_callback(self._replacing.discard)
+
+    async def _replace(self, worker: WorkerProcess) -> None:
+        await worker.stop(retire)
+        while True:
+            try:
+                await self._spawn()
+                return
+            except BrokenProcessPool as err:
+                logger.error(f"Unable to start a worker, retrying: {err}")
+                await asyncio.sleep(1)
+
+    @property
+    def live(self) -> int:
+        """The workers running or being started."""
+        return len(self._workers) + len(self._replacing) + len(self._growing)
+
+    async def _control(self) -> None:
+        while True:
+            await asyncio.sleep(self.scale_interval)
+            try:
+                self._scale()
+            except Exception:
+                logger.exception("Unable to scale workers")
+
+    def _scale(self) -> None:
+        now = time.monotonic()
+        wait = max([self._max_wait] + [now - start for start in self._waiting.values()])
+        self._max_wait = 0.0
+
+        if self._waiting and wait > self.scale_up_wait and self.live < self.size:
+            n = min(self.size - self.live, len(self._waiting) - len(self._growing))
+            if n > 0:
+                self._scale_up(n, f"a task waited {wait:.3f}s for a worker")
+        elif not self._waiting and self.live > self.min_workers:
+            self._scale_down(now)
+
+    def _scale_up(self, n: int, reason: str) -> None:
+        logger.info(f"Scaling workers up from {self.live} to {self.live + n}, {reason}")
+        self.scaled['up'] += n
+        WORKER_SCALING.inc(n, direction='up')
+        for i in range(0, n):
+            task = asyncio.ensure_future(self._grow())
+            self._growing.add(task)
+            task.add_done_callback(self._growing.discard)
+
+    async def _grow(self) -> None:
+        try:
+            await self._spawn()
+        except BrokenProcessPool as err:
+            logger.error(f"Unable to start a worker: {err}")
+
+    def _scale_down(self, now: float) -> None:
+        idle = []  # type: List[WorkerProcess]
+        while not self._idle.empty():
+            idle.append(self._idle.get_nowait())
+        # the longest idle go first, the others are handed out again in the order they became idle
+        idle.sort(key=lambda worker: worker.idle_since)
+        retired = []  # type: List[WorkerProcess]
+        for worker in idle:
+            if now - worker.idle_since >= self.scale_down_after and self.live > self.min_workers:
+                self._workers.discard(worker)
+                retired.append(worker)
+            else:
+                self._idle.put_nowait(worker)
+        if not retired:
+            return
+
+        idle_for = now - retired[-1].idle_since
+        logger.info(f"Scaling workers down from {self.live + len(retired)} to {self.live}, "
+                    f"idle for {idle_for:.0f}s")
+        self.scaled['down'] += len(retired)
+        WORKER_SCALING.inc(len(retired), direction='down')
+        WORKER_POOL_SIZE.set(len(self._workers))
+        for worker in retired:
+            task = asyncio.ensure_future(worker.stop(retire))
+            self._shrinking.add(task)
+            task.add_done_callback(self._shrinking.discard)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'recycled': dict(self.recycled),
+            'processes': len(self._workers),
+            'min_workers': self.min_workers,
+            'max_workers': self.size,
+            'scaled': dict(self.scaled),
+        }
+
+
+class Node(object):
+    """A `pandocserver worker` node as seen by the front-end."""
+
+    def __init__(self, url: str) -> None:
+        self.url = url.rstrip('/')
+        self.healthy = False
+        self.capacity = 1
+        self.in_flight = 0
+        self.dispatched = 0
+        self.lost = 0
+
+    @property
+    def load(self) -> float:
+        return self.in_flight / self.capacity
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'capacity': self.capacity,
+            'in_flight': self.in_flight,
+            'dispatched': self.dispatched,
+            'lost': self.lost,
+        }
+
+
+class RemoteExecutor(Executor):
+    """
+    Dispatches tasks to `pandocserver worker` nodes over HTTP.
+
+    The input file is uploaded with every task and the output streamed back
+    into a local file, so nodes need not share a filesystem with the
+    front-end. Tasks go to the healthy node with the smallest share of its
+    workers busy. Nodes are health checked every `health_interval` seconds, a
+    node failing a check or dropping a task is left out until it passes a
+    check again and its task is re-dispatched to another node. Conversion
+    errors and refused tasks (4xx) are reported by the node and not retried.
+
+    `size` starts out as the configured one and follows the workers the
+    healthy nodes report, `on_resize` is called with it when it changes.
+
+    Requests carry `secret` as a bearer token, options are sent by the names
+    configured in `options`, the nodes resolve them with their own.
+    """
+
+    shares_files = False
+
+    def __init__(self, urls: Sequence[str], size: int, health_interval: float = 5.0,
+                 connect_timeout: float = 5.0, secret: Optional[str] = None, options: Optional[Any] = None) -> None:
+        super().__init__(size)
+        self.nodes = [Node(url) for url in urls]
+        self.health_interval = health_interval
+        self.connect_timeout = connect_timeout
+        self._secret = secret
+        self._templates = options.templates if options is not None else {}  # type: Mapping[str, str]
+        self._filters = options.filters if options is not None else {}  # type: Mapping[str, str]
+        self._session = None  # type: Optional[aiohttp.ClientSession]
+        self._health_task = None  # type: Optional[asyncio.Future]
+        self.on_resize = None  # type: Optional[Callable[[int], None]]
+
+    async def start(self) -> None:
+        Path(DEFAULT_TEMP_DIR).mkdir(mode=0o700, exist_ok=True)
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout),
+            headers={'Authorization': f'Bearer {self._secret}'} if self._secret else None
+        )
+        await self.check()
+        healthy = sum(node.healthy for node in self.nodes)
+        if not healthy:
+            logger.warning("No healthy worker node, conversions fail until one is up")
+        logger.info(f"Dispatching to {healthy} of {len(self.nodes)} worker node(s)")
+        self._health_task = asyncio.ensure_future(self._check_periodically())
+
+    async def stop(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+        if self._session is not None:
+            await self._session.close()
+        await asyncio.get_event_loop().run_in_executor(
+            None, partial(shutil.rmtree, DEFAULT_TEMP_DIR, ignore_errors=True)
+        )
+
+    async def check(self) -> None:
+        await asyncio.gather(*[self._check(node) for node in self.nodes])
+        healthy = sum(node.healthy for node in self.nodes)
+        WORKER_NODES.set(healthy, state='healthy')
+        WORKER_NODES.set(len(self.nodes) - healthy, state='unhealthy')
+        size = sum(node.capacity for node in self.nodes if node.healthy)
+        if size and size != self.size:
+            # without healthy nodes conversions fail right away, the last size is kept
+            logger.info(f"Worker nodes run {size} worker(s)")
+            self.size = size
+            if self.on_resize is not None:
+                self.on_resize(size)
+
+    async def _check_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check()
+
+    async def _check(self, node: Node) -> None:
+        try:
+            timeout = aiohttp.ClientTimeout(total=self.health_interval)
+            async with self._session.get(f"{node.url}/health", timeout=timeout) as response:
+                response.raise_for_status()
+                health = await response.json()
+            capacity = max(1, int(health['capacity']))
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, TypeError, ValueError) as err:
+            if node.healthy:
+                logger.warning(f"Worker node '{node.url}' failed its health check: {err!r}")
+            node.healthy = False
+            return
+
+        if not node.healthy:
+            logger.info(f"Worker node '{node.url}' is up with {capacity} worker(s)")
+        node.healthy = True
+        node.capacity = capacity
+
+    def _pick(self, tried: Set[Node]) -> Node:
+        nodes = [node for node in self.nodes if node.healthy and node not in tried]
+        if not nodes:
+            raise NoWorkersError(f"No healthy worker node, tried {len(tried)} of {len(self.nodes)}")
+        return min(nodes, key=lambda node: (node.load, node.dispatched))
+
+    async def submit(self, fn: Callable[..., Any], labels: Dict[str, str], *args: Any) -> Any:
+        if fn.__name__ not in REMOTE_TASKS:
+            raise TypeError(f"Task '{fn.__name__}' can not run on worker nodes")
+        _, index = REMOTE_TASKS[fn.__name__]
+
+        args_ = list(args)
+        in_file = None  # type: Optional[Union[Path, bytes]]
+        if index is not None:
+            # a file, or the input itself for documents kept in memory
+            in_file = args_[index] if isinstance(args_[index], bytes) else Path(args_[index])
+            args_[index] = None
+        task = json.dumps({'labels': labels, 'args': encode_args(args_, self._templates, self._filters), 'trace': tracing.context()})
+
+        tried = set()  # type: Set[Node]
+        while True:
+            node = self._pick(tried)
+            tried.add(node)
+            node.in_flight += 1
+            node.dispatched += 1
+            try:
+                return await self._dispatch(node, fn.__name__, task, in_file)
+            except WorkerLostError as err:
+                node.healthy = False
+                node.lost += 1
+                NODE_REDISPATCHES.inc(node=node.url)
+                logger.warning(f"Lost worker node '{node.url}' running '{fn.__name__}', re-dispatching: {err}")
+            finally:
+                node.in_flight -= 1
+
+    async def _dispatch(self, node: Node, name: str, task: str, in_file: Optional[Union[Path, bytes]]) -> Any:
+        run = asyncio.get_event_loop().run_in_executor
+        fobj = await run(None, in_file.open, 'rb') if isinstance(in_file, Path) else None
+        try:
+            data = aiohttp.FormData()
+            data.add_field('task', task, content_type='application/json')
+            if fobj is not None:
+                data.add_field('file', fobj, filename=in_file.name)
+            elif in_file is not None:
+                data.add_field('file', in_file, filename='document')
+            async with self._session.post(f"{node.url}/tasks/{name}", data=data) as response:
+                if response.status == 422:
+                    # the conversion failed, another node would fail it as well
+                    raise RuntimeError(await response.text())
+                if response.status >= 500:
+                    raise WorkerLostError(f"HTTP {response.status}")
+                if response.status != 200:
+                    # refused, e.g. a wrong secret, which another node would refuse as well
+                    raise RuntimeError(f"Worker node '{node.url}' refused '{name}': HTTP {response.status}")
+
+                result = json.loads(response.headers['X-Task-Result'])
+                if result['kind'] == 'bytes':
+                    output = await response.read()
+                elif result['kind'] == 'json':
+                    output = await response.json()
+                else:
+                    output = await self._receive(response, result['filename'])
+                REGISTRY.merge(decode_samples(result['samples']))
+                return output
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as err:
+            raise WorkerLostError(repr(err))
+        finally:
+            if fobj is not None:
+                await run(None, fobj.close)
+
+    async def _receive(self, response: aiohttp.ClientResponse, filename: str) -> Path:
+        """Streams an output file into a dir of its own, like the ones the workers create."""
+        run = asyncio.get_event_loop().run_in_executor
+        out_dir = Path(await run(None, partial(mkdtemp, dir=DEFAULT_TEMP_DIR)))
+        out_file = out_dir / Path(filename).name
+        try:
+            with await run(None, out_file.open, 'wb') as fobj:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    await run(None, fobj.write, chunk)
+        except BaseException:
+            await run(None, partial(shutil.rmtree, str(out_dir), ignore_errors=True))
+            raise
+        return out_file
+
+    def stats(self) -> Dict[str, Any]:
+        return {'nodes': [node.to_dict() for node in self.nodes]}
@@ -0,0 +1,104 @@
+import importlib
+import inspect
+import io
+import logging
+import subprocess
+from typing import Any, Callable, List, NamedTuple, Optional, Sequence
+
+from . import limits
+from .metrics import timed
+
+logger = logging.getLogger('asyncio')
+
+
+class FilterError(Exception):
+    pass
+
+
+class Stage(NamedTuple):
+    name: str
+    # a panflute style `main(doc=None)` run in process, otherwise the filter is run as a command
+    main: Optional[Callable[..., Any]] = None
+
+
+class FilterPipeline(object):
+    """
+    Runs pandoc's Python filters on a JSON AST in sequence.
+
+    Filters are configured by their command name, e.g. `pandoc-latex-admonition`.
+    With `in_process` set the module of that name is imported once and, when
+    it has a panflute style `main(doc=None)`, called on the parsed document
+    instead of starting an interpreter for every filter and document.
+    Other filters are run as commands with the JSON piped through them, as
+    pandoc does.
+    """
+
+    def __init__(self, filters: Sequence[str], in_process: bool = True) -> None:
+        self.filters = tuple(filters)
+        self.in_process = in_process
+        self._stages = [Stage(name) for name in self.filters]  # type: List[Stage]
+        self._panflute = None  # type: Any
+
+    @property
+    def commands(self) -> List[str]:
+        return list(self.filters)
+
+    def load(self) -> None:
+        """Imports the filter modules, should be called once per worker."""
+        if not self.in_process or not self.filters:
+            return
+        try:
+            self._panflute = importlib.import_module('panflute')
+        except ImportError:
+            logger.warning("panflute is not installed, filters are run as commands")
+            return
+
+        stages = []
+        for name in self.filters:
+            main = None
+            try:
+                module = importlib.import_module(name.replace('-', '_'))
+            except ImportError as err:
+                logger.info(f"Unable to import filter '{name}', it is run as a command, reason: {err}")
+            else:
+                main = getattr(module, 'main', None)
+                if main is None or 'doc' not in inspect.signature(main).parameters:
+                    logger.info(f"Filter '{name}' does not take a document, it is run as a command")
+                    main = None
+            stages.append(Stage(name, main))
+        self._stages = stages
+        logger.info(f"Loaded {sum(stage.main is not None for stage in stages)} of {len(stages)} filter(s) in process")
+
+    def run(self, ast: str, to_format: str) -> str:
+        """Runs the filters on a JSON AST written for `to_format`, returns the filtered AST."""
+        doc = None  # the parsed document while filters run in process one after another
+        for stage in self._stages:
+            with timed('filter'):
+                if stage.main is not None:
+                    if doc is None:
+                        doc = self._panflute.load(io.StringIO(ast))
+                        doc.format = to_format
+                    try:
+                        result = stage.main(doc=doc)
+                    except Exception as err:
+                        raise FilterError(f"Filter '{stage.name}' failed, reason: {err!r}")
+                    doc = doc if result is None else result
+                    continue
+
+                if doc is not None:
+                    ast, doc = self._dump(doc), None
+                try:
+                    process = limits.run([stage.name, to_format], input=ast, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE, universal_newlines=True)
+                except OSError as err:
+                    raise FilterError(f"Unable to run filter '{stage.name}', reason: {err}")
+                if process.returncode != 0:
+                    raise FilterError(f"Filter '{stage.name}' failed: {process.stderr.strip()}")
+                ast = process.stdout
+
+        return ast if doc is None else self._dump(doc)
+
+    def _dump(self, doc: Any) -> str:
+        fobj = io.StringIO()
+        self._panflute.dump(doc, fobj)
+        return fobj.getvalue()
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import threading
+from functools import partial
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Tuple, Union
+
+from .utils import clean_up_result
+
+logger = logging.getLogger('asyncio')
+
+
+class _Flight(object):
+
+    def __init__(self, task: asyncio.Future) -> None:
+        self.task = task
+        # the callers waiting for the result, each gets a reference to a result file
+        self.waiters = 0
+        self.landed = False
+
+
+class Flights(object):
+    """
+    Runs concurrent conversions with the same key once.
+
+    `run` starts the conversion or joins the one in flight for its key, so
+    identical requests arriving together share a single executor job. The
+    conversion runs as a task of its own, which removes its input, and its
+    result is `(output, cached)` as returned by `SiteHandler.run`. Every
+    caller getting a fresh result file holds a reference to it, returned with
+    `release`, and the file is removed once the last one was returned. A
+    conversion whose callers went away still finishes, e.g. for the cache.
+    """
+
+    def __init__(self) -> None:
+        self.coalesced = 0
+        self._flights = {}  # type: Dict[str, _Flight]
+        self._refs = {}  # type: Dict[str, int]
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._flights
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[Tuple[Any, bool]]]) -> Tuple[Tuple[Any, bool], bool]:
+        """Returns the result of `fn`, or of the conversion in flight for `key`, and whether it was shared."""
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fn()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(partial(self._landed, key, flight))
+        else:
+            self.coalesced += 1
+        flight.waiters += 1
+        try:
+            # one caller going away does not cancel the conversion of the others
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.landed:
+                flight.waiters -= 1
+            elif not flight.task.cancelled() and flight.task.exception() is None:
+                self._release_result(flight.task.result())
+            raise
+        return result, shared
+
+    def _landed(self, key: str, flight: _Flight, task: asyncio.Future) -> None:
+        flight.landed = True
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        output, cached = task.result()
+        if isinstance(output, Path) and not cached:
+            if flight.waiters == 0:
+                clean_up_result(output)
+            elif flight.waiters > 1:
+                logger.info(f"Conversion shared by {flight.waiters} requests, created file: '{output.name}'")
+                with self._lock:
+                    self._refs[str(output)] = flight.waiters
+
+    def _release_result(self, result: Tuple[Any, bool]) -> None:
+        output, cached = result
+        if isinstance(output, Path) and not cached:
+            self.release(output)
+
+    def release(self, filepath: Union[str, Path]) -> None:
+        """Returns a reference to a result file, removes it when it was the last one."""
+        filepath = str(filepath)
+        with self._lock:
+            refs = self._refs.pop(filepath, 1) - 1
+            if refs > 0:
+                self._refs[filepath] = refs
+                return
+        clean_up_result(filepath)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            shared = len(self._refs)
+        return {'in_flight': self.in_flight, 'coalesced': self.coalesced, 'shared_results': shared}
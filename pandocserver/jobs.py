@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiohttp import web
+
+from . import tracing
+from .uploads import Upload
+from .utils import JobsConfig, clean_up_result, clean_up_tempfile
+
+logger = logging.getLogger('asyncio')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    upload: Upload
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = QUEUED
+    result: Optional[Path] = None
+    cached: bool = False
+    error: Optional[str] = None
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'filename': self.upload.filename,
+            'from': self.upload.from_format,
+            'to': self.upload.to_format,
+            'trace_id': self.upload.trace[0] if self.upload.trace else None,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobManager(object):
+    """
+    Runs conversion jobs in the background from a bounded queue.
+
+    `run` converts an upload and returns the result file and whether it was
+    served from the cache. Finished jobs and their results are kept for `ttl`
+    seconds after which both are removed.
+    """
+
+    def __init__(self,
+                 run: Callable[[Upload], Awaitable[Tuple[Path, bool]]],
+                 concurrency: int,
+                 max_queued: int,
+                 ttl: float) -> None:
+        self._run = run
+        self._concurrency = concurrency
+        self._ttl = ttl
+        self._jobs = {}  # type: Dict[str, Job]
+        self._queue = asyncio.Queue(maxsize=max_queued)  # type: asyncio.Queue
+        self._consumers = []
+        self._loop = asyncio.get_event_loop()
+
+    def submit(self, upload: Upload) -> Job:
+        job = Job(upload=upload)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFullError(f"Job queue is full ({self._queue.maxsize} jobs)")
+        self._jobs[job.id] = job
+        logger.info(f"Queued job '{job.id}' for '{upload.filename}'")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def stats(self) -> Dict[str, int]:
+        stats = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        for job in self._jobs.values():
+            stats[job.status] += 1
+        return stats
+
+    async def _consume(self) -> None:
+        while True:
+            job = await self._queue.get()
+            job.status = RUNNING
+            job.started = time.time()
+            try:
+                with tracing.traced(job.upload.trace):
+                    job.result, job.cached = await self._run(job.upload)
+            except Exception as err:
+                logger.error(f"Job '{job.id}' failed: {err}")
+                job.status = FAILED
+                job.error = str(err)
+            else:
+                logger.info(f"Job '{job.id}' done, created file: '{job.result.name}'")
+                job.status = DONE
+            finally:
+                job.finished = time.time()
+                await self._loop.run_in_executor(None, clean_up_tempfile, job.upload.path)
+                self._loop.call_later(self._ttl, self._expire, job.id)
+                self._queue.task_done()
+
+    def _expire(self, job_id: str) -> None:
+        job = self._jobs.pop(job_id, None)
+        if job is not None and job.result is not None and not job.cached:
+            self._loop.run_in_executor(None, clean_up_result, str(job.result))
+        logger.debug(f"Expired job '{job_id}'")
+
+    async def start(self, *args: Any) -> None:
+        self._consumers = [asyncio.ensure_future(self._consume()) for _ in range(self._concurrency)]
+
+    async def stop(self, *args: Any) -> None:
+        for consumer in self._consumers:
+            consumer.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        for job in self._jobs.values():
+            clean_up_tempfile(job.upload.path)
+            if job.result is not None and not job.cached:
+                clean_up_result(job.result)
+        self._jobs.clear()
+
+
+def init_jobs(app: web.Application, conf: JobsConfig,
+              run: Callable[[Upload], Awaitable[Tuple[Path, bool]]]) -> JobManager:
+    jobs = JobManager(run, conf.concurrency or app['config'].workers.max_workers, conf.max_queued, conf.ttl)
+    app.on_startup.append(jobs.start)
+    app.on_cleanup.append(jobs.stop)
+    app['jobs'] = jobs
+    return jobs
@@ -0,0 +1,170 @@
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+from collections import Counter
+from pathlib import Path
+from typing import Optional, Union
+
+from . import limits
+from .services import FORMATS_CACHE_DIR
+
+logger = logging.getLogger('asyncio')
+
+LATEX_CACHE_DIR = FORMATS_CACHE_DIR / 'latex'
+
+BEGIN_DOCUMENT = '\\begin{document}'
+
+
+class LatexError(Exception):
+    pass
+
+
+class LatexEngine(object):
+    """
+    Compiles pandoc's LaTeX output to pdf, keeping warm state between conversions.
+
+    Template preambles are dumped into format files with mylatexformat, keyed
+    by their content, so documents sharing a preamble skip loading its
+    packages. Format files and the TeX and fontconfig font caches live in
+    `cache_dir`, which is shared by the workers and kept across restarts,
+    while every worker reuses a single aux dir for its runs.
+    """
+
+    MAX_RUNS = 3
+
+    def __init__(self, engine: str = 'xelatex', cache_dir: Union[str, Path] = LATEX_CACHE_DIR,
+                 dump_preamble: bool = True, max_formats: int = 8) -> None:
+        self.engine = engine
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.dump_preamble = dump_preamble
+        self.max_formats = max_formats
+        self.aux_dir = None  # type: Optional[Path]
+        self._env = {}
+        self._version = ''
+        self._formats = {}
+        self._seen = Counter()  # type: Counter
+
+    @property
+    def formats_dir(self) -> Path:
+        return self.cache_dir / 'formats'
+
+    def start(self, preamble: Optional[str] = None) -> None:
+        """Sets up the caches and aux dir and dumps `preamble`, e.g. of the configured template."""
+        if shutil.which(self.engine) is None:
+            raise LatexError(f"LaTeX engine '{self.engine}' not found")
+
+        for name in ('formats', 'texmf-var', 'xdg-cache'):
+            (self.cache_dir / name).mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.aux_dir = self.cache_dir / f'aux-{os.getpid()}'
+        shutil.rmtree(str(self.aux_dir), ignore_errors=True)
+        self.aux_dir.mkdir(mode=0o700)
+
+        self._env = dict(
+            os.environ,
+            TEXMFVAR=str(self.cache_dir / 'texmf-var'),
+            TEXMFCACHE=str(self.cache_dir / 'texmf-var'),
+            # fontconfig keeps its cache in $XDG_CACHE_HOME/fontconfig
+            XDG_CACHE_HOME=str(self.cache_dir / 'xdg-cache'),
+            TEXFORMATS=f"{self.formats_dir}{os.pathsep}",
+        )
+        self._version = subprocess.run([self.engine, '--version'], stdout=subprocess.PIPE, env=self._env,
+                                       universal_newlines=True).stdout.split('\n', 1)[0]
+
+        if preamble is not None and self.dump_preamble:
+            self._format(preamble, dump=True)
+        logger.info(f"Started {self._version or self.engine} with cache dir '{self.cache_dir}'")
+
+    def stop(self) -> None:
+        if self.aux_dir is not None:
+            shutil.rmtree(str(self.aux_dir), ignore_errors=True)
+            self.aux_dir = None
+
+    def _format(self, preamble: str, dump: bool = False) -> Optional[str]:
+        """Returns the name of the format file for the preamble, dumping it when asked to."""
+        key = hashlib.sha256(f"{self.engine}:{self._version}:{preamble}".encode('utf-8')).hexdigest()[:32]
+        if key in self._formats:
+            return self._formats[key]
+
+        if (self.formats_dir / f'{key}.fmt').exists():
+            self._formats[key] = key
+            return key
+
+        # preambles holding document metadata are only dumped once they recur
+        self._seen[key] += 1
+        if not dump and (self._seen[key] < 2 or len(self._formats) >= self.max_formats):
+            return None
+
+        jobname = f'{key}-{os.getpid()}'
+        source = self.aux_dir / f'{jobname}.tex'
+        source.write_text(f"{preamble}{BEGIN_DOCUMENT}\n\\end{{document}}\n", encoding='utf-8')
+        try:
+            process = limits.run(
+                [self.engine, '-ini', '-interaction=nonstopmode', f'-jobname={jobname}',
+                 f'-output-directory={self.formats_dir}', f'&{self.engine}', 'mylatexformat.ltx', source.name],
+                cwd=str(self.aux_dir), env=self._env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True
+            )
+            dumped = self.formats_dir / f'{jobname}.fmt'
+            if process.returncode != 0 or not dumped.exists():
+                # e.g. xelatex can not dump preambles which load native fonts
+                logger.warning("Unable to dump the preamble, compiling it with every document instead")
+                self._formats[key] = None
+                return None
+            os.replace(str(dumped), str(self.formats_dir / f'{key}.fmt'))
+        finally:
+            for path in self.aux_dir.glob(f'{jobname}.*'):
+                path.unlink()
+            for path in self.formats_dir.glob(f'{jobname}.*'):
+                path.unlink()
+
+        logger.info(f"Dumped preamble into format '{key}'")
+        self._formats[key] = key
+        return key
+
+    def _reset_aux_dir(self) -> None:
+        for path in self.aux_dir.iterdir():
+            if path.is_dir():
+                shutil.rmtree(str(path), ignore_errors=True)
+            else:
+                path.unlink()
+
+    def compile(self, tex: str, out_file: Union[str, Path], resource_dir: Optional[Union[str, Path]] = None) -> Path:
+        """Compiles a standalone LaTeX document to `out_file`, resolving images relative to `resource_dir`."""
+        if self.aux_dir is None:
+            raise LatexError("LaTeX engine is not started")
+
+        self._reset_aux_dir()
+        preamble, begin, _ = tex.partition(BEGIN_DOCUMENT)
+        fmt = self._format(preamble) if begin and self.dump_preamble else None
+
+        source = self.aux_dir / 'document.tex'
+        source.write_text(tex, encoding='utf-8')
+        env = dict(self._env)
+        if resource_dir is not None:
+            env['TEXINPUTS'] = f"{Path(resource_dir).resolve()}{os.pathsep}"
+
+        args = [self.engine, '-interaction=nonstopmode', '-halt-on-error', f'-output-directory={self.aux_dir}']
+        if fmt is not None:
+            args.append(f'-fmt={fmt}')
+        args.append(source.name)
+
+        for run in range(self.MAX_RUNS):
+            process = limits.run(args, cwd=str(self.aux_dir), env=env, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, universal_newlines=True)
+            if process.returncode != 0:
+                raise LatexError(f"{self.engine} failed: {self._errors(process.stdout)}")
+            log = (self.aux_dir / 'document.log').read_text(encoding='utf-8', errors='replace')
+            # pandoc's rule: rerun for the table of contents and while labels changed
+            if 'Rerun to get' not in log and not (run == 0 and '\\tableofcontents' in tex):
+                break
+
+        out_file = Path(out_file)
+        shutil.move(str(self.aux_dir / 'document.pdf'), str(out_file))
+        return out_file
+
+    @staticmethod
+    def _errors(output: str) -> str:
+        lines = [line for line in output.splitlines() if line.startswith('!')]
+        return "\n".join(lines) or output[-1000:]
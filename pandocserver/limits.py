@@ -0,0 +1,78 @@
+import logging
+import resource
+import signal
+import subprocess
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Optional, Sequence
+
+logger = logging.getLogger('asyncio')
+
+
+class ConversionTimeoutError(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True)
+class ResourceLimits:
+    """Limits of a conversion, the wall-clock `timeout` and the resources of each child process."""
+    timeout: Optional[float] = None
+    # address space in bytes, RLIMIT_RSS is not enforced by Linux
+    memory: Optional[int] = None
+    # cpu seconds
+    cpu: Optional[int] = None
+
+    def apply(self) -> None:
+        """Limits the resources of the current process, run in children before they exec."""
+        if self.memory:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory, self.memory))
+        if self.cpu:
+            # SIGXCPU at the soft limit, SIGKILL a second later
+            resource.setrlimit(resource.RLIMIT_CPU, (self.cpu, self.cpu + 1))
+
+
+_limits = ResourceLimits()
+
+
+def set_limits(limits: ResourceLimits) -> None:
+    global _limits
+    _limits = limits
+
+
+def get_limits() -> ResourceLimits:
+    return _limits
+
+
+def _preexec() -> Optional[Callable[[], None]]:
+    return _limits.apply if _limits.memory or _limits.cpu else None
+
+
+def run(args: Sequence[str], **kwargs: Any) -> subprocess.CompletedProcess:
+    """
+    Runs a child process with the resource limits applied.
+
+    The child is killed when the conversion's deadline interrupts the wait.
+    """
+    process = subprocess.run(args, preexec_fn=_preexec(), **kwargs)
+    if process.returncode in (-signal.SIGXCPU, -signal.SIGKILL) and _limits.cpu:
+        logger.warning(f"'{args[0]}' was killed after {_limits.cpu} cpu second(s)")
+    return process
+
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    """Raises a `ConversionTimeoutError` in the block once it ran for `seconds`, main thread only."""
+    if not seconds:
+        yield
+        return
+
+    def expired(signum: int, frame: Any) -> None:
+        raise ConversionTimeoutError(f"Conversion did not finish within {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
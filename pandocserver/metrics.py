@@ -0,0 +1,268 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .tracing import span
+
+logger = logging.getLogger('asyncio')
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, float('inf'))
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Metric(object):
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # type: Dict[LabelValues, Any]
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def drain(self) -> Dict[LabelValues, Any]:
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values: Dict[LabelValues, Any]) -> None:
+        raise NotImplementedError
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        return '\n'.join(lines + self.samples())
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def merge(self, values: Dict[LabelValues, Any]) -> None:
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+    def collected(self, samples: Dict[str, Dict[LabelValues, Any]], **labels: Any) -> float:
+        """Returns the value for the labels from samples gathered with `collect`."""
+        return samples.get(self.name, {}).get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            # per bucket counts followed by the sum of all observations
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 1))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def merge(self, values: Dict[LabelValues, Any]) -> None:
+        with self._lock:
+            for key, other in values.items():
+                counts = self._values.setdefault(key, [0] * (len(self.buckets) + 1))
+                for i, value in enumerate(other):
+                    counts[i] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, counts in sorted(self._values.items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                labels = _format_labels(self.labelnames + ('le',), key + (_format_value(bound),))
+                lines.append(f'{self.name}_bucket{labels} {total}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+
+class Registry(object):
+    """
+    Process local collection of metrics.
+
+    Worker processes `drain` their registry after every task and ship the
+    result to the parent which `merge`s it into its own registry.
+    """
+
+    def __init__(self) -> None:
+        self._metrics = {}  # type: Dict[str, Metric]
+
+    def register(self, metric: Metric) -> Any:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def drain(self) -> Dict[str, Dict[LabelValues, Any]]:
+        return {name: values for name, values in
+                ((name, metric.drain()) for name, metric in self._metrics.items()) if values}
+
+    def merge(self, samples: Optional[Dict[str, Dict[LabelValues, Any]]]) -> None:
+        collected = _collected.get()
+        for name, values in (samples or {}).items():
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric.merge(values)
+            if collected is not None and isinstance(metric, Counter):
+                totals = collected.setdefault(name, {})
+                for key, value in values.items():
+                    totals[key] = totals.get(key, 0) + value
+
+    def expose(self) -> str:
+        return '\n'.join(metric.expose() for metric in self._metrics.values()) + '\n'
+
+
+_collected = contextvars.ContextVar('collected', default=None)  # type: contextvars.ContextVar
+
+
+@contextmanager
+def collect() -> Iterator[Dict[str, Dict[LabelValues, Any]]]:
+    """Additionally gathers the counters merged from workers within the block, e.g. for one request."""
+    samples = {}  # type: Dict[str, Dict[LabelValues, Any]]
+    token = _collected.set(samples)
+    try:
+        yield samples
+    finally:
+        _collected.reset(token)
+
+
+def encode_samples(samples: Dict[str, Dict[LabelValues, Any]]) -> Dict[str, List[List[Any]]]:
+    """Returns drained samples in a JSON serializable form, e.g. to ship them from a worker node."""
+    return {name: [[list(key), value] for key, value in values.items()] for name, values in samples.items()}
+
+
+def decode_samples(data: Dict[str, List[List[Any]]]) -> Dict[str, Dict[LabelValues, Any]]:
+    return {name: {tuple(key): value for key, value in values} for name, values in data.items()}
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'pandocserver_stage_duration_seconds', 'Time spent per conversion stage.',
+    ('stage', 'from_format', 'to_format')
+))
+
+RECEIVED_BYTES = REGISTRY.register(Counter(
+    'pandocserver_received_bytes_total', 'Bytes of uploaded documents.', ('from_format', 'to_format')
+))
+
+SENT_BYTES = REGISTRY.register(Counter(
+    'pandocserver_sent_bytes_total', 'Bytes of converted documents sent.', ('from_format', 'to_format')
+))
+
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    'pandocserver_cache_lookups_total', 'Result cache lookups by outcome.', ('result',)
+))
+
+COALESCED = REGISTRY.register(Counter(
+    'pandocserver_coalesced_requests_total', 'Requests served by an identical conversion already in flight.',
+    ('from_format', 'to_format')
+))
+
+ARCHIVE_MEMBERS = REGISTRY.register(Counter(
+    'pandocserver_archive_members_total', 'Archive members converted or reused from the cache.', ('result',)
+))
+
+POOL_CONVERSIONS = REGISTRY.register(Gauge(
+    'pandocserver_pool_conversions', 'Conversions running on or queued for the worker pool.', ('state',)
+))
+
+QUEUE_WAIT = REGISTRY.register(Histogram(
+    'pandocserver_queue_wait_seconds', 'Time conversions waited for a worker slot by cost class.', ('cost_class',)
+))
+
+WORKER_RECYCLES = REGISTRY.register(Counter(
+    'pandocserver_worker_recycles_total', 'Worker processes replaced by a freshly warmed one.', ('reason',)
+))
+
+WORKER_POOL_SIZE = REGISTRY.register(Gauge(
+    'pandocserver_worker_processes', 'Warm worker processes of the local pool.', ()
+))
+
+WORKER_SCALING = REGISTRY.register(Counter(
+    'pandocserver_worker_scaling_total', 'Worker processes started or retired by the pool autoscaler.',
+    ('direction',)
+))
+
+WORKER_NODES = REGISTRY.register(Gauge(
+    'pandocserver_worker_nodes', 'Remote worker nodes by health.', ('state',)
+))
+
+NODE_REDISPATCHES = REGISTRY.register(Counter(
+    'pandocserver_node_redispatches_total', 'Tasks re-dispatched after losing the worker node running them.',
+    ('node',)
+))
+
+_labels = threading.local()
+
+
+@contextmanager
+def labelled(**labels: Any) -> Iterator[None]:
+    """Sets the default labels for the stages timed in this thread."""
+    previous = getattr(_labels, 'values', {})
+    _labels.values = dict(previous, **labels)
+    try:
+        yield
+    finally:
+        _labels.values = previous
+
+
+@contextmanager
+def timed(stage: str, **labels: Any) -> Iterator[None]:
+    """Observes the duration of the block as `stage` in the stage histogram, and traces it."""
+    labels = dict(getattr(_labels, 'values', {}), **labels)
+    start = time.perf_counter()
+    try:
+        with span(stage, **labels):
+            yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage, **labels)
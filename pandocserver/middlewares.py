@@ -1,6 +1,12 @@
+import hmac
+
 import aiohttp_jinja2
 from aiohttp import web
 
+from . import tracing
+
+TRACE_HEADER = 'X-Trace-Id'
+
 
 async def handle_404(request):
     return aiohttp_jinja2.render_template('404.html', request, {}, status=404)
@@ -38,9 +44,49 @@ def create_error_middleware(overrides):
     return error_middleware
 
 
+def create_trace_middleware(request_id_header='X-Request-Id'):
+
+    @web.middleware
+    async def trace_middleware(request, handler):
+        # a request id given by the client or a proxy is kept as the trace id
+        trace_id = tracing.trace_id(request.headers.get(request_id_header))
+        request['trace_id'] = trace_id
+
+        with tracing.traced((trace_id, None)), \
+                tracing.span('request', method=request.method, path=request.path) as attributes:
+            try:
+                response = await handler(request)
+            except web.HTTPException as ex:
+                attributes['status'] = ex.status
+                ex.headers[TRACE_HEADER] = trace_id
+                raise
+            except Exception:
+                attributes['status'] = 500
+                raise
+
+            attributes['status'] = response.status
+            response.headers[TRACE_HEADER] = trace_id
+            return response
+
+    return trace_middleware
+
+
+def create_auth_middleware(secret):
+
+    @web.middleware
+    async def auth_middleware(request, handler):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme != 'Bearer' or not hmac.compare_digest(token.encode('utf-8'), secret.encode('utf-8')):
+            raise web.HTTPUnauthorized(headers={'WWW-Authenticate': 'Bearer'})
+        return await handler(request)
+
+    return auth_middleware
+
+
 def init_middlewares(app):
     error_middleware = create_error_middleware({
         404: handle_404,
         500: handle_500
     })
+    app.middlewares.append(create_trace_middleware())
     app.middlewares.append(error_middleware)
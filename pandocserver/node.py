@@ -0,0 +1,147 @@
+import asyncio
+import inspect
+import json
+import logging
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from pathlib import Path
+from typing import IO, Any, Callable, List
+from tempfile import NamedTemporaryFile
+
+from aiohttp import web
+from aiohttp.multipart import BodyPartReader
+
+from . import tracing
+from .executors import LocalExecutor, REMOTE_TASKS, decode_args
+from .metrics import encode_samples
+from .middlewares import create_auth_middleware
+from .responses import FileResponse
+from .services import get_formats
+from .uploads import spool
+from .utils import Config, clean_up_tempfile, init_cache, init_config, init_traces, init_workers
+from .worker import DEFAULT_TEMP_DIR
+
+logger = logging.getLogger('asyncio')
+
+
+def check_args(fn: Callable[..., Any], args: List[Any]) -> None:
+    """Checks the arguments of a task from a front-end which end up in paths or pandoc's arguments."""
+    values = inspect.signature(fn).bind(*args).arguments
+    if 'service' in values:
+        raise ValueError("Tasks can not be given a service")
+    filename = values.get('filename', 'document')
+    if not isinstance(filename, str) or filename in ('', '.', '..') or Path(filename).name != filename:
+        raise ValueError(f"Not a plain file name: '{filename}'")
+    formats = get_formats()
+    if 'from_format' in values and values['from_format'] not in formats.input:
+        raise ValueError(f"Unknown input format: '{values['from_format']}'")
+    to_formats = values.get('to_formats') or [values.get('to_format')]
+    if 'to_format' in values or 'to_formats' in values:
+        for to_format in to_formats:
+            if to_format not in formats.output:
+                raise ValueError(f"Unknown output format: '{to_format}'")
+
+
+class NodeHandler:
+    """
+    Runs the tasks front-ends dispatch with a `RemoteExecutor` on this node's workers.
+
+    `POST /tasks/{task}` takes the task's JSON encoded labels and arguments
+    followed by its input file, if it takes one, and responds with the
+    output, a file, bytes or JSON, and an `X-Task-Result` header carrying the
+    kind of output and the metrics recorded. Failed conversions and invalid
+    arguments are answered with a `422`, options are resolved by their names
+    against this node's own `options`. Every request needs the node secret.
+    """
+
+    def __init__(self, conf: Config, executor: LocalExecutor) -> None:
+        self._conf = conf
+        self._executor = executor
+        self._loop = asyncio.get_event_loop()
+        self.in_flight = 0
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'capacity': self._executor.size,
+            'in_flight': self.in_flight,
+            'version': get_formats().version,
+        })
+
+    async def _spool(self, field: BodyPartReader) -> IO[bytes]:
+        ext = "".join(Path(field.filename).suffixes)
+        r = self._loop.run_in_executor
+        fobj = await r(
+            None,
+            partial(NamedTemporaryFile, mode='wb', suffix=f'{ext}', dir=DEFAULT_TEMP_DIR, delete=False)
+        )
+        try:
+            with fobj:
+                uploads = self._conf.uploads
+                await spool(field, fobj, uploads.chunk_size, uploads.max_size, uploads.queue_size)
+        except BaseException:
+            await r(None, clean_up_tempfile, fobj.name)
+            raise
+        return fobj
+
+    async def run_task(self, request: web.Request) -> web.StreamResponse:
+        name = request.match_info['task']
+        if name not in REMOTE_TASKS:
+            raise web.HTTPNotFound()
+        fn, index = REMOTE_TASKS[name]
+
+        reader = await request.multipart()
+        field = await reader.next()
+        assert field.name == 'task'
+        task = json.loads(await field.text())
+
+        field = await reader.next()
+        fobj = None
+        try:
+            options = self._conf.options
+            args = decode_args(task['args'], options.templates, options.filters)
+            check_args(fn, args)
+            if index is not None:
+                assert field.name == 'file'
+                fobj = await self._spool(field)
+                args[index] = fobj.name
+            self.in_flight += 1
+            trace = task.get('trace')
+            try:
+                with tracing.traced(tuple(trace) if trace else None):  # type: ignore
+                    result, samples = await self._executor.execute(fn, task['labels'], *args)
+            finally:
+                self.in_flight -= 1
+        except BrokenProcessPool as err:
+            logger.error(f"Worker pool is broken: {err}")
+            raise web.HTTPServiceUnavailable(text=str(err))
+        except Exception as err:
+            logger.error(f"{err}")
+            return web.Response(text=str(err), status=422)
+        finally:
+            if fobj is not None:
+                await self._loop.run_in_executor(None, clean_up_tempfile, fobj.name)
+
+        header = {'kind': 'bytes', 'samples': encode_samples(samples)}
+        if isinstance(result, bytes):
+            return web.Response(body=result, headers={'X-Task-Result': json.dumps(header)})
+        if isinstance(result, list):
+            header.update(kind='json')
+            return web.json_response(result, headers={'X-Task-Result': json.dumps(header)})
+
+        result = Path(result)
+        header.update(kind='file', filename=result.name)
+        return FileResponse(path=str(result.resolve()), headers={'X-Task-Result': json.dumps(header)}, delete=True)
+
+
+async def init_node(conf: Config) -> web.Application:
+    if not conf.workers.node_secret:
+        raise ValueError("A worker node requires 'workers.node_secret', shared with its front-ends")
+    app = web.Application(middlewares=[create_auth_middleware(conf.workers.node_secret)])
+    init_config(app, conf)
+    cache = init_cache(app, conf.cache)
+    executor = await init_workers(app, conf.workers, conf.document, cache, conf.pdf, conf.filters, local=True,
+                                  traces=init_traces(app, conf.traces))
+    handler = NodeHandler(conf, executor)  # type: ignore
+    app.router.add_route('GET', '/health', handler.health, name='health')
+    app.router.add_route('POST', '/tasks/{task}', handler.run_task, name='tasks')
+    return app
@@ -0,0 +1,148 @@
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from .compression import available_codecs
+
+METADATA_KEY = re.compile(r'^[A-Za-z][\w-]{0,63}$')
+MAX_METADATA = 32
+MAX_METADATA_VALUE = 1024
+
+# options a request may set, repeatable ones can be given several times
+OPTIONS = frozenset(['template', 'standalone', 'toc', 'toc_depth', 'number_sections', 'metadata', 'filter', 'compression'])
+REPEATABLE_OPTIONS = frozenset(['metadata', 'filter'])
+
+
+class InvalidOptionError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class ConversionOptions:
+    """Per request pandoc options, with templates and filters resolved to their configured paths."""
+    template: Optional[str] = None
+    # documents are always standalone, batch snippets only when asked for
+    standalone: bool = False
+    toc: bool = False
+    toc_depth: Optional[int] = None
+    number_sections: bool = False
+    metadata: Tuple[Tuple[str, str], ...] = ()
+    filters: Tuple[str, ...] = ()
+    # the codec of archive outputs, `store` also leaves text outputs unencoded
+    compression: Optional[str] = None
+
+
+def _bool(name: str, value: str) -> bool:
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if value.lower() in ('0', 'false', 'no', 'off', ''):
+        return False
+    raise InvalidOptionError(f"Not a boolean for '{name}': '{value}'")
+
+
+def _choice(name: str, value: str, choices: Mapping[str, str]) -> str:
+    if value not in choices:
+        raise InvalidOptionError(f"Unknown {name} '{value}', available: {', '.join(sorted(choices)) or 'none'}")
+    return choices[value]
+
+
+def parse_options(fields: Dict[str, List[str]], templates: Mapping[str, str],
+                  filters: Mapping[str, str]) -> ConversionOptions:
+    """
+    Checks the option fields of a request against the whitelist.
+
+    Templates and filters are referred to by their configured names, so
+    clients can not point pandoc at arbitrary files or programs.
+    """
+    for name, values in fields.items():
+        if name not in OPTIONS:
+            raise InvalidOptionError(f"Unknown option '{name}'")
+        if len(values) > 1 and name not in REPEATABLE_OPTIONS:
+            raise InvalidOptionError(f"Option '{name}' given more than once")
+
+    options = {}  # type: Dict[str, object]
+    if 'template' in fields:
+        options['template'] = _choice('template', fields['template'][0], templates)
+    if 'standalone' in fields:
+        options['standalone'] = _bool('standalone', fields['standalone'][0])
+    if 'toc' in fields:
+        options['toc'] = _bool('toc', fields['toc'][0])
+    if 'toc_depth' in fields:
+        value = fields['toc_depth'][0]
+        if not value.isdigit() or not 1 <= int(value) <= 6:
+            raise InvalidOptionError(f"Not a toc depth between 1 and 6: '{value}'")
+        options['toc_depth'] = int(value)
+    if 'number_sections' in fields:
+        options['number_sections'] = _bool('number_sections', fields['number_sections'][0])
+    if 'metadata' in fields:
+        metadata = []
+        for item in fields['metadata']:
+            key, sep, value = item.partition('=')
+            if not sep or not METADATA_KEY.match(key):
+                raise InvalidOptionError(f"Not a key=value metadata item: '{item[:80]}'")
+            if len(value) > MAX_METADATA_VALUE or '\n' in value:
+                raise InvalidOptionError(f"Metadata value of '{key}' is too long or spans lines")
+            metadata.append((key, value))
+        if len(metadata) > MAX_METADATA:
+            raise InvalidOptionError(f"More than {MAX_METADATA} metadata items")
+        options['metadata'] = tuple(metadata)
+    if 'filter' in fields:
+        options['filters'] = tuple(_choice('filter', name, filters) for name in fields['filter'])
+    if 'compression' in fields:
+        codecs = available_codecs()
+        options['compression'] = _choice('compression', fields['compression'][0], dict(zip(codecs, codecs)))
+    return ConversionOptions(**options)  # type: ignore
+
+
+def option_fields(options: ConversionOptions, templates: Mapping[str, str],
+                  filters: Mapping[str, str]) -> Dict[str, List[str]]:
+    """
+    Returns the option fields of a request `parse_options` turns into `options`.
+
+    Worker nodes get these instead of the resolved options, so they check them
+    against their own whitelist.
+    """
+    template_names = {path: name for name, path in templates.items()}
+    filter_names = {path: name for name, path in filters.items()}
+    fields = {}  # type: Dict[str, List[str]]
+    if options.template is not None:
+        fields['template'] = [template_names[options.template]]
+    if options.standalone:
+        fields['standalone'] = ['true']
+    if options.toc:
+        fields['toc'] = ['true']
+    if options.toc_depth is not None:
+        fields['toc_depth'] = [str(options.toc_depth)]
+    if options.number_sections:
+        fields['number_sections'] = ['true']
+    if options.metadata:
+        fields['metadata'] = [f"{key}={value}" for key, value in options.metadata]
+    if options.filters:
+        fields['filter'] = [filter_names[path] for path in options.filters]
+    if options.compression is not None:
+        fields['compression'] = [options.compression]
+    return fields
+
+
+@lru_cache(maxsize=256)
+def build_args(base: Tuple[str, ...], options: Optional[ConversionOptions] = None) -> Tuple[str, ...]:
+    """Returns the pandoc arguments for a conversion, the configured ones followed by the request's."""
+    if options is None:
+        return base
+
+    args = list(base)
+    if options.standalone and '--standalone' not in args:
+        args.append("--standalone")
+    if options.template is not None:
+        args.append(f"--template={options.template}")
+    if options.toc:
+        args.append("--table-of-contents")
+    if options.toc_depth is not None:
+        args.append(f"--toc-depth={options.toc_depth}")
+    if options.number_sections:
+        args.append("--number-sections")
+    args.extend(f"--metadata={key}:{value}" for key, value in options.metadata)
+    for path in options.filters:
+        args.append(f"--lua-filter={path}" if path.endswith('.lua') else f"--filter={path}")
+    return tuple(args)
@@ -0,0 +1,48 @@
+import logging
+import weakref
+from typing import Any, Callable, Optional
+
+from aiohttp import web
+from aiohttp.abc import AbstractStreamWriter
+
+from . import tracing
+from .metrics import SENT_BYTES, timed
+from .utils import clean_up_result
+
+logger = logging.getLogger('asyncio')
+
+
+class FileResponse(web.FileResponse):
+    """
+    File response recording the time spent sending it and the bytes sent.
+
+    The file is sent with sendfile where the platform supports it. With
+    `delete` set it is removed as soon as the transfer finished or the client
+    went away, or when the response is dropped without ever being sent, by
+    `release` which can keep a file shared with other responses.
+    """
+
+    def __init__(self, path: str, *args: Any, labels: Optional[dict] = None,
+                 delete: bool = False, release: Callable[[str], None] = clean_up_result, **kwargs: Any) -> None:
+        super().__init__(path, *args, **kwargs)
+        self._labels = labels or {}
+        # sent after the handler returned, outside of the request's trace
+        self._trace = tracing.context()
+        self._finalizer = weakref.finalize(self, release, str(path)) if delete else None
+        self._counted = False
+
+    async def prepare(self, request: web.BaseRequest) -> Optional[AbstractStreamWriter]:
+        try:
+            with tracing.traced(self._trace), timed('send', **self._labels):
+                writer = await super().prepare(request)
+        finally:
+            if self._finalizer is not None:
+                self._finalizer()
+        return writer
+
+    async def write_eof(self, data: bytes = b'') -> None:
+        await super().write_eof(data)
+        if not self._counted:
+            self._counted = True
+            # compressed responses are counted as written, their length is only known by now
+            SENT_BYTES.inc(self.body_length if self.compression else self.content_length or 0, **self._labels)
@@ -12,6 +12,12 @@ def init_routes(app: web.Application, handler: SiteHandler) -> None:
 
     add_route('GET', '/', handler.index, name='index')
     add_route('POST', '/convert', handler.convert, name='convert')
+    add_route('POST', '/batch', handler.batch, name='batch')
+    add_route('POST', '/jobs', handler.submit_job, name='jobs')
+    add_route('GET', '/jobs/{job_id}', handler.job, name='job')
+    add_route('GET', '/jobs/{job_id}/result', handler.job_result, name='job_result')
+    add_route('GET', '/stats', handler.stats, name='stats')
+    add_route('GET', '/metrics', handler.metrics, name='metrics')
 
     # added static dir
     app.router.add_static(
@@ -1,23 +1,141 @@
+import base64
+import hashlib
+import http.client
+import json
 import logging
+import os
 import pathlib
 import re
+import shlex
 import shutil
+import socket
+import subprocess
 import tarfile
+import time
 import zipfile
 from pathlib import Path
-from typing import Union, IO, Any
+from typing import Union, IO, Any, FrozenSet, Iterable, Iterator, NamedTuple, Optional, Tuple
 
 import pypandoc
 
+from . import limits, tracing
+from .compression import BlockWriter, CODECS, CompressionError, ZipWriter
+from .metrics import timed
+from .options import ConversionOptions, build_args
+
 logger = logging.getLogger('asyncio')
 
-__FORMATS = pypandoc.get_pandoc_formats()
+FORMATS_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'pandocserver'
+
+
+class PandocFormats(NamedTuple):
+    input: FrozenSet[str]
+    output: FrozenSet[str]
+    version: str
+
+    @property
+    def all(self) -> FrozenSet[str]:
+        return self.input | self.output
+
 
-PANDOC_SERVICE_INPUT_FORMATS = frozenset(__FORMATS[0])
+_formats = None  # type: Optional[PandocFormats]
 
-PANDOC_SERVICE_OUTPUT_FORMATS = frozenset(['pdf'] + __FORMATS[1])
 
-PANDOC_SERVICE_FORMATS = frozenset(PANDOC_SERVICE_INPUT_FORMATS | PANDOC_SERVICE_OUTPUT_FORMATS)
+def _pandoc_binary() -> Optional[Path]:
+    path = os.environ.get('PYPANDOC_PANDOC') or shutil.which('pandoc')
+    return Path(path).resolve() if path else None
+
+
+def discover_formats(cache_dir: Union[str, Path] = FORMATS_CACHE_DIR) -> PandocFormats:
+    """
+    Probes pandoc for its formats and version.
+
+    The result is cached on disk keyed by the pandoc binary path, mtime and
+    size, so pandoc is only probed again after it has been replaced.
+    """
+    start = time.monotonic()
+    binary = _pandoc_binary()
+    cache_file = None
+    if binary is not None:
+        st = binary.stat()
+        key = hashlib.sha256(f"{binary}:{st.st_mtime_ns}:{st.st_size}".encode('utf-8')).hexdigest()
+        cache_file = Path(cache_dir) / f"formats-{key}.json"
+        try:
+            data = json.loads(cache_file.read_text())
+            formats = PandocFormats(frozenset(data['input']), frozenset(data['output']), data['version'])
+        except (OSError, ValueError, KeyError):
+            pass
+        else:
+            logger.info(f"Loaded pandoc {formats.version} formats from cache in {time.monotonic() - start:.3f}s")
+            return formats
+
+    input_formats, output_formats = pypandoc.get_pandoc_formats()
+    formats = PandocFormats(frozenset(input_formats), frozenset(['pdf'] + output_formats),
+                            pypandoc.get_pandoc_version())
+    logger.info(f"Probed pandoc {formats.version} formats in {time.monotonic() - start:.3f}s")
+
+    if cache_file is not None:
+        try:
+            cache_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+            tmp_file.write_text(json.dumps({
+                'input': sorted(formats.input), 'output': sorted(formats.output), 'version': formats.version
+            }))
+            os.replace(str(tmp_file), str(cache_file))
+        except OSError as err:
+            logger.warning(f"Unable to cache pandoc formats, reason: {err}")
+    return formats
+
+
+def get_formats() -> PandocFormats:
+    """Returns the pandoc formats, discovering them on first use."""
+    global _formats
+    if _formats is None:
+        _formats = discover_formats()
+    return _formats
+
+
+def set_formats(formats: PandocFormats) -> None:
+    """Uses formats discovered elsewhere, e.g. handed to a worker by its parent."""
+    global _formats
+    _formats = formats
+
+
+def __getattr__(name: str) -> FrozenSet[str]:
+    # keeps the former import time constants available, computed lazily
+    if name == 'PANDOC_SERVICE_INPUT_FORMATS':
+        return get_formats().input
+    if name == 'PANDOC_SERVICE_OUTPUT_FORMATS':
+        return get_formats().output
+    if name == 'PANDOC_SERVICE_FORMATS':
+        return get_formats().all
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+ARCHIVE_COMPRESSIONS = {
+    '.tar': 'tar',
+    # gz
+    '.gz': 'gz',
+    '.tgz': 'gz',
+    # xz
+    '.xz': 'xz',
+    '.txz': 'xz',
+    # bz2
+    '.bz2': 'bz2',
+    '.tbz': 'bz2',
+    '.tbz2': 'bz2',
+    '.tb2': 'bz2',
+    #zip
+    '.zip': 'zip'
+}
+
+# output formats pandoc writes as binary files
+BINARY_FORMATS = frozenset(['pdf', 'docx', 'odt', 'epub', 'epub2', 'epub3', 'pptx'])
+
+
+def is_archive(filepath: Union[str, Path]) -> bool:
+    suffixes = Path(filepath).suffixes
+    return bool(suffixes) and suffixes[-1] in ARCHIVE_COMPRESSIONS
 
 
 class ExtractArchiveError(Exception):
@@ -34,23 +152,7 @@ def extract_archive(filepath: Union[str, Path]) -> Path:
     suffixes = Path(archive.resolve()).suffixes
     ext = "".join(suffixes)
 
-    compressions = {
-        '.tar': 'tar',
-        # gz
-        '.gz': 'gz',
-        '.tgz': 'gz',
-        # xz
-        '.xz': 'xz',
-        '.txz': 'xz',
-        # bz2
-        '.bz2': 'bz2',
-        '.tbz': 'bz2',
-        '.tbz2': 'bz2',
-        '.tb2': 'bz2',
-        #zip
-        '.zip': 'zip'
-    }
-    if suffixes[-1] not in compressions:
+    if not is_archive(archive.resolve()):
         raise NotAnArchiveError("Not an archive")
 
     stem = re.sub(f"{ext}$", "", archive.name)
@@ -59,13 +161,14 @@ def extract_archive(filepath: Union[str, Path]) -> Path:
     Path(out_path.resolve()).mkdir(mode=0o700, exist_ok=False)
 
     try:
-        if archive.exists() and archive.is_file():
-            if tarfile.is_tarfile(archive.resolve()):
-                with tarfile.open(fileobj=archive.open(mode='rb'), mode='r:*') as tar_obj:
-                    tar_obj.extractall(path=out_path.resolve())
-            elif zipfile.is_zipfile(archive.resolve()):
-                with zipfile.ZipFile(file=archive.resolve(), mode='r') as zip_obj:
-                    zip_obj.extractall(path=out_path.resolve())
+        with timed('extract'):
+            if archive.exists() and archive.is_file():
+                if tarfile.is_tarfile(archive.resolve()):
+                    with tarfile.open(fileobj=archive.open(mode='rb'), mode='r:*') as tar_obj:
+                        tar_obj.extractall(path=out_path.resolve())
+                elif zipfile.is_zipfile(archive.resolve()):
+                    with zipfile.ZipFile(file=archive.resolve(), mode='r') as zip_obj:
+                        zip_obj.extractall(path=out_path.resolve())
     except OSError as err:
         raise ExtractArchiveError(f"Unable to extract archive, reason: {err}")
     except tarfile.TarError as err:
@@ -77,37 +180,146 @@ def extract_archive(filepath: Union[str, Path]) -> Path:
         return out_path
 
 
+def _is_document(name: str) -> bool:
+    # documents sit in the top level dir of an archive, e.g. `docs/index.md`
+    parts = Path(name).parts
+    return len(parts) == 2 and '.' in parts[1] and not parts[1].startswith('.')
+
+
+def archive_members(filepath: Union[str, Path]) -> Iterator[Tuple[str, IO[bytes]]]:
+    """
+    Yields the documents in an archive one at a time, as name and file object.
+
+    Tar archives are read as a stream, so every file object has to be consumed
+    before asking for the next member.
+    """
+    archive = Path(filepath)
+    if not is_archive(archive.resolve()):
+        raise NotAnArchiveError("Not an archive")
+
+    try:
+        if tarfile.is_tarfile(str(archive.resolve())):
+            with tarfile.open(str(archive.resolve()), mode='r|*') as tar_obj:
+                for member in tar_obj:
+                    if member.isfile() and _is_document(member.name):
+                        yield member.name, tar_obj.extractfile(member)
+        elif zipfile.is_zipfile(str(archive.resolve())):
+            with zipfile.ZipFile(file=str(archive.resolve()), mode='r') as zip_obj:
+                for info in zip_obj.infolist():
+                    if not info.is_dir() and _is_document(info.filename):
+                        with zip_obj.open(info) as fobj:
+                            yield info.filename, fobj
+        else:
+            raise ExtractArchiveError(f"Unable to read archive '{archive.name}'")
+    except OSError as err:
+        raise ExtractArchiveError(f"Unable to extract archive, reason: {err}")
+    except tarfile.TarError as err:
+        raise ExtractArchiveError(f"Unable to extract tar archive, reason: {err}")
+    except (zipfile.BadZipFile, zipfile.LargeZipFile) as err:
+        raise ExtractArchiveError(f"Unable to extract zip archive, reason: {err}")
+
+
 class CreateArchiveError(Exception):
     pass
 
 
-def create_archive(filepath: Union[str, Path], compression: str) -> Path:
+def _archive_kind(compression: str) -> str:
+    kind = ARCHIVE_COMPRESSIONS.get(compression)
+    if kind is None:
+        raise CreateArchiveError(f"Invalid compression type: '{compression}'")
+    return kind
+
+
+# the codecs archives named by these compressions are written with by default
+KIND_CODECS = {'tar': 'store', 'gz': 'gzip', 'xz': 'xz', 'bz2': 'bzip2', 'zip': 'gzip'}
+
+
+def archive_path(filepath: Union[str, Path], compression: str, codec: Optional[str] = None) -> Path:
+    """
+    Returns the archive for `filepath` with the given compression suffix, e.g. `.gz` -> `.tar.gz`.
+
+    A `codec` replaces the compression of tar archives, zip archives keep their suffix.
+    """
+    kind = _archive_kind(compression)
+    if kind == 'zip':
+        return Path(str(filepath) + '.zip')
+    codec = codec or KIND_CODECS[kind]
+    if codec not in CODECS:
+        raise CreateArchiveError(f"Invalid compression: '{codec}'")
+    return Path(str(filepath) + '.tar' + CODECS[codec].suffix)
+
+
+class ArchiveWriter(object):
+    """
+    Writes an archive member by member.
+
+    Tar archives are written as a stream, compressed in blocks on the
+    compression threads, so members are never read back and can be removed
+    as soon as they have been added. Zip entries are compressed on the
+    compression threads while the next ones are added.
+    """
+
+    def __init__(self, filepath: Union[str, Path], compression: str, codec: Optional[str] = None) -> None:
+        kind = _archive_kind(compression)
+        self.filepath = Path(filepath)
+        self._zip_obj = None  # type: Optional[ZipWriter]
+        self._tar_obj = None  # type: Optional[tarfile.TarFile]
+        self._stream = None  # type: Optional[BlockWriter]
+        self._fobj = None  # type: Optional[IO[bytes]]
+        try:
+            if kind == 'zip':
+                self._zip_obj = ZipWriter(self.filepath, codec or KIND_CODECS[kind])
+            else:
+                self._fobj = self.filepath.open('wb')
+                self._stream = BlockWriter(self._fobj, codec or KIND_CODECS[kind])
+                self._tar_obj = tarfile.open(fileobj=self._stream, mode='w|')  # type: ignore
+        except (OSError, ValueError, tarfile.TarError, CompressionError) as err:
+            if self._fobj is not None:
+                self._fobj.close()
+            raise CreateArchiveError(f"Unable to create archive, reason: {err}")
+
+    def add(self, filepath: Union[str, Path], arcname: str, remove: bool = False) -> None:
+        """Adds a file, removed once it was added when `remove` is set."""
+        try:
+            if self._zip_obj is not None:
+                self._zip_obj.add(filepath, arcname=arcname, remove=remove)
+            else:
+                self._tar_obj.add(name=str(filepath), arcname=arcname, recursive=False)
+                if remove:
+                    os.unlink(str(filepath))
+        except (OSError, ValueError, tarfile.TarError, zipfile.LargeZipFile) as err:
+            raise CreateArchiveError(f"Unable to add '{arcname}' to archive, reason: {err}")
+
+    def close(self) -> None:
+        try:
+            for obj in (self._zip_obj, self._tar_obj, self._stream):
+                if obj is not None:
+                    obj.close()
+        except (OSError, ValueError, tarfile.TarError) as err:
+            raise CreateArchiveError(f"Unable to create archive, reason: {err}")
+        finally:
+            if self._fobj is not None:
+                self._fobj.close()
+
+    def __enter__(self) -> 'ArchiveWriter':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+def create_archive(filepath: Union[str, Path], compression: str, codec: Optional[str] = None) -> Path:
     dir_to_archive = Path(filepath)
 
     if not dir_to_archive.is_dir():
         raise OSError(f"Not a directory: '{dir_to_archive.resolve()}'")
 
     try:
-        if compression == '.zip':
-            archive = Path(str(dir_to_archive.resolve()) + ".zip")
-            with zipfile.ZipFile(file=archive.open(mode='wb+'), mode='w') as zip_obj:
-                zip_obj.write(filename=dir_to_archive.resolve(), arcname=dir_to_archive.name)
-
-        elif compression == '.tar' or compression in ('.gz', '.xz', '.bz2'):
-            tar_mode = "w"
-            archive = Path(str(dir_to_archive.resolve()) + ".tar")
-            if compression in ('.gz', '.xz', '.bz2'):
-                archive = Path(str(dir_to_archive.resolve()) + f".tar{compression}")
-                tar_mode = f'w:{compression[1:]}'
-
-            with tarfile.open(fileobj=archive.open(mode='wb+'), mode=tar_mode) as tar_obj:
-                tar_obj.add(name=dir_to_archive.resolve(), arcname=dir_to_archive.name)
-        else:
-            raise CreateArchiveError(f"Invalid compression type: '{compression}'")
-
-    except (OSError, ValueError, zipfile.LargeZipFile) as err:
-        raise CreateArchiveError(f"Unable to create archive, reason: {err}")
-    else:
+        archive = archive_path(dir_to_archive.resolve(), compression, codec)
+        with timed('archive'), ArchiveWriter(archive, compression, codec) as writer:
+            for path in sorted(dir_to_archive.resolve().rglob('*')):
+                if path.is_file():
+                    writer.add(path, arcname=f"{dir_to_archive.name}/{path.relative_to(dir_to_archive.resolve())}")
         logger.debug(f"Created achive {archive.resolve()}")
         return archive
     finally:
@@ -115,27 +327,235 @@ def create_archive(filepath: Union[str, Path], compression: str) -> Path:
         logger.info(f"Cleaned up archived dir {dir_to_archive.resolve()}")
 
 
+class EngineUnavailableError(Exception):
+    pass
+
+
+class PandocServerEngine(object):
+    """
+    Long-lived pandoc server (`pandoc server` / `pandoc-server`) fed over its JSON API.
+
+    One engine is started per worker process, conversions it can not handle
+    (pdf, or arguments the API does not know) are left to the subprocess path.
+    """
+
+    # arguments which only affect logging or pdf generation
+    IGNORED_ARGUMENTS = frozenset(['log', 'verbose', 'quiet', 'fail-if-warnings', 'pdf-engine', 'pdf-engine-opt'])
+
+    ARGUMENTS = frozenset([
+        'standalone', 'strip-comments', 'table-of-contents', 'toc-depth', 'number-sections',
+        'shift-heading-level-by', 'tab-stop', 'wrap', 'columns', 'reference-links', 'reference-location',
+        'top-level-division', 'identifier-prefix', 'email-obfuscation', 'html-q-tags', 'markdown-headings',
+        'section-divs', 'html-math-method', 'highlight-style', 'track-changes', 'default-image-extension',
+        'citeproc', 'ascii', 'dpi',
+    ])
+
+    ARGUMENT_ALIASES = {'toc': 'table-of-contents'}
+
+    def __init__(self, command: str = 'pandoc server', host: str = '127.0.0.1',
+                 timeout: float = 120.0, startup_timeout: float = 10.0) -> None:
+        self.command = shlex.split(command)
+        self.host = host
+        self.port = None
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+        self._process = None
+        self._connection = None
+
+    @staticmethod
+    def _free_port(host: str) -> int:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind((host, 0))
+            return sock.getsockname()[1]
+
+    def start(self) -> None:
+        self.stop()
+        self.port = self._free_port(self.host)
+        try:
+            self._process = subprocess.Popen(
+                self.command + [f'--port={self.port}', f'--timeout={int(self.timeout)}'],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL
+            )
+        except OSError as err:
+            raise EngineUnavailableError(f"Unable to start pandoc server, reason: {err}")
+
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise EngineUnavailableError(f"Pandoc server exited with code {self._process.returncode}")
+            try:
+                socket.create_connection((self.host, self.port), timeout=0.5).close()
+            except OSError:
+                time.sleep(0.05)
+            else:
+                logger.info(f"Started pandoc server on port {self.port}")
+                return
+        self.stop()
+        raise EngineUnavailableError("Pandoc server did not start in time")
+
+    def stop(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self._process is not None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+            self._process = None
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    @classmethod
+    def _parse_arguments(cls, extra_args: Iterable[str]) -> Optional[dict]:
+        """Maps pandoc cli arguments onto API parameters, None when the API can not express them."""
+        params = {}
+        for arg in extra_args:
+            name, _, value = arg.lstrip('-').partition('=')
+            name = cls.ARGUMENT_ALIASES.get(name, name)
+            if name in cls.IGNORED_ARGUMENTS:
+                continue
+            if name not in cls.ARGUMENTS:
+                return None
+            if not value:
+                params[name] = True
+            elif value.isdigit():
+                params[name] = int(value)
+            else:
+                params[name] = value
+        return params
+
+    def supports(self, to_format: str, extra_args: Iterable[str]) -> bool:
+        return to_format != 'pdf' and self._parse_arguments(extra_args) is not None
+
+    def _request(self, payload: dict) -> Tuple[int, bytes]:
+        if not self.running:
+            self.start()
+        if self._connection is None:
+            self._connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+        body = json.dumps(payload)
+        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+        try:
+            self._connection.request('POST', '/', body=body, headers=headers)
+            response = self._connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException) as err:
+            self.stop()
+            raise EngineUnavailableError(f"Pandoc server request failed, reason: {err}")
+
+    def convert(self, source_file: Union[str, Path, bytes], to: str, format: str, extra_args: Iterable[str],
+                outputfile: Optional[str] = None, **kwargs: Any) -> Union[str, bytes]:
+        """Converts a file, or a document given as bytes."""
+        source = source_file if isinstance(source_file, bytes) else Path(source_file).read_bytes()
+        if format in BINARY_FORMATS:
+            text = base64.b64encode(source).decode('ascii')
+        else:
+            text = source.decode('utf-8')
+
+        payload = dict(self._parse_arguments(extra_args), text=text, to=to)
+        if format is not None:
+            payload['from'] = format
+
+        status, body = self._request(payload)
+        if status != 200:
+            raise RuntimeError(f'Pandoc server failed during conversion: {body.decode("utf-8", "replace")}')
+
+        result = json.loads(body.decode('utf-8'))
+        output = result['output']
+        output = base64.b64decode(output) if result.get('base64') else output
+        if outputfile is None:
+            return output
+        mode = 'wb' if isinstance(output, bytes) else 'w'
+        with open(outputfile, mode) as fobj:
+            fobj.write(output)
+        return ''
+
+
+class PandocProcess(object):
+    """
+    Stand-in for pypandoc's `convert_file` and `convert_text` running pandoc with the conversion's limits.
+
+    Pandoc is found the way pypandoc finds it, the child gets the resource
+    limits of `limits` and is killed when the conversion's deadline passes.
+    """
+
+    @staticmethod
+    def _run(args: list, to: str, format: Optional[str], extra_args: Iterable[str], encoding: str,
+             outputfile: Optional[str], filters: Optional[Iterable[str]], source: Optional[bytes] = None) -> str:
+        args.insert(1, f'--to={to}')
+        if format:
+            args.insert(1, f'--from={format}')
+        if outputfile:
+            args.append(f'--output={outputfile}')
+        args.extend(extra_args)
+        args.extend(f'--filter={name}' for name in filters or ())
+
+        process = limits.run(args, input=source, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise RuntimeError(f'Pandoc died with exitcode "{process.returncode}" during conversion: '
+                               f'{process.stderr.decode(encoding, "replace")}')
+        try:
+            return process.stdout.decode('utf-8')
+        except UnicodeDecodeError:
+            raise RuntimeError('Pandoc output was not utf-8.')
+
+    @classmethod
+    def convert_file(cls, source_file: Union[str, Path], to: str, format: Optional[str] = None,
+                     extra_args: Iterable[str] = (), encoding: str = 'utf-8', outputfile: Optional[str] = None,
+                     filters: Optional[Iterable[str]] = None) -> str:
+        return cls._run([pypandoc.get_pandoc_path(), str(source_file)], to, format, extra_args, encoding,
+                        outputfile, filters)
+
+    @classmethod
+    def convert_text(cls, source: bytes, to: str, format: Optional[str] = None,
+                     extra_args: Iterable[str] = (), encoding: str = 'utf-8', outputfile: Optional[str] = None,
+                     filters: Optional[Iterable[str]] = None) -> str:
+        """Converts a document given as bytes, piped to pandoc's stdin."""
+        return cls._run([pypandoc.get_pandoc_path()], to, format, extra_args, encoding, outputfile, filters,
+                        source=source)
+
+
+def without_filters(args: Iterable[str]) -> Tuple[str, ...]:
+    """Returns pandoc arguments without the `--filter`s and `--lua-filter`s."""
+    return tuple(arg for arg in args if not arg.startswith(('--filter=', '--lua-filter=')))
+
+
 class PandocService(object):
     """
     Base class for converting provided HTML to a doc or docx
     """
 
-    def __init__(self, **kwargs: dict):
+    def __init__(self, engine: Optional[PandocServerEngine] = None, latex_engine: Optional[Any] = None,
+                 **kwargs: dict):
         self.service = self.get_service()
+        self.engine = engine
+        # a started `latex.LatexEngine` compiling pdf outputs
+        self.latex_engine = latex_engine
+        # a loaded `filters.FilterPipeline` run on every conversion
+        self.filter_pipeline = None  # type: Optional[Any]
+        # set while parsing the JSON AST shared by several formats, their writers run the filters for each
+        self.unfiltered = False
         self._register_formats()
         self._source = None
         self._out_file = None
         self._from_format = None
+        self._options = None  # type: Optional[ConversionOptions]
         self._extra_args(**kwargs)
 
     def _extra_args(self, **kwargs):
-        self.extra_args = []
+        # the configured arguments, every conversion writes a standalone document
+        self._base_args = ('--standalone',)  # type: Tuple[str, ...]
+        self.extra_args = self._base_args
 
         def parse_arg(arg, value):
             argument = None
             if type(value) == bool and value is True:
                 argument = f"{arg}"
-            elif type(value) != bool:
+            elif type(value) != bool and value is not None:
                 argument = f"{arg}={value}"
             if argument is not None:
                 self.add_argument(argument)
@@ -147,56 +567,146 @@ class PandocService(object):
         for k, v in kwargs.items():
             parse_arg(k, v)
 
+    _registered_formats = None  # type: Optional[FrozenSet[str]]
+
     @classmethod
     def _register_formats(cls) -> None:
-        """Adds format properties."""
-        for fmt in PANDOC_SERVICE_FORMATS:
+        """Adds format properties, once per set of formats."""
+        formats = get_formats().all
+        if cls._registered_formats == formats:
+            return
+        cls._registered_formats = formats
+        for fmt in formats:
             clean_fmt = fmt.replace('+', '_')
             setattr(cls, clean_fmt, property(
                 (lambda x, fmt=fmt: cls._output(x, fmt)),  # fget
                 (lambda x, y, fmt=fmt: cls._input(x, y, fmt))))  # fset
 
-    def _input(self, source: IO[Any], from_format=None) -> None:
-        if from_format not in PANDOC_SERVICE_INPUT_FORMATS:
+    def _input(self, source: Union[str, bytes], from_format=None) -> None:
+        # a file, or small documents as bytes which are piped to pandoc
+        if from_format not in get_formats().input:
             raise AttributeError(f"Not a valid input format: '{from_format}'")
         self._source = source
         self._form_format = from_format
 
     def _output(self, to_format, **kwargs) -> Union[str, pathlib.Path]:
-        if to_format not in PANDOC_SERVICE_OUTPUT_FORMATS:
+        if to_format not in get_formats().output:
             raise AttributeError(f"Not a valid output format: '{to_format}'")
 
+        latex = self.latex_engine if to_format == 'pdf' and self._out_file else None
+        if latex is not None:
+            # pandoc only writes the LaTeX, the warm engine compiles it
+            to_format = 'latex'
+
+        filters = kwargs.get('filters') or None
+        pipeline = self.filter_pipeline if not self.unfiltered else None
+        if pipeline is not None and pipeline.filters and not pipeline.in_process:
+            filters = (filters or []) + pipeline.commands
+        extra_args = self.extra_args if not self.unfiltered else without_filters(self.extra_args)
+
+        use_engine = (self.engine is not None and not filters
+                      and self.engine.supports(to_format, extra_args))
         to_format = 'latex' if to_format == 'pdf' else to_format
 
         kwargs = {
             'source_file': self._source,
             'to': to_format,
             'format': getattr(self, '_form_format', None),
-            'extra_args': self.extra_args,
+            'extra_args': extra_args,
             'encoding': 'utf-8',
-            'filters': kwargs.get('filters', None),
+            'filters': filters,
         }
 
-        if self._out_file:
+        if self._out_file and latex is None:
             kwargs["outputfile"] = str(self._out_file)
-        return self.service.convert_file(**kwargs)
+
+        if pipeline is not None and pipeline.filters and pipeline.in_process:
+            # the filtered AST is piped to pandoc
+            kwargs['source_file'], kwargs['format'] = self._run_filters(to_format), 'json'
+
+        with timed('pandoc'):
+            log = tracing.log_file('pandoc') if not use_engine else None
+            if log is not None:
+                # the request's own log instead of the configured one
+                kwargs['extra_args'] = tuple(arg for arg in extra_args
+                                             if not arg.startswith('--log=')) + (f'--log={log}',)
+            output = None
+            if use_engine:
+                try:
+                    output = self.engine.convert(**kwargs)
+                except EngineUnavailableError as err:
+                    logger.warning(f"{err}, falling back to a pandoc subprocess")
+            if output is None:
+                output = self._convert(**kwargs)
+
+        if latex is None:
+            return output
+        with timed('latex'):
+            latex.compile(output, self._out_file, resource_dir=Path(str(self._source)).parent)
+        return ''
+
+    def _convert(self, source_file: Union[str, Path, bytes], **kwargs: Any) -> str:
+        if isinstance(source_file, bytes):
+            return self.service.convert_text(source_file, **kwargs)
+        return self.service.convert_file(source_file, **kwargs)
+
+    def _run_filters(self, to_format: str) -> bytes:
+        """Reads the source into a JSON AST and runs the filter pipeline on it, returns the filtered AST."""
+        from_format = getattr(self, '_form_format', None)
+        if from_format == 'json':
+            # already an AST, e.g. the one shared by several formats
+            source = self._source if isinstance(self._source, bytes) else Path(self._source).read_bytes()
+            ast = source.decode('utf-8')
+        else:
+            with timed('pandoc'):
+                # the request's filters run on the filtered AST, by the writer
+                ast = self._convert(self._source, to='json', format=from_format,
+                                    extra_args=without_filters(self.extra_args), encoding='utf-8')
+        return self.filter_pipeline.run(ast, to_format).encode('utf-8')
 
     @property
     def out_file(self) -> Union[str, pathlib.Path]:
         return self._out_file
 
     @out_file.setter
-    def out_file(self, filepath: Union[str, pathlib.Path]) -> None:
-        if filepath.parent.is_dir():
-            self.add_argument('standalone')
+    def out_file(self, filepath: Optional[Union[str, pathlib.Path]]) -> None:
+        if filepath is None:
+            # output is returned instead of written to a file
+            self._out_file = None
+        elif filepath.parent.is_dir():
             self._out_file = filepath
         else:
             raise OSError(f"Not a valid output dir: {filepath.parent.resolve()}")
 
     @staticmethod
-    def get_service() -> pypandoc:
-        return pypandoc
+    def get_service() -> PandocProcess:
+        return PandocProcess()
 
-    def add_argument(self, arg) -> list:
-        self.extra_args.append(f"--{arg.replace('_', '-')}")
+    @property
+    def options(self) -> Optional[ConversionOptions]:
+        return self._options
+
+    @options.setter
+    def options(self, options: Optional[ConversionOptions]) -> None:
+        self.set_options(options)
+
+    def set_options(self, options: Optional[ConversionOptions], fragment: bool = False) -> None:
+        """
+        Sets the options of the next conversions, which get fresh arguments built from the configured ones.
+
+        Fragments, e.g. the snippets of a batch, are converted without
+        `--standalone` and the configured template, unless the options ask
+        for a standalone document or a template.
+        """
+        self._options = options
+        base = self._base_args
+        if fragment and (options is None or not options.standalone and options.template is None):
+            base = tuple(arg for arg in base if arg != '--standalone' and not arg.startswith('--template='))
+        self.extra_args = build_args(base, options)
+
+    def add_argument(self, arg) -> Tuple[str, ...]:
+        argument = f"--{arg.replace('_', '-')}"
+        if argument not in self._base_args:
+            self._base_args += (argument,)
+        self.extra_args = build_args(self._base_args, self._options)
         return self.extra_args
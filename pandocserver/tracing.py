@@ -0,0 +1,213 @@
+import asyncio
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+logger = logging.getLogger('asyncio')
+
+TRACE_ID = re.compile(r'^[A-Za-z0-9_.-]{8,64}$')
+
+# the trace id and the id of the innermost open span
+TraceContext = Tuple[str, Optional[str]]
+
+_path = None  # type: Optional[Path]
+_context = contextvars.ContextVar('trace', default=None)  # type: contextvars.ContextVar
+_attributes = contextvars.ContextVar('span_attributes', default=None)  # type: contextvars.ContextVar
+# spans ending on an event loop, written by a thread of the process which recorded them
+_queue = None  # type: Optional[queue.SimpleQueue]
+_writer_pid = None  # type: Optional[int]
+
+
+def configure(path: Optional[Union[str, Path]]) -> None:
+    """Sets the dir traces are written to, in every process recording spans, None disables them."""
+    global _path
+    _path = None if path is None else Path(path).expanduser()
+    if _path is not None:
+        _path.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+
+def trace_id(value: Optional[str] = None) -> str:
+    """Returns `value`, e.g. a client's request id, when it is usable as a trace id or a new one."""
+    if value and TRACE_ID.match(value):
+        return value
+    return uuid.uuid4().hex
+
+
+def context() -> Optional[TraceContext]:
+    return _context.get()
+
+
+def current_id() -> Optional[str]:
+    ctx = _context.get()
+    return None if ctx is None else ctx[0]
+
+
+@contextmanager
+def traced(ctx: Optional[TraceContext]) -> Iterator[None]:
+    """Records the spans of the block in the trace `ctx`, as children of its span."""
+    token = _context.set(ctx)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def _trace_dir(trace: str, root: Optional[Path] = None) -> Path:
+    path = (root or _path) / trace
+    path.mkdir(mode=0o700, exist_ok=True)
+    return path
+
+
+def _append(root: Path, records: List[Dict[str, Any]]) -> None:
+    traces = {}  # type: Dict[str, List[Dict[str, Any]]]
+    for record in records:
+        traces.setdefault(record['trace_id'], []).append(record)
+    for trace, spans in traces.items():
+        try:
+            with (_trace_dir(trace, root) / 'spans.jsonl').open('a', encoding='utf-8') as fobj:
+                fobj.write(''.join(json.dumps(record, default=str) + '\n' for record in spans))
+        except OSError as err:
+            logger.warning(f"Unable to write {len(spans)} span(s) of trace '{trace}', reason: {err}")
+
+
+def _write_spans(spans: queue.SimpleQueue) -> None:
+    while True:
+        items = [spans.get()]
+        while not spans.empty():
+            items.append(spans.get_nowait())
+        records = {}  # type: Dict[Path, List[Dict[str, Any]]]
+        for item in items:
+            if isinstance(item, tuple):
+                records.setdefault(item[0], []).append(item[1])
+        for root, batch in records.items():
+            _append(root, batch)
+        for item in items:
+            if isinstance(item, threading.Event):
+                item.set()
+
+
+def _enqueue(record: Dict[str, Any]) -> None:
+    global _queue, _writer_pid
+    if _writer_pid != os.getpid():
+        # a thread per process, the one of a forked parent is not running here
+        _queue = queue.SimpleQueue()
+        _writer_pid = os.getpid()
+        threading.Thread(target=_write_spans, args=(_queue,), name='span-writer', daemon=True).start()
+        atexit.register(flush, 5.0)
+    _queue.put((_path, record))
+
+
+def flush(timeout: Optional[float] = None) -> bool:
+    """Waits until the spans handed to the writer thread are written, returns False on a timeout."""
+    if _queue is None or _writer_pid != os.getpid():
+        return True
+    written = threading.Event()
+    _queue.put(written)
+    return written.wait(timeout)
+
+
+def _on_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Records the block as a span of the current trace.
+
+    Spans are appended as JSON lines to `spans.jsonl` in the trace's dir once
+    they end, by whichever process recorded them. Spans ending on an event
+    loop are written by a thread in batches, so the loop never waits on the
+    disk. The attributes yielded can be added to until then.
+    """
+    ctx = _context.get()
+    if _path is None or ctx is None:
+        yield attributes
+        return
+
+    trace, parent = ctx
+    span_id = uuid.uuid4().hex[:16]
+    token = _context.set((trace, span_id))
+    attributes_token = _attributes.set(attributes)
+    start = time.time()
+    error = None
+    try:
+        yield attributes
+    except BaseException as err:
+        error = repr(err)
+        raise
+    finally:
+        end = time.time()
+        _attributes.reset(attributes_token)
+        _context.reset(token)
+        record = {
+            'trace_id': trace,
+            'span_id': span_id,
+            'parent_id': parent,
+            'name': name,
+            'start': start,
+            'end': end,
+            'duration': round(end - start, 6),
+            'pid': os.getpid(),
+            'attributes': attributes,
+        }
+        if error is not None:
+            record['error'] = error
+        if _on_loop():
+            _enqueue(record)
+        else:
+            _append(_path, [record])
+
+
+def log_file(name: str) -> Optional[Path]:
+    """Returns a file for the current span to log to, e.g. pandoc's `--log`, attached to the span."""
+    ctx = _context.get()
+    attributes = _attributes.get()
+    if _path is None or ctx is None or attributes is None:
+        return None
+    path = _trace_dir(ctx[0]) / f'{name}-{ctx[1]}.json'
+    attributes['log'] = str(path)
+    return path
+
+
+def remove_expired(ttl: float) -> int:
+    """Removes the traces older than `ttl` seconds, returns how many."""
+    if _path is None:
+        return 0
+    expired = time.time() - ttl
+    removed = 0
+    for path in _path.iterdir():
+        try:
+            if path.is_dir() and path.stat().st_mtime < expired:
+                shutil.rmtree(str(path), ignore_errors=True)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def install_log_records() -> None:
+    """Adds the current trace id to every log record as `trace_id`, for the log format."""
+    factory = logging.getLogRecordFactory()
+
+    def record_factory(*args: Any, **kwargs: Any) -> logging.LogRecord:
+        record = factory(*args, **kwargs)
+        record.trace_id = current_id() or '-'
+        return record
+
+    logging.setLogRecordFactory(record_factory)
@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import logging
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+
+from aiohttp import web
+from aiohttp.multipart import BodyPartReader
+
+from .options import ConversionOptions
+from .tracing import TraceContext
+
+logger = logging.getLogger('asyncio')
+
+
+async def spool(field: BodyPartReader,
+                fobj: BinaryIO,
+                chunk_size: int,
+                max_size: Optional[int] = None,
+                queue_size: int = 8) -> Tuple[int, str]:
+    """
+    Writes a multipart field to a file without blocking the event loop.
+
+    Chunks are read on the loop and handed through a bounded queue to a writer
+    which writes and hashes them in the default thread pool, so a slow disk
+    only applies backpressure to this upload. Returns the size and the sha256
+    hex digest of the written data, raises a 413 once `max_size` is exceeded.
+    """
+    loop = asyncio.get_event_loop()
+    digest = hashlib.sha256()
+    queue = asyncio.Queue(maxsize=queue_size)  # type: asyncio.Queue
+
+    def write(chunk: bytes) -> None:
+        fobj.write(chunk)
+        digest.update(chunk)
+
+    async def writer() -> None:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            await loop.run_in_executor(None, write, chunk)
+
+    writer_task = asyncio.ensure_future(writer())
+
+    async def put(chunk: Optional[bytes]) -> None:
+        put_task = asyncio.ensure_future(queue.put(chunk))
+        await asyncio.wait([writer_task, put_task], return_when=asyncio.FIRST_COMPLETED)
+        if not put_task.done():
+            # the writer only stops before the end of the upload when a write failed
+            put_task.cancel()
+            writer_task.result()
+
+    size = 0
+    try:
+        while True:
+            chunk = await field.read_chunk(size=chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                logger.warning(f"Rejected upload '{field.filename}', larger than {max_size} bytes")
+                raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=size)
+
+            await put(chunk)
+
+        await put(None)
+        await writer_task
+    except BaseException:
+        writer_task.cancel()
+        raise
+
+    await loop.run_in_executor(None, fobj.flush)
+    return size, digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class Upload:
+    """A spooled upload, or a small one kept in memory, together with the conversion requested for it."""
+    filename: str
+    path: str
+    size: int
+    digest: str
+    from_format: str
+    to_format: str
+    options: ConversionOptions = ConversionOptions()
+    # who requested the conversion, for fair scheduling
+    client: str = ''
+    # the trace of the request, the conversion's spans are recorded in
+    trace: Optional[TraceContext] = None
+    # the upload itself when it was kept in memory, `path` is empty then
+    content: Optional[bytes] = None
+
+    @property
+    def source(self) -> Union[str, bytes]:
+        return self.path if self.content is None else self.content
+
+    @property
+    def to_formats(self) -> List[str]:
+        # several formats can be requested at once, comma separated
+        return self.to_format.split(',')
+
+    @property
+    def ext(self) -> str:
+        return "".join(Path(self.filename).suffixes)
+
+    @property
+    def labels(self) -> Dict[str, str]:
+        return {'from_format': self.from_format, 'to_format': self.to_format}
+
+    @property
+    def input_filename(self) -> str:
+        return re.sub(f"{re.escape(self.ext)}$", "", self.filename)
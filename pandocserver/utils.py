@@ -1,15 +1,19 @@
 import asyncio
 import click
 import logging
-from typing import Any, Dict, Union
-from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional, Union
 from dataclasses import dataclass, field
 from aiohttp import web
 import trafaret_config
 import trafaret as t
 from pathlib import Path
 import os
-from .worker import warm, clean
+from .admission import AdmissionController, CHEAP, EXPENSIVE
+from .cache import ResultCache
+from .executors import Executor, LocalExecutor, RemoteExecutor
+from . import tracing
+from .limits import ResourceLimits
+from .worker import DEFAULT_TEMP_DIR
 
 logger = logging.getLogger('asyncio')
 
@@ -23,7 +27,27 @@ CONFIG_TRAFARET = t.Dict({
         t.Key('port'): t.Int[0: 2 ** 16]
     }),
     t.Key('workers'): t.Dict({
-        t.Key('max_workers'): t.Int[1:1024]
+        t.Key('max_workers'): t.Int[1:1024],
+        t.Key('fan_out', optional=True): t.Bool,
+        t.Key('fan_out_limit', optional=True): t.Int[1:1024],
+        t.Key('engine', optional=True): t.Enum('subprocess', 'server'),
+        t.Key('engine_command', optional=True): t.String(),
+        t.Key('max_in_flight', optional=True): t.Int[1:],
+        t.Key('max_queued', optional=True): t.Int[0:],
+        t.Key('inline_max_size', optional=True): t.Int[0:],
+        t.Key('nodes', optional=True): t.List(t.URL),
+        t.Key('health_interval', optional=True): t.Float(gt=0),
+        t.Key('node_secret', optional=True): t.String(min_length=16),
+        t.Key('timeout', optional=True): t.Float(gt=0),
+        t.Key('child_max_memory', optional=True): t.Int[1:],
+        t.Key('child_max_cpu', optional=True): t.Int[1:],
+        t.Key('recycle_after', optional=True): t.Int[1:],
+        t.Key('recycle_max_rss', optional=True): t.Int[1:],
+        t.Key('compression_threads', optional=True): t.Int[1:1024],
+        t.Key('min_workers', optional=True): t.Int[1:1024],
+        t.Key('scale_up_wait', optional=True): t.Float(gte=0),
+        t.Key('scale_down_after', optional=True): t.Float(gte=0),
+        t.Key('scale_interval', optional=True): t.Float(gt=0)
     }),
     t.Key('document'): t.Dict({
         t.Key('log', optional=True): t.String,
@@ -32,6 +56,52 @@ CONFIG_TRAFARET = t.Dict({
         t.Key('fail_if_warnings', optional=True): t.Bool,
         t.Key('extra_args', optional=True): t.Dict({}).allow_extra('*')
     }),
+    t.Key('uploads', optional=True): t.Dict({
+        t.Key('chunk_size', optional=True): t.Int[1024:],
+        t.Key('max_size', optional=True): t.Int[1:],
+        t.Key('queue_size', optional=True): t.Int[1:1024]
+    }),
+    t.Key('jobs', optional=True): t.Dict({
+        t.Key('concurrency', optional=True): t.Int[1:1024],
+        t.Key('max_queued', optional=True): t.Int[1:],
+        t.Key('ttl', optional=True): t.Int[1:]
+    }),
+    t.Key('cache', optional=True): t.Dict({
+        t.Key('path'): t.String(),
+        t.Key('max_size', optional=True): t.Int[0:]
+    }),
+    t.Key('options', optional=True): t.Dict({
+        t.Key('templates', optional=True): t.Mapping(t.String, t.String),
+        t.Key('filters', optional=True): t.Mapping(t.String, t.String)
+    }),
+    t.Key('filters', optional=True): t.Dict({
+        t.Key('python', optional=True): t.List(t.String),
+        t.Key('in_process', optional=True): t.Bool
+    }),
+    t.Key('pdf', optional=True): t.Dict({
+        t.Key('engine', optional=True): t.Enum('xelatex', 'pdflatex', 'lualatex'),
+        t.Key('cache_dir', optional=True): t.String(),
+        t.Key('dump_preamble', optional=True): t.Bool,
+        t.Key('max_formats', optional=True): t.Int[0:]
+    }),
+    t.Key('traces', optional=True): t.Dict({
+        t.Key('path'): t.String(),
+        t.Key('ttl', optional=True): t.Int[1:]
+    }),
+    t.Key('batch', optional=True): t.Dict({
+        t.Key('max_size', optional=True): t.Int[1:],
+        t.Key('max_items', optional=True): t.Int[1:],
+        t.Key('max_item_size', optional=True): t.Int[1:],
+        t.Key('chunk_size', optional=True): t.Int[1:10000]
+    }),
+    t.Key('scheduling', optional=True): t.Dict({
+        t.Key('client_header', optional=True): t.String(),
+        t.Key('expensive_formats', optional=True): t.List(t.String),
+        t.Key('cheap_max_size', optional=True): t.Int[0:],
+        t.Key('reserved_workers', optional=True): t.Int[0:],
+        t.Key('cheap_weight', optional=True): t.Int[1:],
+        t.Key('expensive_weight', optional=True): t.Int[1:]
+    }),
 })
 
 
@@ -64,6 +134,27 @@ class AppConfig:
 @dataclass(frozen=True)
 class WorkersConfig:
     max_workers: int
+    fan_out: bool = False
+    fan_out_limit: int = None
+    engine: str = 'subprocess'
+    engine_command: str = None
+    max_in_flight: int = None
+    max_queued: int = None
+    inline_max_size: int = None
+    nodes: list = None
+    health_interval: float = 5.0
+    # the bearer token front-ends authenticate with at worker nodes
+    node_secret: str = None
+    timeout: float = None
+    child_max_memory: int = None
+    child_max_cpu: int = None
+    recycle_after: int = None
+    recycle_max_rss: int = None
+    compression_threads: int = None
+    min_workers: int = None
+    scale_up_wait: float = 0.5
+    scale_down_after: float = 60.0
+    scale_interval: float = 1.0
 
 
 @dataclass(frozen=True)
@@ -75,11 +166,84 @@ class DocumentConfig:
     extra_args: dict = field(default_factory=dict)
 
 
+@dataclass(frozen=True)
+class UploadsConfig:
+    chunk_size: int = 256 * 1024
+    max_size: int = None
+    queue_size: int = 8
+
+
+@dataclass(frozen=True)
+class JobsConfig:
+    concurrency: int = None
+    max_queued: int = 100
+    ttl: int = 3600
+
+
+@dataclass(frozen=True)
+class CacheConfig:
+    path: str
+    max_size: int = 1024 ** 3
+
+
+@dataclass(frozen=True)
+class OptionsConfig:
+    templates: dict = field(default_factory=dict)
+    filters: dict = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class FiltersConfig:
+    python: list = field(default_factory=list)
+    in_process: bool = True
+
+
+@dataclass(frozen=True)
+class PdfConfig:
+    engine: str = 'xelatex'
+    cache_dir: str = None
+    dump_preamble: bool = True
+    max_formats: int = 8
+
+
+@dataclass(frozen=True)
+class TracesConfig:
+    path: str
+    ttl: int = 7 * 24 * 3600
+
+
+@dataclass(frozen=True)
+class SchedulingConfig:
+    client_header: str = 'X-API-Key'
+    expensive_formats: list = field(default_factory=lambda: ['pdf'])
+    cheap_max_size: int = 1024 ** 2
+    reserved_workers: int = 0
+    cheap_weight: int = 3
+    expensive_weight: int = 1
+
+
+@dataclass(frozen=True)
+class BatchConfig:
+    max_size: int = 16 * 1024 ** 2
+    max_items: int = 10000
+    max_item_size: int = 1024 ** 2
+    chunk_size: int = 64
+
+
 @dataclass(frozen=True)
 class Config:
     app: AppConfig
     workers: WorkersConfig
     document: DocumentConfig
+    uploads: UploadsConfig = field(default_factory=UploadsConfig)
+    jobs: JobsConfig = field(default_factory=JobsConfig)
+    cache: Optional[CacheConfig] = None
+    options: OptionsConfig = field(default_factory=OptionsConfig)
+    filters: FiltersConfig = field(default_factory=FiltersConfig)
+    pdf: Optional[PdfConfig] = None
+    scheduling: SchedulingConfig = field(default_factory=SchedulingConfig)
+    traces: Optional[TracesConfig] = None
+    batch: BatchConfig = field(default_factory=BatchConfig)
 
 
 def config_from_dict(d: Dict[str, Any]) -> Config:
@@ -92,13 +256,84 @@ def config_from_dict(d: Dict[str, Any]) -> Config:
     document_config = DocumentConfig( # type: ignore
         **d['document']
     )
-    return Config(app=app_config, workers=workers_config, document=document_config)  # type: ignore
+    uploads_config = UploadsConfig(  # type: ignore
+        **d.get('uploads', {})
+    )
+    jobs_config = JobsConfig(  # type: ignore
+        **d.get('jobs', {})
+    )
+    cache_config = None
+    if 'cache' in d:
+        cache_config = CacheConfig(  # type: ignore
+            **d['cache']
+        )
+    options_config = OptionsConfig(  # type: ignore
+        **d.get('options', {})
+    )
+    filters_config = FiltersConfig(  # type: ignore
+        **d.get('filters', {})
+    )
+    pdf_config = None
+    if 'pdf' in d:
+        pdf_config = PdfConfig(  # type: ignore
+            **d['pdf']
+        )
+    scheduling_config = SchedulingConfig(  # type: ignore
+        **d.get('scheduling', {})
+    )
+    batch_config = BatchConfig(  # type: ignore
+        **d.get('batch', {})
+    )
+    traces_config = None
+    if 'traces' in d:
+        traces_config = TracesConfig(  # type: ignore
+            **d['traces']
+        )
+    return Config(app=app_config, workers=workers_config, document=document_config,  # type: ignore
+                  uploads=uploads_config, jobs=jobs_config, cache=cache_config, options=options_config, filters=filters_config,
+                  pdf=pdf_config, scheduling=scheduling_config, traces=traces_config, batch=batch_config)
 
 
 def init_config(app: web.Application, config: Config) -> None:
     app['config'] = config
 
 
+def init_cache(app: web.Application, conf: Optional[CacheConfig]) -> Optional[ResultCache]:
+    cache = None
+    if conf is not None:
+        cache = ResultCache(conf.path, conf.max_size)
+        logger.info(f"Caching conversion results in '{cache.path}'")
+    app['cache'] = cache
+    return cache
+
+
+def init_traces(app: web.Application, conf: Optional[TracesConfig]) -> Optional[TracesConfig]:
+    """Writes request traces to the configured dir, expiring them after their ttl."""
+    if conf is None:
+        return None
+    tracing.configure(conf.path)
+    logger.info(f"Writing request traces to '{conf.path}'")
+
+    async def expire_traces() -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            removed = await loop.run_in_executor(None, tracing.remove_expired, conf.ttl)
+            if removed:
+                logger.info(f"Removed {removed} expired trace(s)")
+            await asyncio.sleep(min(conf.ttl, 3600))
+
+    async def start(app: web.Application) -> None:
+        app['traces_expiry'] = asyncio.ensure_future(expire_traces())
+
+    async def stop(app: web.Application) -> None:
+        app['traces_expiry'].cancel()
+        await asyncio.get_event_loop().run_in_executor(None, tracing.flush, 5.0)
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    return conf
+
+
 def clean_up_tempfile(filepath: Union[str, Path]):
     p = Path(filepath)
 
@@ -107,20 +342,46 @@ def clean_up_tempfile(filepath: Union[str, Path]):
         p.unlink()
 
 
-async def init_workers(app: web.Application, conf: WorkersConfig, doc: DocumentConfig) -> ProcessPoolExecutor:
-    n = conf.max_workers
-    executor = ProcessPoolExecutor(max_workers=n)
+def clean_up_result(filepath: Union[str, Path]):
+    """Removes a conversion result and the dir it was created in once that is empty."""
+    p = Path(filepath)
+    clean_up_tempfile(p)
+
+    if p.parent.resolve() != Path(DEFAULT_TEMP_DIR).resolve():
+        try:
+            p.parent.rmdir()
+        except OSError:
+            pass
+
 
-    loop = asyncio.get_event_loop()
-    run = loop.run_in_executor
-    fs = [run(executor, warm, doc) for i in range(0, n)]
-    await asyncio.gather(*fs)
+async def init_workers(app: web.Application, conf: WorkersConfig, doc: DocumentConfig,
+                       cache: Optional[ResultCache] = None, pdf: Optional[PdfConfig] = None,
+                       filters: Optional[FiltersConfig] = None, local: bool = False,
+                       scheduling: SchedulingConfig = SchedulingConfig(),
+                       traces: Optional[TracesConfig] = None, options: Optional[OptionsConfig] = None) -> Executor:
+    """Starts the executor running conversions, on worker nodes when configured unless `local` is set."""
+    if conf.nodes and not local:
+        if not conf.node_secret:
+            raise ValueError("'workers.nodes' requires 'workers.node_secret', shared with the nodes")
+        executor = RemoteExecutor(conf.nodes, conf.max_workers, conf.health_interval,
+                                  secret=conf.node_secret, options=options)  # type: Executor
+    else:
+        limits = ResourceLimits(conf.timeout, conf.child_max_memory, conf.child_max_cpu)
+        executor = LocalExecutor(conf.max_workers, doc, conf.engine, conf.engine_command, cache, pdf, filters,
+                                 limits, conf.recycle_after, conf.recycle_max_rss, traces, conf.compression_threads,
+                                 conf.min_workers, conf.scale_up_wait, conf.scale_down_after, conf.scale_interval)
+    await executor.start()
 
     async def close_executor(app: web.Application) -> None:
-        fs = [run(executor, clean) for i in range(0, n)]
-        await asyncio.shield(asyncio.gather(*fs))
-        executor.shutdown(wait=True)
+        await executor.stop()
 
     app.on_cleanup.append(close_executor)
     app['executor'] = executor
+    app['admission'] = AdmissionController(
+        conf.max_in_flight or executor.size, conf.max_queued, scheduling.reserved_workers,
+        {CHEAP: scheduling.cheap_weight, EXPENSIVE: scheduling.expensive_weight}
+    )
+    if isinstance(executor, RemoteExecutor) and conf.max_in_flight is None:
+        # follows the workers of the healthy nodes
+        executor.on_resize = app['admission'].resize
     return executor
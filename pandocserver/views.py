@@ -1,36 +1,57 @@
 import asyncio
+import hashlib
+import json
 import logging
 import mimetypes
-import re
+import shutil
 from functools import partial
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import Dict
-from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from dataclasses import asdict, replace
 
 import aiohttp_jinja2
-from aiohttp import web
+from aiohttp import hdrs, web
 from multidict import CIMultiDict
 
 
-from .services import PANDOC_SERVICE_FORMATS
-from .worker import convert, DEFAULT_TEMP_DIR
+from .admission import OverloadedError, CHEAP, EXPENSIVE
+from .batch import BatchError, BatchItem, InvalidBatchError, chunk_items, parse_batch
+from . import tracing
+from .cache import cache_key
+from .compression import CODECS
+from .executors import Executor
+from .flights import Flights
+from .metrics import REGISTRY, ARCHIVE_MEMBERS, COALESCED, POOL_CONVERSIONS, RECEIVED_BYTES, SENT_BYTES, collect, timed
+from .options import ConversionOptions, InvalidOptionError, parse_options
+from .responses import FileResponse
+from .services import get_formats, is_archive, BINARY_FORMATS, NotAnArchiveError
+from .worker import bundle, convert, convert_batch, convert_inline, convert_document, convert_many, extract, ConvertMembersError, DEFAULT_TEMP_DIR
+from .jobs import Job, JobQueueFullError, DONE, FAILED
+from .uploads import Upload, spool
 from .utils import Config, clean_up_tempfile
 
 logger = logging.getLogger('asyncio')
 
 
 class SiteHandler:
-    def __init__(self, conf: Config, executor: ProcessPoolExecutor) -> None:
+    def __init__(self, conf: Config, executor: Executor) -> None:
         self._conf = conf
         self._executor = executor
         self._loop = asyncio.get_event_loop()
+        self._flights = Flights()
 
     @aiohttp_jinja2.template('index.html')
     async def index(self, request: web.Request) -> Dict[str, str]:
         return {}
 
-    async def convert(self, request: web.Request) -> web.StreamResponse:
+    async def _receive(self, request: web.Request, in_memory: bool = False) -> Upload:
+        """
+        Reads a conversion request, spooling the upload to a temp file.
+
+        With `in_memory` set, uploads which will be converted inline are read
+        into memory instead, when the request is small enough to tell up front.
+        """
         reader = await request.multipart()
 
         field = await reader.next()
@@ -39,59 +60,449 @@ class SiteHandler:
 
         field = await reader.next()
         assert field.name == 'to'
-        to_format = str(await field.read(), 'utf-8')
+        # one or more formats, comma separated and/or as repeated fields
+        to_formats = []  # type: List[str]
+        while field is not None and field.name == 'to':
+            to_formats.extend(fmt.strip() for fmt in str(await field.read(), 'utf-8').split(',') if fmt.strip())
+            field = await reader.next()
+        to_format = ",".join(dict.fromkeys(to_formats))
 
-        field = await reader.next()
-        assert field.name == 'file'
+        # optional conversion options up to the file
+        fields = {}  # type: Dict[str, List[str]]
+        while field is not None and field.name != 'file':
+            fields.setdefault(field.name, []).append(str(await field.read(), 'utf-8'))
+            field = await reader.next()
+        try:
+            options = parse_options(fields, self._conf.options.templates, self._conf.options.filters)
+        except InvalidOptionError as err:
+            raise web.HTTPBadRequest(text=str(err))
+
+        assert field is not None and field.name == 'file'
         filename = field.filename
+        if options.compression is not None and CODECS[options.compression].zip_method is None \
+                and (len(to_formats) > 1 or Path(filename).suffix == '.zip'):
+            raise web.HTTPBadRequest(text=f"Compression '{options.compression}' is not supported in zip archives")
 
         ext = "".join(Path(filename).suffixes)
-        input_filename = re.sub(f"{ext}$", "", filename)
 
-        assert from_format in PANDOC_SERVICE_FORMATS
-        assert to_format in PANDOC_SERVICE_FORMATS
+        formats = get_formats()
+        assert from_format in formats.all
+        assert to_formats and all(fmt in formats.all for fmt in to_formats)
+
+        if (in_memory and request.content_length is not None
+                and self._inlinable(filename, request.content_length, to_formats)):
+            with timed('upload', from_format=from_format, to_format=to_format):
+                content = bytes(await field.read())
+            RECEIVED_BYTES.inc(len(content), from_format=from_format, to_format=to_format)
+            return Upload(filename, '', len(content), hashlib.sha256(content).hexdigest(), from_format, to_format,
+                          options, self._client(request), tracing.context(), content)
+
+        r = self._loop.run_in_executor
+        fobj = await r(
+            None,
+            partial(NamedTemporaryFile, mode='wb', suffix=f'{ext}', dir=DEFAULT_TEMP_DIR, delete=False)
+        )
+        try:
+            with fobj:
+                uploads = self._conf.uploads
+                with timed('upload', from_format=from_format, to_format=to_format):
+                    size, digest = await spool(field, fobj, uploads.chunk_size, uploads.max_size, uploads.queue_size)
+        except BaseException:
+            await r(None, clean_up_tempfile, fobj.name)
+            raise
+
+        logger.info(f"Created input file '{fobj.name}' sized '{size}'")
+        RECEIVED_BYTES.inc(size, from_format=from_format, to_format=to_format)
+        return Upload(filename, fobj.name, size, digest, from_format, to_format, options, self._client(request),
+                      tracing.context())
 
+    def _client(self, request: web.Request) -> str:
+        """Identifies the client by its API key, or its address without one."""
+        key = request.headers.get(self._conf.scheduling.client_header)
+        if key:
+            # keys are only logged hashed
+            return 'key-' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:12]
+        return request.remote or ''
+
+    def _cost_class(self, upload: Upload) -> str:
+        scheduling = self._conf.scheduling
+        if (upload.size > scheduling.cheap_max_size or is_archive(upload.filename)
+                or any(fmt in scheduling.expensive_formats for fmt in upload.to_formats)):
+            return EXPENSIVE
+        return CHEAP
+
+    @staticmethod
+    def _encoding(request: web.BaseRequest, upload: Upload) -> Optional[web.ContentCoding]:
+        """
+        Returns the coding a text output is sent with, None to send it as is, with sendfile.
+
+        Outputs are encoded when the client accepts gzip or deflate, or with
+        gzip when the request chose it as its `compression`.
+        """
+        if (upload.options.compression == 'store' or len(upload.to_formats) != 1
+                or upload.to_format in BINARY_FORMATS or is_archive(upload.filename)):
+            return None
+        if upload.options.compression == 'gzip':
+            return web.ContentCoding.gzip
+        accepted = request.headers.get(hdrs.ACCEPT_ENCODING, '').lower()
+        for coding in (web.ContentCoding.gzip, web.ContentCoding.deflate):
+            if coding.value in accepted:
+                return coding
+        return None
+
+    def _inlinable(self, filename: str, size: int, to_formats: List[str]) -> bool:
+        max_size = self._conf.workers.inline_max_size
+        return (max_size is not None and size <= max_size and len(to_formats) == 1
+                and to_formats[0] not in BINARY_FORMATS and not is_archive(filename))
+
+    def _inline(self, upload: Upload) -> bool:
+        """Whether the output should be returned by the worker instead of written to a file."""
+        return upload.content is not None or self._inlinable(upload.filename, upload.size, upload.to_formats)
+
+    async def run(self, app: web.Application, upload: Upload, block: bool = False,
+                  inline: bool = False) -> Tuple[Union[Path, bytes], bool]:
+        """
+        Converts an upload, returns the result and whether it came from the cache.
+
+        The result is the output file, or with `inline` set the output itself
+        unless it was found in the cache. Raises an `OverloadedError` when the
+        worker pool queue is full, unless `block` is set.
+        """
         r = self._loop.run_in_executor
-        executor = request.app['executor']
-        fobj_out = None
+        cache = app['cache']
+
+        key = self._upload_key(upload)
+        if cache is not None:
+            fobj_out = await r(None, cache.get, key)
+            if fobj_out is not None:
+                return fobj_out, True
+
         try:
-            with (await r(
-                    None,
-                    partial(NamedTemporaryFile, mode='wb', suffix=f'{ext}', dir=DEFAULT_TEMP_DIR)
-            )) as fobj:
-                size = 0
-                while True:
-                    chunk = await field.read_chunk()  # 8192 bytes by default.
-                    if not chunk:
-                        break
-                    size += len(chunk)
-                    fobj.write(chunk)
-                fobj.seek(0)
-
-                logger.info(f"Created input file '{fobj.name}' sized '{size}'")
-
-                try:
-                    fobj_out = await r(executor, convert, input_filename, fobj.name, from_format, to_format)
-                    logger.info(f"Conversion successful, created file: '{fobj_out.name}'")
-                except (RuntimeError, TypeError) as e:
-                    logger.error(f"{e}")
-                    raise
-
-                content_type, _ = mimetypes.guess_type(str(fobj_out.resolve()))
-                disposition = f'filename="{fobj_out.name}"'
-
-                if 'text' not in content_type:
-                    disposition = 'attachment; ' + disposition
-
-                headers = {
-                    'Access-Control-Expose-Headers': 'Content-Disposition',
-                    'Content-Disposition': disposition,
-                    'Content-Transfer-Encoding': 'binary'
-                }
+            with tracing.span('convert', **upload.labels):
+                submit = self._admitted(app, upload, block)
+                if inline:
+                    output = await submit(convert_inline, upload.labels, upload.source, upload.from_format,
+                                          upload.to_format, upload.options)
+                else:
+                    output = await self._convert(app['executor'], upload.input_filename, upload.path,
+                                                 upload.from_format, upload.to_format, upload.options, submit)
+                    logger.info(f"Conversion successful, created file: '{output.name}'")
+        except (RuntimeError, TypeError) as e:
+            logger.error(f"{e}")
+            raise
+
+        if cache is not None:
+            if inline:
+                await r(None, cache.put_bytes, key, self._output_name(upload), output)
+            else:
+                await r(None, cache.put, key, output)
+        return output, False
+
+    def _upload_key(self, upload: Upload) -> str:
+        options = upload.options
+        if len(upload.to_formats) == 1 and not is_archive(upload.filename):
+            # only archives are compressed by the workers
+            options = replace(options, compression=None)
+        return self._cache_key(upload.digest, upload.filename, upload.from_format, upload.to_format, options)
+
+    @staticmethod
+    def _output_name(upload: Upload) -> str:
+        return f"{upload.input_filename}.{upload.to_format}"
+
+    @staticmethod
+    def _overloaded(err: OverloadedError) -> web.HTTPServiceUnavailable:
+        return web.HTTPServiceUnavailable(text=str(err), headers={'Retry-After': str(err.retry_after)})
+
+    async def convert(self, request: web.Request) -> web.StreamResponse:
+        admission = request.app['admission']
+        if admission.full:
+            # reject before spooling the upload
+            raise self._overloaded(admission.reject())
+
+        upload = await self._receive(request, in_memory=True)
+
+        inline = self._inline(upload)
+        key = f"{self._upload_key(upload)}:{inline}"
+        # identical requests arriving together share one conversion and its result file
+        joining = key in self._flights
+        try:
+            with collect() as samples:
+                (output, cached), shared = await self._flights.run(
+                    key, partial(self._run_flight, request.app, upload, inline)
+                )
+        except OverloadedError as err:
+            raise self._overloaded(err)
         except Exception as err:
             return web.Response(text=str(err), status=500)
+        finally:
+            if joining and upload.content is None:
+                # the conversion in flight has an upload of its own
+                self._loop.run_in_executor(None, clean_up_tempfile, upload.path)
+
+        response = None
+        try:
+            response = self._response(request, upload, output, cached, shared, samples)
+        finally:
+            if response is None and isinstance(output, Path) and not cached:
+                self._flights.release(output)
+        return response
+
+    async def _run_flight(self, app: web.Application, upload: Upload,
+                          inline: bool) -> Tuple[Union[Path, bytes], bool]:
+        """Converts an upload for every request sharing the conversion, removes the upload once done."""
+        try:
+            return await self.run(app, upload, inline=inline)
+        finally:
+            if upload.content is None:
+                await self._loop.run_in_executor(None, clean_up_tempfile, upload.path)
+
+    def _response(self, request: web.Request, upload: Upload, output: Union[Path, bytes], cached: bool,
+                  shared: bool, samples: Dict[str, Any]) -> web.StreamResponse:
+        if isinstance(output, bytes):
+            headers = self._headers(Path(self._output_name(upload)))
         else:
-            return web.FileResponse(path=str(fobj_out.resolve()), headers=CIMultiDict(headers))
+            headers = self._headers(output)
+        if shared:
+            COALESCED.inc(**upload.labels)
+        if request.app['cache'] is not None:
+            headers['X-Cache'] = 'HIT' if cached else 'MISS'
+            if is_archive(upload.filename) and not cached and not shared:
+                headers['X-Members-Reused'] = str(int(ARCHIVE_MEMBERS.collected(samples, result='reused')))
+                headers['X-Members-Rebuilt'] = str(int(ARCHIVE_MEMBERS.collected(samples, result='rebuilt')))
+
+        if isinstance(output, bytes):
+            content_type, _ = mimetypes.guess_type(self._output_name(upload))
+            SENT_BYTES.inc(len(output), **upload.labels)
+            response = web.Response(body=output, headers=CIMultiDict(headers),
+                                    content_type=content_type or 'application/octet-stream')  # type: web.StreamResponse
+        else:
+            # cached results are shared, fresh results are removed once sent to every request sharing them
+            response = FileResponse(path=str(output.resolve()), headers=CIMultiDict(headers),
+                                    labels=upload.labels, delete=not cached, release=self._flights.release)
+        coding = self._encoding(request, upload)
+        if coding is not None:
+            response.enable_compression(coding)
+        return response
+
+    @staticmethod
+    async def _read(request: web.Request, max_size: int) -> bytes:
+        if request.content_length is not None and request.content_length > max_size:
+            raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=request.content_length)
+        body = bytearray()
+        async for chunk in request.content.iter_any():
+            body += chunk
+            if len(body) > max_size:
+                raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=len(body))
+        return bytes(body)
+
+    async def _convert_chunk(self, app: web.Application, client: str, from_format: str, to_format: str,
+                             items: List[BatchItem], options: ConversionOptions) -> bytes:
+        labels = {'from_format': from_format, 'to_format': to_format}
+        RECEIVED_BYTES.inc(sum(len(item.content) for item in items), **labels)
+        try:
+            with timed('queue', **labels):
+                slot = await app['admission'].slot(True, CHEAP, client)
+            with slot, tracing.span('chunk', items=len(items), **labels):
+                results = await self._submit(app['executor'], convert_batch, labels, from_format, to_format,
+                                             [item.content for item in items], options)
+        except Exception as err:
+            logger.error(f"Batch chunk of {len(items)} document(s) failed: {err}")
+            results = [(None, str(err))] * len(items)
+
+        lines = []
+        for item, (output, error) in zip(items, results):
+            result = {'id': item.id, 'output': output} if error is None else {'id': item.id, 'error': error}
+            lines.append(json.dumps(result) + '\n')
+        data = ''.join(lines).encode('utf-8')
+        SENT_BYTES.inc(len(data), **labels)
+        return data
+
+    async def batch(self, request: web.Request) -> web.StreamResponse:
+        """
+        Converts the `{"id", "from", "to", "content"}` items of a JSON array or NDJSON body.
+
+        Items are grouped by their formats and converted in chunks, a worker
+        task each, and the results are streamed back as NDJSON lines of
+        `{"id", "output"}` or `{"id", "error"}` as their chunks finish.
+        Conversion options are taken from the query string.
+        """
+        admission = request.app['admission']
+        if admission.full:
+            raise self._overloaded(admission.reject())
+
+        conf = self._conf.batch
+        try:
+            fields = {name: request.query.getall(name) for name in request.query}
+            options = parse_options(fields, self._conf.options.templates, self._conf.options.filters)
+        except InvalidOptionError as err:
+            raise web.HTTPBadRequest(text=str(err))
+        body = await self._read(request, conf.max_size)
+        try:
+            items = await self._loop.run_in_executor(
+                None, partial(parse_batch, body, conf.max_items, conf.max_item_size)
+            )
+        except InvalidBatchError as err:
+            raise web.HTTPBadRequest(text=str(err))
+
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        errors = [item for item in items if isinstance(item, BatchError)]
+        if errors:
+            await response.write(''.join(json.dumps({'id': item.id, 'error': item.error}) + '\n'
+                                         for item in errors).encode('utf-8'))
+
+        client = self._client(request)
+        valid = [item for item in items if isinstance(item, BatchItem)]
+        chunks = [
+            asyncio.ensure_future(self._convert_chunk(request.app, client, from_format, to_format, chunk, options))
+            for (from_format, to_format), chunk in chunk_items(valid, conf.chunk_size)
+        ]
+        try:
+            for chunk in asyncio.as_completed(chunks):
+                await response.write(await chunk)
         finally:
-            if fobj_out is not None:
-                self._loop.call_later(30, clean_up_tempfile, str(fobj_out.resolve()))
+            # the client went away
+            for chunk in chunks:
+                chunk.cancel()
+        logger.info(f"Converted a batch of {len(items)} document(s) in {len(chunks)} chunk(s)")
+        await response.write_eof()
+        return response
+
+    async def submit_job(self, request: web.Request) -> web.Response:
+        upload = await self._receive(request)
+        try:
+            job = request.app['jobs'].submit(upload)
+        except JobQueueFullError as err:
+            await self._loop.run_in_executor(None, clean_up_tempfile, upload.path)
+            raise web.HTTPServiceUnavailable(text=str(err))
+
+        location = request.app.router['job'].url_for(job_id=job.id)
+        return web.json_response(job.to_dict(), status=202, headers={'Location': str(location)})
+
+    def _get_job(self, request: web.Request) -> Job:
+        job = request.app['jobs'].get(request.match_info['job_id'])
+        if job is None:
+            raise web.HTTPNotFound()
+        return job
+
+    async def job(self, request: web.Request) -> web.Response:
+        return web.json_response(self._get_job(request).to_dict())
+
+    async def job_result(self, request: web.Request) -> web.StreamResponse:
+        job = self._get_job(request)
+        if job.status == FAILED:
+            return web.Response(text=job.error, status=500)
+        if job.status != DONE:
+            raise web.HTTPConflict(text=f"Job '{job.id}' is {job.status}")
+        response = FileResponse(path=str(job.result.resolve()), headers=CIMultiDict(self._headers(job.result)),
+                                labels=job.upload.labels)
+        coding = self._encoding(request, job.upload)
+        if coding is not None:
+            response.enable_compression(coding)
+        return response
+
+    async def _submit(self, executor: Executor, fn: Callable[..., Any],
+                      labels: Dict[str, str], *args: Any) -> Any:
+        return await executor.submit(fn, labels, *args)
+
+    def _admitted(self, app: web.Application, upload: Upload,
+                  block: bool = False) -> Callable[..., Awaitable[Any]]:
+        """
+        Returns a `_submit` for the tasks of an upload taking a slot of the admission controller each.
+
+        A fanned out archive is charged a slot per member converted at the
+        same time. Only its first task can be rejected, the others belong to a
+        conversion which was admitted already and wait for their slots.
+        """
+        admission = app['admission']
+        cost = self._cost_class(upload)
+        admitted = False
+
+        async def submit(fn: Callable[..., Any], labels: Dict[str, str], *args: Any) -> Any:
+            nonlocal admitted
+            with timed('queue', **labels):
+                slot = await admission.slot(block or admitted, cost, upload.client)
+            admitted = True
+            with slot:
+                return await self._submit(app['executor'], fn, labels, *args)
+        return submit
+
+    async def _convert(self, executor: Executor, filename: str, in_file: str,
+                       from_format: str, to_format: str, options: ConversionOptions,
+                       submit: Optional[Callable[..., Awaitable[Any]]] = None) -> Path:
+        labels = {'from_format': from_format, 'to_format': to_format}
+        submit = submit or partial(self._submit, executor)
+        to_formats = to_format.split(',')
+        if len(to_formats) > 1:
+            return await submit(convert_many, labels, filename, in_file, from_format, to_formats, options)
+
+        # members are handed around as paths, which worker nodes do not share
+        if not self._conf.workers.fan_out or not executor.shares_files:
+            return await submit(convert, labels, filename, in_file, from_format, to_format, options)
+
+        try:
+            out_dir, members = await submit(extract, labels, filename, in_file)
+        except NotAnArchiveError:
+            return await submit(convert, labels, filename, in_file, from_format, to_format, options)
+
+        limit = asyncio.Semaphore(self._conf.workers.fan_out_limit or self._conf.workers.max_workers)
+
+        async def convert_one(member: str) -> List[Path]:
+            async with limit:
+                with tracing.span('member', member=Path(member).name):
+                    return await submit(convert_document, labels, member, out_dir, from_format, [to_format], options)
+
+        output = None
+        try:
+            results = await asyncio.gather(*[convert_one(member) for member in members], return_exceptions=True)
+            errors = {
+                Path(member).name: result
+                for member, result in zip(members, results) if isinstance(result, Exception)
+            }
+            if errors:
+                raise ConvertMembersError(errors)
+
+            logger.info(f"Converted {len(members)} document(s) from '{from_format}' to '{to_format}'")
+            output = await submit(bundle, labels, out_dir, Path(in_file).suffixes[-1], options.compression)
+            return output
+        finally:
+            if output is None:
+                # the extracted members and their outputs, the bundle keeps only itself in there
+                await asyncio.shield(self._loop.run_in_executor(
+                    None, partial(shutil.rmtree, str(Path(out_dir).parent), ignore_errors=True)))
+
+    async def stats(self, request: web.Request) -> web.Response:
+        stats = {}
+        cache = request.app['cache']
+        if cache is not None:
+            stats['cache'] = await self._loop.run_in_executor(None, cache.stats)
+        stats['jobs'] = request.app['jobs'].stats()
+        stats['flights'] = self._flights.stats()
+        stats['workers'] = dict(request.app['admission'].stats(), **request.app['executor'].stats())
+        return web.json_response(stats)
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        admission = request.app['admission']
+        POOL_CONVERSIONS.set(admission.in_flight, state='running')
+        POOL_CONVERSIONS.set(admission.queued, state='queued')
+        return web.Response(body=REGISTRY.expose().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    def _cache_key(self, digest: str, filename: str, from_format: str, to_format: str,
+                   options: ConversionOptions) -> str:
+        return cache_key(digest, filename, from_format, to_format, asdict(self._conf.document), asdict(options),
+                         self._conf.filters.python, get_formats().version)
+
+    @staticmethod
+    def _headers(filepath: Path) -> Dict[str, str]:
+        content_type, _ = mimetypes.guess_type(str(filepath.resolve()))
+        disposition = f'filename="{filepath.name}"'
+
+        if 'text' not in (content_type or ''):
+            disposition = 'attachment; ' + disposition
+
+        return {
+            'Access-Control-Expose-Headers': 'Content-Disposition',
+            'Content-Disposition': disposition,
+            'Content-Transfer-Encoding': 'binary'
+        }
@@ -1,5 +1,5 @@
+import hashlib
 import logging
-import mimetypes
 
 import os
 
@@ -7,32 +7,117 @@ import pathlib
 import re
 import shutil
 import signal
+from dataclasses import asdict, replace
 from pathlib import Path
-from tempfile import gettempdir
+from tempfile import NamedTemporaryFile, gettempdir, mkdtemp
 
-from typing import Any, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
-from .services import PandocService as service, \
-    create_archive, CreateArchiveError, extract_archive, ExtractArchiveError, NotAnArchiveError
+from .cache import ResultCache, cache_key
+from .filters import FilterPipeline
+from .limits import ConversionTimeoutError, deadline, get_limits, set_limits
+from . import compression, tracing
+from .latex import BEGIN_DOCUMENT, LATEX_CACHE_DIR, LatexEngine, LatexError
+from .metrics import ARCHIVE_MEMBERS, REGISTRY, labelled, timed
+from .options import ConversionOptions
+from .services import PandocService as service, PandocServerEngine, EngineUnavailableError, \
+    get_formats, set_formats, create_archive, extract_archive, \
+    ArchiveWriter, archive_members, archive_path, is_archive
 
 logger = logging.getLogger('asyncio')
 
 _service = None
+_member_cache = None  # type: Optional[ResultCache]
+_settings = {}  # type: Dict[str, Any]
 
 DEFAULT_TEMP_DIR = os.environ.get('PANDOC_TEMP_DIR', gettempdir() + '/.pandoc')
 
 
-def warm(conf) -> None:
+def warm(conf, engine: str = 'subprocess', engine_command: Optional[str] = None,
+         formats: Optional[Any] = None, cache: Optional[ResultCache] = None, pdf: Optional[Any] = None,
+         filters: Optional[Any] = None, limits: Optional[Any] = None,
+         traces: Optional[Any] = None, compression_threads: Optional[int] = None) -> None:
     logger.info("Warming up the service")
+    if formats is not None:
+        set_formats(formats)
+    if limits is not None:
+        set_limits(limits)
+    if traces is not None:
+        tracing.configure(traces.path)
+    compression.set_threads(compression_threads)
+
+    # archive members are cached next to the results, the cache is safe to share between processes
+    global _member_cache, _settings
+    _member_cache = cache
+    _settings = dict(conf.__dict__, filters=list(filters.python) if filters is not None else [])
 
     # should be executed only in child processes
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # a process group of its own, so a stuck worker can be killed with its children
+    os.setpgrp()
+    # drop anything inherited from the parent process
+    REGISTRY.drain()
     tmp_dir = Path(DEFAULT_TEMP_DIR)
     tmp_dir.mkdir(mode=0o700, exist_ok=True)
     logger.debug(f"Creating tempdir {tmp_dir.resolve()}")
     global _service
     if _service is None:
-        _service = service(**conf.__dict__)
+        pandoc_engine = None
+        if engine == 'server':
+            kwargs = {}  # type: Dict[str, Any]
+            if engine_command:
+                kwargs['command'] = engine_command
+            if limits is not None and limits.timeout:
+                kwargs['timeout'] = limits.timeout
+            pandoc_engine = PandocServerEngine(**kwargs)
+            try:
+                pandoc_engine.start()
+            except EngineUnavailableError as err:
+                logger.warning(f"{err}, it will be retried on the first conversion")
+        _service = service(engine=pandoc_engine, **conf.__dict__)
+        if filters is not None and filters.python:
+            # filter modules are imported once, not for every document
+            _service.filter_pipeline = FilterPipeline(filters.python, filters.in_process)
+            _service.filter_pipeline.load()
+        if pdf is not None:
+            _service.latex_engine = _start_latex(_service, pdf)
+
+
+def _template_preamble(service: Any) -> Optional[str]:
+    """Renders an empty document with the configured template, returns the LaTeX up to its body."""
+    with NamedTemporaryFile(mode='w', suffix='.md', dir=DEFAULT_TEMP_DIR) as fobj:
+        service.out_file = None
+        service.markdown = fobj.name
+        try:
+            tex = service.latex
+        except (RuntimeError, OSError) as err:
+            logger.warning(f"Unable to render the LaTeX template, reason: {err}")
+            return None
+    preamble, begin, _ = tex.partition(BEGIN_DOCUMENT)
+    return preamble if begin else None
+
+
+def _start_latex(service: Any, pdf: Any) -> Optional[LatexEngine]:
+    latex = LatexEngine(pdf.engine, pdf.cache_dir or LATEX_CACHE_DIR, pdf.dump_preamble, pdf.max_formats)
+    try:
+        latex.start(_template_preamble(service) if pdf.dump_preamble else None)
+    except (LatexError, OSError) as err:
+        logger.warning(f"{err}, pdfs are left to pandoc")
+        return None
+    return latex
+
+
+def run_task(fn: Callable[..., Any], labels: Dict[str, str], *args: Any,
+             trace: Optional[tracing.TraceContext] = None) -> Tuple[Any, dict]:
+    """Runs a task in a pool worker, returns its result with the metrics it recorded."""
+    try:
+        with tracing.traced(trace), tracing.span('task', task=fn.__name__), \
+                deadline(get_limits().timeout), labelled(**labels):
+            result = fn(*args)
+    except BaseException:
+        REGISTRY.drain()
+        raise
+    return result, REGISTRY.drain()
 
 
 def clean() -> None:
@@ -42,59 +127,343 @@ def clean() -> None:
     tmp_dir = Path(DEFAULT_TEMP_DIR)
     shutil.rmtree(tmp_dir.resolve(), ignore_errors=True)
     logger.debug(f"Removed tempdir {tmp_dir.resolve()}")
+    retire()
+
+
+def retire() -> None:
+    """Stops the engines of a worker being replaced, the temp dir shared with other workers is left alone."""
     global _service
+    if _service is not None and _service.engine is not None:
+        _service.engine.stop()
+    if _service is not None and _service.latex_engine is not None:
+        _service.latex_engine.stop()
     _service = None
 
 
-def convert(filename:  str,
-            in_file: Union[str, pathlib.Path],
-            from_format: Optional[str] = None,
-            to_format: Optional[str] = None,
-            service: Optional[Any] = None) -> Union[str, pathlib.Path]:
+class ConvertMembersError(Exception):
+    def __init__(self, errors: Dict[str, Exception]) -> None:
+        self.errors = errors
+        super().__init__("\n".join(f"{name}: {err}" for name, err in sorted(errors.items())))
+
 
+def _get_service(service: Optional[Any] = None) -> Any:
     if service is None:
         service = _service
 
     if service is None:
         raise RuntimeError('Service should be loaded first')
+    return service
 
-    assert type(in_file) is str
+
+def extract(filename: str, in_file: Union[str, pathlib.Path]) -> Tuple[str, List[str]]:
+    """Extracts an archive once and returns the output dir and the members to convert."""
+    archive = extract_archive(Path(in_file))
+    archive_ext = "".join(archive.suffixes)
+    archive_stem = re.sub(f"{archive_ext}$", "", archive.name)
+
+    out_dir = Path(str(archive.parent.resolve() / archive_stem / filename) + '_converted')
+    out_dir.mkdir(mode=0o700)
+    members = [str(filepath.resolve()) for filepath in sorted(archive.glob("*/*.*")) if not filepath.is_dir()]
+    return str(out_dir), members
+
+
+def output_name(in_file: Union[str, pathlib.Path], to_format: str) -> str:
+    """Returns the name of the output of converting a document, e.g. `index.md` -> `index.html`."""
+    filepath = Path(in_file)
+    ext = "".join(filepath.suffixes)
+    return f"{re.sub(f'{re.escape(ext)}$', '', filepath.name)}.{to_format}"
+
+
+def convert_member(in_file: Union[str, pathlib.Path],
+                   out_dir: Union[str, pathlib.Path],
+                   from_format: Optional[str] = None,
+                   to_format: Optional[str] = None,
+                   service: Optional[Any] = None) -> pathlib.Path:
+    service = _get_service(service)
+
+    filepath = Path(in_file)
+    out_file = Path(out_dir).resolve() / output_name(filepath, to_format)
+    service.out_file = out_file
+    setattr(service, from_format, str(filepath.resolve()))
+    getattr(service, to_format)
+    logger.info(f"Created output file: {service.out_file.resolve()}")
+    return out_file
+
+
+def convert_formats(in_file: Union[str, pathlib.Path],
+                    out_dir: Union[str, pathlib.Path],
+                    from_format: Optional[str] = None,
+                    to_formats: Sequence[str] = (),
+                    service: Optional[Any] = None) -> List[pathlib.Path]:
+    """
+    Converts a document to each of the formats, in order.
+
+    With several formats the document is parsed once to pandoc's JSON AST,
+    which is then handed to the writer of every format. Filters run on the
+    AST for each format, as they may depend on it.
+    """
+    service = _get_service(service)
+    if len(to_formats) == 1 or from_format == 'json':
+        return [convert_member(in_file, out_dir, from_format, to_format, service) for to_format in to_formats]
+
+    ast_dir = mkdtemp(prefix='.ast-', dir=str(out_dir))
+    try:
+        service.unfiltered = True
+        try:
+            ast = convert_member(in_file, ast_dir, from_format, 'json', service)
+        finally:
+            service.unfiltered = False
+        return [convert_member(ast, out_dir, 'json', to_format, service) for to_format in to_formats]
+    finally:
+        shutil.rmtree(ast_dir, ignore_errors=True)
+
+
+def _file_digest(filepath: pathlib.Path) -> str:
+    digest = hashlib.sha256()
+    with filepath.open('rb') as fobj:
+        for chunk in iter(lambda: fobj.read(256 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _reuse(cached: pathlib.Path, out_file: pathlib.Path) -> bool:
+    try:
+        try:
+            os.link(str(cached), str(out_file))
+        except OSError:
+            shutil.copyfile(str(cached), str(out_file))
+    except OSError:
+        # evicted in the meantime
+        return False
+    return True
+
+
+def convert_document(in_file: Union[str, pathlib.Path],
+                     out_dir: Union[str, pathlib.Path],
+                     from_format: Optional[str] = None,
+                     to_formats: Sequence[str] = (),
+                     options: Optional[ConversionOptions] = None,
+                     service: Optional[Any] = None) -> List[pathlib.Path]:
+    """
+    Converts an archive member like `convert_formats`, reusing earlier outputs for the same content.
+
+    Outputs are cached by the member's content and the conversion settings,
+    so unchanged members of a re-uploaded archive are not converted again.
+    """
+    service = _get_service(service)
+    service.options = options
+    if _member_cache is None:
+        return convert_formats(in_file, out_dir, from_format, to_formats, service)
 
     in_file = Path(in_file)
-    out_file = None
+    digest = _file_digest(in_file)
+    keys = {
+        to_format: cache_key('member', digest, from_format, to_format, _settings,
+                             asdict(replace(options or ConversionOptions(), compression=None)),
+                             get_formats().version)
+        for to_format in to_formats
+    }
+
+    outputs = {}  # type: Dict[str, pathlib.Path]
+    for to_format, key in keys.items():
+        cached = _member_cache.get(key)
+        out_file = Path(out_dir) / output_name(in_file, to_format)
+        if cached is not None and _reuse(cached, out_file):
+            outputs[to_format] = out_file
+
+    missing = [to_format for to_format in to_formats if to_format not in outputs]
+    if missing:
+        for to_format, out_file in zip(missing, convert_formats(in_file, out_dir, from_format, missing, service)):
+            _member_cache.put(keys[to_format], out_file)
+            outputs[to_format] = out_file
+    ARCHIVE_MEMBERS.inc(result='rebuilt' if missing else 'reused')
+    return [outputs[to_format] for to_format in to_formats]
+
+
+def bundle(out_dir: Union[str, pathlib.Path], compression: str, codec: Optional[str] = None) -> pathlib.Path:
+    out_file = create_archive(Path(out_dir), compression=compression, codec=codec)
+    shutil.rmtree(Path(out_dir).resolve(), ignore_errors=True)
+    # only keep the archive in the dir the input was extracted to
+    for path in out_file.parent.iterdir():
+        if path == out_file:
+            continue
+        if path.is_dir():
+            shutil.rmtree(path.resolve(), ignore_errors=True)
+        else:
+            path.unlink()
+    return out_file
+
+
+def convert_inline(in_file: Union[str, pathlib.Path, bytes],
+                   from_format: Optional[str] = None,
+                   to_format: Optional[str] = None,
+                   options: Optional[ConversionOptions] = None,
+                   service: Optional[Any] = None) -> bytes:
+    """
+    Converts a single document to a text format, returns pandoc's output instead of writing a file.
+
+    The document is a file, or the document itself as bytes which is piped to
+    pandoc without touching the disk.
+    """
+    service = _get_service(service)
+    service.options = options
+
+    service.out_file = None
+    setattr(service, from_format, in_file if isinstance(in_file, bytes) else str(in_file))
+    output = getattr(service, to_format)
+    logger.info(f"Converted document from '{from_format}' to '{to_format}' in memory")
+    return output.encode('utf-8') if isinstance(output, str) else output
+
+
+def convert_batch(from_format: str,
+                  to_format: str,
+                  contents: Sequence[str],
+                  options: Optional[ConversionOptions] = None,
+                  service: Optional[Any] = None) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    Converts many small documents between the same formats, returns the output or the error of each.
+
+    The documents are piped to pandoc one after another, so a chunk of them
+    costs one task and no temp files. A conversion running out of time fails
+    the whole chunk. The documents are snippets, converted without
+    `--standalone` and the configured template unless the options ask for them.
+    """
+    service = _get_service(service)
+    service.set_options(options, fragment=True)
+    service.out_file = None
+
+    results = []  # type: List[Tuple[Optional[str], Optional[str]]]
+    for content in contents:
+        setattr(service, from_format, content.encode('utf-8'))
+        try:
+            output = getattr(service, to_format)
+        except ConversionTimeoutError:
+            raise
+        except Exception as err:
+            results.append((None, str(err)))
+        else:
+            results.append((output.decode('utf-8') if isinstance(output, bytes) else output, None))
+
+    logger.info(f"Converted {len(contents)} document(s) from '{from_format}' to '{to_format}' in a batch")
+    return results
+
+
+def convert_archive(filename: str,
+                    in_file: Union[str, pathlib.Path],
+                    from_format: Optional[str] = None,
+                    to_formats: Sequence[str] = (),
+                    options: Optional[ConversionOptions] = None,
+                    service: Optional[Any] = None) -> pathlib.Path:
+    """
+    Converts the documents in an archive one at a time into a new archive.
+
+    Every member is copied to a scratch dir, converted and appended to the
+    output archive before the next member is read, so next to the input and
+    output archives only a single document is on disk at any time.
+    """
+    service = _get_service(service)
+    service.options = options
+
+    in_file = Path(in_file)
+    members = archive_members(in_file)
+    work_dir = Path(mkdtemp(dir=str(in_file.parent.resolve())))
+    scratch_dir = Path(mkdtemp(dir=str(work_dir)))
+    codec = options.compression if options is not None else None
+    out_file = archive_path(work_dir / f"{filename}_converted", in_file.suffixes[-1], codec)
     converted_files = 0
     try:
-        archive = extract_archive(in_file)
-        archive_ext = "".join(archive.suffixes)
-        archive_stem = re.sub(f"{archive_ext}$", "", archive.name)
-
-        out_dir = Path(str(archive.parent.resolve() / archive_stem / filename) + '_converted')
-        out_dir.mkdir(mode=0o700)
-        for filepath in sorted(archive.glob("*/*.*")):
-            if filepath.is_dir():
-                continue
-            ext = "".join(filepath.suffixes)
-            stem = re.sub(f"{ext}$", "", filepath.name)
-            out_file = Path(str(out_dir.resolve()) + f"/{stem}.{to_format}")
-            service.out_file = out_file
-            setattr(service, from_format, str(filepath.resolve()))
-            getattr(service, to_format)
-            logger.info(f"Created output file: {service.out_file.resolve()}")
-            converted_files += 1
-
-        out_file = create_archive(out_dir, compression=in_file.suffixes[-1])
-        shutil.rmtree(out_dir.resolve(), ignore_errors=True)
-    except NotAnArchiveError:
-        logger.debug("Not an archive format, treating it as a file")
-        out_file = Path(str(in_file.parent.resolve()) + f"/{filename}.{to_format}")
+        with ArchiveWriter(out_file, in_file.suffixes[-1], codec) as writer:
+            for name, fobj in members:
+                with tracing.span('member', member=name):
+                    member = scratch_dir / 'in' / Path(name).name
+                    member.parent.mkdir(mode=0o700, exist_ok=True)
+                    with timed('extract'), member.open('wb') as member_fobj:
+                        shutil.copyfileobj(fobj, member_fobj)
+
+                    out_dir = scratch_dir / 'out'
+                    out_dir.mkdir(mode=0o700, exist_ok=True)
+                    for converted in convert_document(member, out_dir, from_format, to_formats, options, service):
+                        with timed('archive'):
+                            # compressed while the next members are converted
+                            writer.add(converted, arcname=f"{filename}_converted/{converted.name}", remove=True)
+                    member.unlink()
+                converted_files += 1
+    except BaseException:
+        members.close()
+        shutil.rmtree(str(work_dir), ignore_errors=True)
+        raise
+    finally:
+        shutil.rmtree(str(scratch_dir), ignore_errors=True)
+
+    logger.info(f"Converted {converted_files} document(s) from '{from_format}' to '{', '.join(to_formats)}'")
+    return out_file
+
+
+def convert_many(filename: str,
+                 in_file: Union[str, pathlib.Path],
+                 from_format: Optional[str] = None,
+                 to_formats: Sequence[str] = (),
+                 options: Optional[ConversionOptions] = None,
+                 service: Optional[Any] = None) -> pathlib.Path:
+    """
+    Converts a document or the documents in an archive to several formats at once.
+
+    The outputs are bundled in an archive, of the same type as the input or
+    a zip for single documents.
+    """
+    service = _get_service(service)
+    service.options = options
+
+    in_file = Path(in_file)
+    if is_archive(in_file):
+        return convert_archive(filename, in_file, from_format, to_formats, options, service)
+
+    work_dir = Path(mkdtemp(dir=str(in_file.parent.resolve())))
+    scratch_dir = Path(mkdtemp(dir=str(work_dir)))
+    out_file = archive_path(work_dir / filename, '.zip')
+    try:
+        outputs = convert_formats(in_file, scratch_dir, from_format, to_formats, service)
+        codec = options.compression if options is not None else None
+        with timed('archive'), ArchiveWriter(out_file, '.zip', codec) as writer:
+            for to_format, output in zip(to_formats, outputs):
+                writer.add(output, arcname=f"{filename}.{to_format}")
+    except BaseException:
+        shutil.rmtree(str(work_dir), ignore_errors=True)
+        raise
+    finally:
+        shutil.rmtree(str(scratch_dir), ignore_errors=True)
+
+    logger.info(f"Converted document from '{from_format}' to '{', '.join(to_formats)}'")
+    return out_file
+
+
+def convert(filename:  str,
+            in_file: Union[str, pathlib.Path],
+            from_format: Optional[str] = None,
+            to_format: Optional[str] = None,
+            options: Optional[ConversionOptions] = None,
+            service: Optional[Any] = None) -> Union[str, pathlib.Path]:
+
+    service = _get_service(service)
+    service.options = options
+
+    assert type(in_file) is str
+
+    in_file = Path(in_file)
+    if is_archive(in_file):
+        return convert_archive(filename, in_file, from_format, [to_format], options, service)
+
+    logger.debug("Not an archive format, treating it as a file")
+    # a dir per conversion, concurrent uploads may share a filename
+    out_dir = Path(mkdtemp(dir=str(in_file.parent.resolve())))
+    out_file = out_dir / f"{filename}.{to_format}"
+    try:
         service.out_file = out_file
         setattr(service, from_format, str(in_file))
         getattr(service, to_format)
-        converted_files += 1
-
-        logger.info(f"Converted document from '{from_format}' to '{to_format}'")
-    except (CreateArchiveError, ExtractArchiveError, AttributeError, RuntimeError, OSError) as err:
+    except BaseException:
+        shutil.rmtree(str(out_dir), ignore_errors=True)
         raise
-    else:
-        logger.info(f"Converted {converted_files} document(s) from '{from_format}' to '{to_format}'")
+
+    logger.info(f"Converted document from '{from_format}' to '{to_format}'")
     return out_file
@@ -31,7 +31,7 @@ setup(
     version=read_version(),
     description='pandocserver',
     platforms=['POSIX'],
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     package_data={
         '': ['config/*.*'],
         'templates': ['*.html']
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+STUB_PANDOC = Path(__file__).parent.parent / 'benchmarks' / 'stub' / 'pandoc'
+
+# set before pandocserver is imported: the stub pandoc, and the temp and cache dirs of this run
+TEST_DIR = tempfile.mkdtemp(prefix='pandocserver-tests-')
+os.environ['PYPANDOC_PANDOC'] = str(STUB_PANDOC)
+os.environ['PANDOC_TEMP_DIR'] = os.path.join(TEST_DIR, 'tmp')
+os.environ['XDG_CACHE_HOME'] = os.path.join(TEST_DIR, 'cache')
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def test_filters(monkeypatch) -> None:
+    """Puts the filters of the tests on the PATH, before the workers are started."""
+    bin_dir = Path(__file__).parent / 'bin'
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+@pytest.fixture
+def stub_pandoc() -> Path:
+    return STUB_PANDOC
+
+
+@pytest.fixture
+def temp_dir() -> Path:
+    """The temp dir results are created in, as set up by the executors."""
+    from pandocserver.worker import DEFAULT_TEMP_DIR
+
+    path = Path(DEFAULT_TEMP_DIR)
+    path.mkdir(mode=0o700, exist_ok=True)
+    yield path
+    shutil.rmtree(str(path), ignore_errors=True)
@@ -0,0 +1,158 @@
+import asyncio
+import time
+
+import pytest
+
+from pandocserver.admission import CHEAP, EXPENSIVE, AdmissionController, OverloadedError
+
+from .utils import form, make_config, serve, tarball
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def hold(admission, order, name, cost=CHEAP, client='', seconds=0.01):
+    with await admission.slot(True, cost, client):
+        order.append(name)
+        await asyncio.sleep(seconds)
+
+
+def test_bounds():
+    async def main():
+        admission = AdmissionController(2, max_queued=1)
+        await admission.acquire()
+        await admission.acquire()
+        waiter = asyncio.ensure_future(admission.acquire())
+        await asyncio.sleep(0)
+        assert (admission.in_flight, admission.queued) == (2, 1)
+        with pytest.raises(OverloadedError) as err:
+            await admission.acquire()
+        assert err.value.retry_after >= 1
+        # blocking callers ignore the queue bound
+        blocked = asyncio.ensure_future(admission.acquire(block=True))
+        await asyncio.sleep(0)
+        admission.release()
+        await waiter
+        admission.release()
+        await blocked
+        assert (admission.in_flight, admission.queued, admission.rejected) == (2, 0, 1)
+
+    run(main())
+
+
+def test_cancelled_waiter():
+    async def main():
+        admission = AdmissionController(1)
+        await admission.acquire()
+        waiter = asyncio.ensure_future(admission.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert admission.queued == 0
+        admission.release()
+        assert admission.in_flight == 0
+
+    run(main())
+
+
+def test_clients_round_robin():
+    async def main():
+        admission = AdmissionController(1)
+        order = []
+        first = asyncio.ensure_future(hold(admission, order, 'a0', client='a'))
+        await asyncio.sleep(0)
+        tasks = [asyncio.ensure_future(hold(admission, order, f'a{i}', client='a')) for i in range(1, 4)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(hold(admission, order, 'b0', client='b')))
+        await asyncio.gather(first, *tasks)
+        return order
+
+    # the client queueing later is not served after all of the other's conversions
+    assert run(main()) == ['a0', 'a1', 'b0', 'a2', 'a3']
+
+
+def test_class_weights():
+    async def main():
+        admission = AdmissionController(1, weights={CHEAP: 2, EXPENSIVE: 1})
+        order = []
+        first = asyncio.ensure_future(hold(admission, order, 'first'))
+        await asyncio.sleep(0)
+        tasks = [asyncio.ensure_future(hold(admission, order, cost, cost=cost))
+                 for cost in [EXPENSIVE] * 3 + [CHEAP] * 6]
+        await asyncio.gather(first, *tasks)
+        return order[1:]
+
+    order = run(main())
+    # two cheap conversions for every expensive one
+    assert order[:6].count(CHEAP) == 4 and order[:6].count(EXPENSIVE) == 2
+
+
+def test_reserved():
+    async def main():
+        admission = AdmissionController(2, reserved=1)
+        await admission.acquire(cost=EXPENSIVE)
+        expensive = asyncio.ensure_future(admission.acquire(cost=EXPENSIVE))
+        await asyncio.sleep(0)
+        # the reserved slot only takes cheap conversions
+        assert admission.queued == 1
+        await admission.acquire(cost=CHEAP)
+        assert admission.in_flight == 2
+        admission.release(EXPENSIVE)
+        await expensive
+        admission.release(EXPENSIVE)
+        admission.release(CHEAP)
+        return admission.stats()
+
+    stats = run(main())
+    assert stats['in_flight'] == 0 and stats['reserved'] == 1
+
+
+def test_fan_out_charged(monkeypatch):
+    # members converted at the same time take a slot each, bounded by max_in_flight as other conversions
+    monkeypatch.setenv('PANDOC_STUB_DELAY', '0.3')
+    conf = make_config(workers={'max_workers': 2, 'max_in_flight': 1, 'fan_out': True, 'fan_out_limit': 4})
+    docs = {f'chapter{i}.md': b'# Chapter\n' for i in range(4)}
+
+    async def main():
+        async with serve(conf) as client:
+            admission = client.server.app['admission']
+            peak = 0
+
+            async def watch():
+                nonlocal peak
+                while True:
+                    peak = max(peak, admission.in_flight)
+                    await asyncio.sleep(0.01)
+
+            watcher = asyncio.ensure_future(watch())
+            start = time.monotonic()
+            response = await client.post('/convert', data=form(tarball(docs), filename='docs.tar.gz'))
+            elapsed = time.monotonic() - start
+            watcher.cancel()
+            assert response.status == 200
+            return peak, elapsed
+
+    peak, elapsed = run(main())
+    assert peak == 1
+    # one member after the other, not the four at once the pool could run
+    assert elapsed >= 4 * 0.3
+
+
+def test_overloaded(monkeypatch):
+    monkeypatch.setenv('PANDOC_STUB_DELAY', '0.5')
+    conf = make_config(workers={'max_workers': 1, 'max_in_flight': 1, 'max_queued': 0})
+
+    async def main():
+        async with serve(conf) as client:
+            running = asyncio.ensure_future(client.post('/convert', data=form(b'# Running')))
+            await asyncio.sleep(0.2)
+            rejected = await client.post('/convert', data=form(b'# Rejected'))
+            stats = await (await client.get('/stats')).json()
+            return (await running).status, rejected, stats['workers']
+
+    status, rejected, stats = run(main())
+    assert status == 200
+    assert rejected.status == 503
+    assert int(rejected.headers['Retry-After']) >= 1
+    assert stats['max_in_flight'] == 1 and stats['rejected'] == 1
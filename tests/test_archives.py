@@ -0,0 +1,61 @@
+import asyncio
+import io
+import zipfile
+
+from pandocserver import worker
+from pandocserver.services import PandocService
+
+from .utils import form, leftovers, make_config, read_tarball, serve, tarball
+
+DOCS = {f'chapter{i}.md': f'# Chapter {i}\n'.encode() for i in range(3)}
+
+
+def test_member_by_member(monkeypatch, tmp_path):
+    archive = tmp_path / 'docs.tar.gz'
+    archive.write_bytes(tarball(DOCS))
+    on_disk = []
+    convert_document = worker.convert_document
+
+    def counted(member, *args):
+        on_disk.append(sorted(path.name for path in member.parent.iterdir()))
+        return convert_document(member, *args)
+
+    monkeypatch.setattr(worker, 'convert_document', counted)
+    output = worker.convert('docs', str(archive), 'markdown', 'html', service=PandocService())
+
+    assert output.name == 'docs_converted.tar.gz'
+    assert read_tarball(output.read_bytes()) == {f'chapter{i}.html': f'# Chapter {i}\n'.encode() for i in range(3)}
+    # one document at a time, the scratch dir is gone
+    assert on_disk == [[f'chapter{i}.md'] for i in range(3)]
+    assert sorted(path.name for path in output.parent.iterdir()) == ['docs_converted.tar.gz']
+
+
+def test_zip():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in DOCS.items():
+            archive.writestr(f'docs/{name}', data)
+
+    async def main():
+        async with serve(make_config()) as client:
+            response = await client.post('/convert', data=form(buffer.getvalue(), filename='docs.zip'))
+            assert response.status == 200
+            return await response.read(), await leftovers()
+
+    body, left = asyncio.run(main())
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert sorted(archive.namelist()) == [f'docs_converted/chapter{i}.html' for i in range(3)]
+    assert left == []
+
+
+def test_failing_member():
+    docs = dict(DOCS, **{'broken.md': b'PANDOC_STUB_FAIL'})
+
+    async def main():
+        async with serve(make_config()) as client:
+            response = await client.post('/convert', data=form(tarball(docs), filename='docs.tar.gz'))
+            return response.status, await leftovers()
+
+    status, left = asyncio.run(main())
+    assert status == 500
+    assert left == []
@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+import pytest
+
+from pandocserver.batch import BatchError, BatchItem, InvalidBatchError, chunk_items, parse_batch
+from pandocserver.options import ConversionOptions
+from pandocserver.services import PandocService
+from pandocserver.worker import convert_batch
+
+from .utils import make_config, serve
+
+TEMPLATE = '/srv/templates/page.html'
+
+
+def item(item_id, content='# Title', from_format='markdown', to_format='html'):
+    return {'id': item_id, 'from': from_format, 'to': to_format, 'content': content}
+
+
+def test_parse_array_and_ndjson():
+    items = [item(1), item('two', to_format='rst')]
+    expected = [BatchItem(1, 'markdown', 'html', '# Title'), BatchItem('two', 'markdown', 'rst', '# Title')]
+    assert parse_batch(json.dumps(items).encode(), 10, 100) == expected
+    ndjson = '\n'.join(json.dumps(i) for i in items) + '\n\n'
+    assert parse_batch(ndjson.encode(), 10, 100) == expected
+
+
+def test_parse_errors():
+    parsed = parse_batch(json.dumps([item(True), item(2, from_format='nope'), item(3, to_format='docx'),
+                                     item(4, content=None), item(5, content='x' * 11), 'text']).encode(), 10, 10)
+    assert all(isinstance(result, BatchError) for result in parsed)
+    assert [result.id for result in parsed] == [True, 2, 3, 4, 5, None]
+
+    with pytest.raises(InvalidBatchError):
+        parse_batch(b'{"id": 1', 10, 10)
+    with pytest.raises(InvalidBatchError):
+        parse_batch(json.dumps([item(i) for i in range(3)]).encode(), 2, 10)
+
+
+def test_chunk_items():
+    items = [BatchItem(i, 'markdown', 'html' if i % 2 else 'rst', '') for i in range(5)]
+    chunks = [(formats, [i.id for i in chunk]) for formats, chunk in chunk_items(items, 2)]
+    assert chunks == [(('markdown', 'rst'), [0, 2]), (('markdown', 'rst'), [4]), (('markdown', 'html'), [1, 3])]
+
+
+def test_snippets_are_fragments():
+    service = PandocService(template=TEMPLATE)
+    assert convert_batch('markdown', 'html', ['one', 'two'], service=service) == [('one', None), ('two', None)]
+    assert '--standalone' not in service.extra_args
+    assert f'--template={TEMPLATE}' not in service.extra_args
+
+    # documents still get both
+    service.options = None
+    assert service.extra_args == ('--standalone', f'--template={TEMPLATE}')
+
+
+@pytest.mark.parametrize('options', [ConversionOptions(standalone=True), ConversionOptions(template=TEMPLATE)])
+def test_standalone_snippets(options):
+    service = PandocService()
+    convert_batch('markdown', 'html', ['one'], options, service=service)
+    assert '--standalone' in service.extra_args
+
+
+def test_batch():
+    items = [item(1, 'one'), item(2, 'two', to_format='rst'), item(3, from_format='nope')]
+
+    async def main():
+        async with serve(make_config()) as client:
+            response = await client.post('/batch?standalone=true', data='\n'.join(json.dumps(i) for i in items))
+            assert response.status == 200
+            assert response.headers['Content-Type'] == 'application/x-ndjson'
+            lines = (await response.text()).splitlines()
+            bad = await client.post('/batch?standalone=maybe', data=json.dumps(items))
+            assert bad.status == 400
+            return [json.loads(line) for line in lines]
+
+    results = sorted(asyncio.run(main()), key=lambda result: result['id'])
+    assert results[0] == {'id': 1, 'output': 'one'}
+    assert results[1] == {'id': 2, 'output': 'two'}
+    assert 'error' in results[2]
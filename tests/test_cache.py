@@ -0,0 +1,129 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from pandocserver.cache import ResultCache, cache_key
+
+from .utils import form, make_config, read_tarball, serve, tarball
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(tmp_path / 'cache', max_size=1000)
+
+
+def age(cache, key, seconds):
+    """Makes an entry look last used `seconds` ago."""
+    entry = cache._entry(key)
+    atime = time.time() - seconds
+    os.utime(str(entry), (atime, atime))
+
+
+def test_cache_key():
+    assert cache_key('a', {'x': 1, 'y': 2}) == cache_key('a', {'y': 2, 'x': 1})
+    assert cache_key('a') != cache_key('b')
+
+
+def test_put_get(cache, tmp_path):
+    source = tmp_path / 'doc.html'
+    source.write_text('converted')
+    key = cache_key('doc')
+
+    assert cache.get(key) is None
+    cached = cache.put(key, source)
+    assert cached.name == 'doc.html'
+    assert cached.read_text() == 'converted'
+    # the cache has its own copy
+    source.unlink()
+    assert cache.get(key).read_text() == 'converted'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_put_bytes(cache):
+    key = cache_key('doc')
+    assert cache.put_bytes(key, 'doc.html', b'converted').read_bytes() == b'converted'
+    assert cache.get_path(key).read_bytes() == b'converted'
+    # get_path is no lookup
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_put_twice(cache):
+    key = cache_key('doc')
+    cache.put_bytes(key, 'doc.html', b'x' * 100)
+    cache.put_bytes(key, 'doc.html', b'x' * 100)
+    assert cache._read_total() == 100
+    assert cache.stats()['entries'] == 1
+
+
+def test_too_large(cache):
+    assert cache.put_bytes(cache_key('doc'), 'doc.html', b'x' * 1001) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_size_file(cache):
+    for i in range(5):
+        cache.put_bytes(cache_key(i), 'doc.html', b'x' * 100)
+    assert cache._read_total() == 500 == cache.stats()['size']
+
+
+def test_size_file_missing(cache):
+    for i in range(3):
+        cache.put_bytes(cache_key(i), 'doc.html', b'x' * 100)
+    (cache.path / cache.SIZE_FILE).unlink()
+    # a cache dir without a size file is scanned once
+    cache.put_bytes(cache_key(3), 'doc.html', b'x' * 100)
+    assert cache._read_total() == 400
+
+
+def test_evicts_least_recently_used(cache):
+    keys = [cache_key(i) for i in range(10)]
+    for i, key in enumerate(keys):
+        cache.put_bytes(key, 'doc.html', b'x' * 100)
+        age(cache, key, 100 - i)
+    # used last, evicted last
+    cache.get(keys[0])
+
+    cache.put_bytes(cache_key('new'), 'doc.html', b'x' * 100)
+    # evicted down to the low water mark
+    assert cache._read_total() == 900 == cache.stats()['size']
+    assert cache.get_path(keys[0]) is not None
+    assert cache.get_path(keys[1]) is None
+    assert cache.get_path(keys[2]) is None
+    assert all(cache.get_path(key) is not None for key in keys[3:])
+    assert cache.get_path(cache_key('new')) is not None
+
+
+def test_shared_dir(cache):
+    # another server using the same cache dir
+    other = ResultCache(cache.path, max_size=1000)
+    cache.put_bytes(cache_key('doc'), 'doc.html', b'x' * 100)
+    assert other.get(cache_key('doc')).read_bytes() == b'x' * 100
+    other.put_bytes(cache_key('other'), 'doc.html', b'x' * 100)
+    assert cache._read_total() == 200
+
+
+def test_members_reused(tmp_path):
+    docs = {f'chapter{i}.md': f'# Chapter {i}\n'.encode() for i in range(4)}
+    changed = dict(docs, **{'chapter0.md': b'# Changed\n', 'chapter4.md': b'# New\n'})
+    conf = make_config(cache={'path': str(tmp_path / 'cache')})
+
+    async def main():
+        async with serve(conf) as client:
+            results = []
+            for files in (docs, changed, changed):
+                response = await client.post('/convert', data=form(tarball(files), filename='docs.tar.gz'))
+                assert response.status == 200
+                headers = response.headers
+                results.append((headers['X-Cache'], headers.get('X-Members-Reused'),
+                                headers.get('X-Members-Rebuilt'), read_tarball(await response.read())))
+            return results
+
+    first, second, third = asyncio.run(main())
+    assert first[:3] == ('MISS', '0', '4')
+    assert second[:3] == ('MISS', '3', '2')
+    assert second[3] == {name.replace('.md', '.html'): data for name, data in changed.items()}
+    # the result itself is cached
+    assert third[:3] == ('HIT', None, None)
+    assert third[3] == second[3]
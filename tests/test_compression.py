@@ -0,0 +1,232 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import random
+import tarfile
+import zipfile
+
+import pytest
+
+from pandocserver import compression
+from pandocserver.compression import BlockWriter, CompressionError, ZipWriter, available_codecs
+
+
+def _zstd_decompress(data):
+    import zstandard
+    return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True).read()
+
+
+def _lz4_decompress(data):
+    import lz4.frame
+    return lz4.frame.open(io.BytesIO(data)).read()
+
+
+DECOMPRESS = {
+    'store': lambda data: data,
+    'gzip': gzip.decompress,
+    'bzip2': bz2.decompress,
+    'xz': lzma.decompress,
+    'zstd': _zstd_decompress,
+    'lz4': _lz4_decompress,
+}
+
+CODECS = [pytest.param(codec, marks=pytest.mark.skipif(codec not in available_codecs(),
+                                                       reason=f'{codec} is not installed'))
+          for codec in DECOMPRESS]
+
+
+def document(size, seed=0):
+    """Compressible bytes which differ from block to block."""
+    rand = random.Random(seed)
+    words = [bytes(rand.choice(b'abcdefghij') for _ in range(rand.randint(2, 8))) for _ in range(200)]
+    data = bytearray()
+    while len(data) < size:
+        data += rand.choice(words) + b' '
+    return bytes(data[:size])
+
+
+@pytest.fixture(autouse=True)
+def threads():
+    compression.set_threads(2)
+    yield
+    compression.set_threads(None)
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    for codec in compression.BLOCK_SIZES:
+        monkeypatch.setitem(compression.BLOCK_SIZES, codec, 1000)
+
+
+def block_compress(codec, *chunks):
+    out = io.BytesIO()
+    writer = BlockWriter(out, codec)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_block_writer(codec):
+    data = document(10000)
+    assert DECOMPRESS[codec](block_compress(codec, data)) == data
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_block_writer_blocks(codec, small_blocks):
+    # many blocks, written in pieces not aligned to them, more than the threads keep pending
+    data = document(50000)
+    chunks = [data[i:i + 777] for i in range(0, len(data), 777)]
+    assert DECOMPRESS[codec](block_compress(codec, *chunks)) == data
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_block_writer_empty(codec):
+    assert DECOMPRESS[codec](block_compress(codec)) == b''
+
+
+def test_gzip_trailer(small_blocks):
+    data = document(5000)
+    compressed = block_compress('gzip', data)
+    # a single member, its trailer checked by the gzip module
+    with gzip.GzipFile(fileobj=io.BytesIO(compressed)) as fobj:
+        assert fobj.read() == data
+    corrupted = compressed[:-8] + b'\0\0\0\0' + compressed[-4:]
+    with pytest.raises(gzip.BadGzipFile):
+        gzip.decompress(corrupted)
+
+
+@pytest.mark.parametrize('codec,mode', [('gzip', 'r:gz'), ('bzip2', 'r:bz2'), ('xz', 'r:xz')])
+def test_tar(codec, mode, small_blocks, tmp_path):
+    names = {f'chapter{i}.html': document(3000, seed=i) for i in range(5)}
+    for name, data in names.items():
+        (tmp_path / name).write_bytes(data)
+    archive = tmp_path / 'docs.tar'
+    with archive.open('wb') as fobj:
+        writer = BlockWriter(fobj, codec)
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            for name in names:
+                tar.add(str(tmp_path / name), arcname=name)
+        writer.close()
+
+    with tarfile.open(str(archive), mode) as tar:
+        assert {member.name: tar.extractfile(member).read() for member in tar} == names
+
+
+def write_zip(path, files, codec='gzip', remove=False):
+    writer = ZipWriter(path / 'out.zip', codec)
+    for name in files:
+        writer.add(path / name, name, remove=remove)
+    writer.close()
+    return path / 'out.zip'
+
+
+def make_files(path, count, size):
+    files = {}
+    for i in range(count):
+        name = f'doc{i}.html'
+        files[name] = document(size, seed=i)
+        (path / name).write_bytes(files[name])
+    return files
+
+
+def read_zip(archive):
+    with zipfile.ZipFile(str(archive)) as zf:
+        assert zf.testzip() is None
+        return {info.filename: zf.read(info) for info in zf.infolist()}
+
+
+@pytest.mark.parametrize('codec', ['store', 'gzip', 'bzip2'])
+def test_zip(codec, tmp_path):
+    files = make_files(tmp_path, 5, 20000)
+    archive = write_zip(tmp_path, files, codec)
+    assert read_zip(archive) == files
+    with zipfile.ZipFile(str(archive)) as zf:
+        assert {info.compress_type for info in zf.infolist()} == {compression.CODECS[codec].zip_method}
+    assert b'PK\x06\x06' not in archive.read_bytes()
+
+
+def test_zip_order_and_names(tmp_path):
+    files = make_files(tmp_path, 12, 1000)
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'übersicht.html').write_bytes(b'unicode')
+    writer = ZipWriter(tmp_path / 'out.zip')
+    for name in files:
+        writer.add(tmp_path / name, name)
+    writer.add(tmp_path / 'sub' / 'übersicht.html', 'sub/übersicht.html')
+    writer.close()
+    with zipfile.ZipFile(str(tmp_path / 'out.zip')) as zf:
+        assert zf.namelist() == list(files) + ['sub/übersicht.html']
+        assert zf.read('sub/übersicht.html') == b'unicode'
+
+
+def test_zip_remove(tmp_path):
+    files = make_files(tmp_path, 3, 1000)
+    archive = write_zip(tmp_path, files, remove=True)
+    assert read_zip(archive) == files
+    assert not any((tmp_path / name).exists() for name in files)
+
+
+def test_zip_unsupported(tmp_path):
+    with pytest.raises(CompressionError):
+        ZipWriter(tmp_path / 'out.zip', 'xz')
+
+
+def test_zip_missing_file(tmp_path):
+    writer = ZipWriter(tmp_path / 'out.zip')
+    writer.add(tmp_path / 'missing.html', 'missing.html')
+    with pytest.raises(FileNotFoundError):
+        writer.close()
+
+
+def test_zip64_sizes(monkeypatch, tmp_path):
+    # sizes and offsets beyond 4 GiB, scaled down
+    monkeypatch.setattr(compression, 'ZIP64_LIMIT', 1000)
+    files = make_files(tmp_path, 4, 2000)
+    files['small.html'] = b'small'
+    (tmp_path / 'small.html').write_bytes(b'small')
+
+    archive = write_zip(tmp_path, files, 'store')
+    data = archive.read_bytes()
+    # the local headers, the central directory and its end need ZIP64 records
+    assert data.count(b'PK\x03\x04') == 5
+    assert b'PK\x06\x06' in data and b'PK\x06\x07' in data
+    assert read_zip(archive) == files
+    with zipfile.ZipFile(str(archive)) as zf:
+        offsets = [info.header_offset for info in zf.infolist()]
+    assert offsets == sorted(offsets) and offsets[-1] > 1000
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'bzip2'])
+def test_zip64_compressed(codec, monkeypatch, tmp_path):
+    monkeypatch.setattr(compression, 'ZIP64_LIMIT', 1000)
+    files = make_files(tmp_path, 3, 20000)
+    assert read_zip(write_zip(tmp_path, files, codec)) == files
+
+
+def test_zip64_entries(monkeypatch, tmp_path):
+    # more than 65535 entries, scaled down
+    monkeypatch.setattr(compression, 'ZIP_MAX_ENTRIES', 10)
+    files = make_files(tmp_path, 25, 100)
+    archive = write_zip(tmp_path, files)
+    data = archive.read_bytes()
+    assert b'PK\x06\x06' in data
+    # the end of the central directory points at the ZIP64 record for the count
+    assert data[-22:].startswith(b'PK\x05\x06')
+    assert int.from_bytes(data[-12:-10], 'little') == 0xffff
+    assert read_zip(archive) == files
+
+
+def test_zip64_unzip(monkeypatch, tmp_path):
+    if not any(os.access(os.path.join(p, 'unzip'), os.X_OK) for p in os.environ['PATH'].split(os.pathsep)):
+        pytest.skip('unzip is not installed')
+    import subprocess
+
+    monkeypatch.setattr(compression, 'ZIP64_LIMIT', 1000)
+    monkeypatch.setattr(compression, 'ZIP_MAX_ENTRIES', 2)
+    files = make_files(tmp_path, 4, 2000)
+    archive = write_zip(tmp_path, files, 'bzip2')
+    subprocess.run(['unzip', '-tq', str(archive)], check=True, stdout=subprocess.DEVNULL)
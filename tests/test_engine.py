@@ -0,0 +1,85 @@
+from pathlib import Path
+
+import pytest
+
+from pandocserver.services import EngineUnavailableError, PandocServerEngine, PandocService
+
+
+@pytest.fixture
+def engine(stub_pandoc):
+    engine = PandocServerEngine(command=f'{stub_pandoc} server', timeout=10)
+    yield engine
+    engine.stop()
+
+
+def test_convert_bytes(engine):
+    assert engine.convert(b'# Title', to='html', format='markdown', extra_args=()) == '# Title'
+    assert engine.running
+
+
+def test_convert_file(engine, tmp_path):
+    source = tmp_path / 'doc.md'
+    source.write_text('# Title')
+    out = tmp_path / 'doc.html'
+    assert engine.convert(str(source), to='html', format='markdown', extra_args=(), outputfile=str(out)) == ''
+    assert out.read_text() == '# Title'
+
+
+def test_reuses_server(engine):
+    engine.convert(b'one', to='html', format='markdown', extra_args=())
+    process = engine._process
+    engine.convert(b'two', to='html', format='markdown', extra_args=())
+    assert engine._process is process
+
+
+def test_restarts_server(engine):
+    engine.convert(b'one', to='html', format='markdown', extra_args=())
+    engine._process.kill()
+    engine._process.wait()
+    assert engine.convert(b'two', to='html', format='markdown', extra_args=()) == 'two'
+
+
+def test_conversion_error(engine):
+    with pytest.raises(RuntimeError, match='stub failure'):
+        engine.convert(b'PANDOC_STUB_FAIL', to='html', format='markdown', extra_args=())
+    # the server keeps serving
+    assert engine.convert(b'ok', to='html', format='markdown', extra_args=()) == 'ok'
+
+
+def test_unavailable():
+    engine = PandocServerEngine(command='/nonexistent/pandoc server')
+    with pytest.raises(EngineUnavailableError):
+        engine.convert(b'text', to='html', format='markdown', extra_args=())
+
+
+def test_parse_arguments():
+    params = PandocServerEngine._parse_arguments(
+        ['--standalone', '--toc', '--toc-depth=2', '--wrap=none', '--log=/tmp/log'])
+    assert params == {'standalone': True, 'table-of-contents': True, 'toc-depth': 2, 'wrap': 'none'}
+    assert PandocServerEngine._parse_arguments(['--filter=pandoc-citeproc']) is None
+    assert PandocServerEngine._parse_arguments(['--metadata=title:x']) is None
+
+
+def test_supports(engine):
+    assert engine.supports('html', ['--standalone'])
+    assert not engine.supports('pdf', ['--standalone'])
+    assert not engine.supports('html', ['--lua-filter=x.lua'])
+
+
+def test_service_uses_engine(engine, tmp_path):
+    service = PandocService(engine=engine)
+    service.markdown = b'# Title'
+    assert service.html == '# Title'
+    assert engine.running
+
+
+def test_service_falls_back(tmp_path):
+    # a server which can not start, conversions run the stub pandoc instead
+    engine = PandocServerEngine(command='/nonexistent/pandoc server')
+    service = PandocService(engine=engine)
+    source = tmp_path / 'doc.md'
+    source.write_text('# Title')
+    service.out_file = tmp_path / 'doc.html'
+    service.markdown = str(source)
+    service.html
+    assert Path(service.out_file).read_text() == '# Title'
@@ -0,0 +1,66 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from pandocserver.options import ConversionOptions
+from pandocserver.views import SiteHandler
+from pandocserver.worker import DEFAULT_TEMP_DIR
+
+from .utils import form, leftovers, make_config, read_tarball, serve, tarball
+
+DOCS = {f'chapter{i}.md': f'# Chapter {i}\n'.encode() for i in range(4)}
+
+
+def fan_out_config(**workers):
+    return make_config(workers=dict({'fan_out': True, 'max_workers': 2}, **workers))
+
+
+def test_fan_out():
+    async def main():
+        async with serve(fan_out_config(fan_out_limit=2)) as client:
+            response = await client.post('/convert', data=form(tarball(DOCS), filename='docs.tar.gz'))
+            assert response.status == 200
+            return read_tarball(await response.read()), await leftovers()
+
+    members, left = asyncio.run(main())
+    assert members == {f'chapter{i}.html': f'# Chapter {i}\n'.encode() for i in range(4)}
+    assert left == []
+
+
+def test_failing_member():
+    docs = dict(DOCS, **{'broken.md': b'PANDOC_STUB_FAIL'})
+
+    async def main():
+        async with serve(fan_out_config()) as client:
+            response = await client.post('/convert', data=form(tarball(docs), filename='docs.tar.gz'))
+            return response.status, await response.text(), await leftovers()
+
+    status, text, left = asyncio.run(main())
+    assert status == 500
+    assert 'broken.md' in text and 'chapter0.md' not in text
+    # neither the extracted members nor the converted ones are left behind
+    assert left == []
+
+
+def test_cancelled(monkeypatch, tmp_path):
+    monkeypatch.setenv('PANDOC_STUB_DELAY', '0.3')
+    conf = fan_out_config()
+
+    async def main():
+        async with serve(conf) as client:
+            executor = client.server.app['executor']
+            archive = Path(DEFAULT_TEMP_DIR) / 'upload.tar.gz'
+            archive.write_bytes(tarball(DOCS))
+            task = asyncio.ensure_future(SiteHandler(conf, executor)._convert(
+                executor, 'docs', str(archive), 'markdown', 'html', ConversionOptions()))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            archive.unlink()
+            # the members in flight finish, or fail without their output dir
+            await asyncio.sleep(0.5)
+            return await leftovers()
+
+    assert asyncio.run(main()) == []
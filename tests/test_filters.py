@@ -0,0 +1,51 @@
+import asyncio
+import io
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from pandocserver.filters import FilterError, FilterPipeline
+
+from .utils import form, make_config, serve
+
+pytestmark = pytest.mark.usefixtures('test_filters')
+
+
+def test_pipeline():
+    pipeline = FilterPipeline(['stamp-format', 'stamp-format'])
+    pipeline.load()
+    assert pipeline.run('doc\n', 'html') == 'doc\n[html]\n[html]\n'
+
+
+def test_pipeline_error():
+    pipeline = FilterPipeline(['false'])
+    with pytest.raises(FilterError):
+        pipeline.run('doc\n', 'html')
+
+
+def convert(to, in_process=True):
+    async def main():
+        conf = make_config(filters={'python': ['stamp-format'], 'in_process': in_process})
+        async with serve(conf) as client:
+            response = await client.post('/convert', data=form(b'doc\n', to=to))
+            assert response.status == 200, await response.text()
+            return await response.read()
+
+    return asyncio.run(main())
+
+
+def test_single_format():
+    assert convert('html') == b'doc\n[html]\n'
+
+
+def test_several_formats():
+    # the filters run for every format on the AST parsed once, as for each format on its own
+    with zipfile.ZipFile(io.BytesIO(convert('html,latex,json'))) as zf:
+        outputs = {Path(name).name: zf.read(name) for name in zf.namelist()}
+    assert outputs == {'doc.html': b'doc\n[html]\n', 'doc.latex': b'doc\n[latex]\n', 'doc.json': b'doc\n[json]\n'}
+
+
+def test_not_in_process():
+    # handed to pandoc as a `--filter`, which the stub ignores
+    assert convert('html', in_process=False) == b'doc\n'
@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+
+from pandocserver.flights import Flights
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def result_file(temp_dir, name='doc.html'):
+    path = temp_dir / name
+    path.write_text('converted')
+    return path
+
+
+def test_coalesces(temp_dir):
+    flights = Flights()
+    calls = []
+    output = result_file(temp_dir)
+
+    async def convert():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return output, False
+
+    async def main():
+        return await asyncio.gather(*(flights.run('key', convert) for _ in range(3)))
+
+    results = run(main())
+    assert len(calls) == 1
+    assert [shared for _, shared in results] == [False, True, True]
+    assert all(result == (output, False) for result, _ in results)
+    assert flights.stats() == {'in_flight': 0, 'coalesced': 2, 'shared_results': 1}
+
+    # the file is removed with the last reference
+    flights.release(output)
+    flights.release(output)
+    assert output.exists()
+    flights.release(output)
+    assert not output.exists()
+    assert flights.stats()['shared_results'] == 0
+
+
+def test_different_keys(temp_dir):
+    flights = Flights()
+    calls = []
+
+    async def convert(name):
+        calls.append(name)
+        await asyncio.sleep(0.01)
+        return name, False
+
+    async def main():
+        return await asyncio.gather(flights.run('a', lambda: convert('a')), flights.run('b', lambda: convert('b')))
+
+    assert run(main()) == [(('a', False), False), (('b', False), False)]
+    assert calls == ['a', 'b']
+
+
+def test_single_caller(temp_dir):
+    flights = Flights()
+    output = result_file(temp_dir)
+
+    async def convert():
+        return output, False
+
+    run(flights.run('key', convert))
+    assert flights.stats()['shared_results'] == 0
+    flights.release(output)
+    assert not output.exists()
+
+
+def test_cached_results_are_kept(temp_dir):
+    flights = Flights()
+    output = result_file(temp_dir)
+
+    async def convert():
+        await asyncio.sleep(0.01)
+        return output, True
+
+    async def main():
+        return await asyncio.gather(flights.run('key', convert), flights.run('key', convert))
+
+    run(main())
+    assert flights.stats()['shared_results'] == 0
+    assert output.exists()
+
+
+def test_errors_reach_all_callers():
+    flights = Flights()
+
+    async def convert():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('failed')
+
+    async def main():
+        return await asyncio.gather(flights.run('key', convert), flights.run('key', convert),
+                                    return_exceptions=True)
+
+    results = run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert 'key' not in flights
+
+
+def test_cancelled_caller(temp_dir):
+    flights = Flights()
+    output = result_file(temp_dir)
+    started = []
+
+    async def convert():
+        started.append(1)
+        await asyncio.sleep(0.05)
+        return output, False
+
+    async def main():
+        first = asyncio.ensure_future(flights.run('key', convert))
+        second = asyncio.ensure_future(flights.run('key', convert))
+        await asyncio.sleep(0.01)
+        # one caller going away does not cancel the conversion of the other
+        second.cancel()
+        return await first, second
+
+    (result, shared), second = run(main())
+    assert second.cancelled()
+    assert result == (output, False)
+    assert len(started) == 1
+    # the remaining caller holds the only reference
+    flights.release(output)
+    assert not output.exists()
+
+
+def test_all_callers_gone(temp_dir):
+    flights = Flights()
+    output = result_file(temp_dir)
+
+    async def convert():
+        await asyncio.sleep(0.02)
+        return output, False
+
+    async def main():
+        caller = asyncio.ensure_future(flights.run('key', convert))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        # the conversion still finishes and removes its unused result
+        await asyncio.sleep(0.05)
+
+    run(main())
+    assert not output.exists()
+    assert 'key' not in flights
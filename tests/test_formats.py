@@ -0,0 +1,57 @@
+import asyncio
+import io
+import zipfile
+
+from aiohttp import FormData
+
+from .utils import form, leftovers, make_config, read_tarball, serve, tarball
+
+
+def convert(data, **kwargs):
+    async def main():
+        async with serve(make_config()) as client:
+            response = await client.post('/convert', data=data, **kwargs)
+            assert response.status == 200
+            return response.headers, await response.read(), await leftovers()
+
+    return asyncio.run(main())
+
+
+def read_zip(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+def test_comma_separated():
+    headers, body, left = convert(form(b'# Title', to='html, rst,html'))
+    assert read_zip(body) == {'doc.html': b'# Title', 'doc.rst': b'# Title'}
+    assert headers['Content-Type'] == 'application/zip'
+    assert left == []
+
+
+def test_repeated_fields():
+    data = FormData()
+    data.add_field('from', 'markdown')
+    data.add_field('to', 'html')
+    data.add_field('to', 'rst,plain')
+    data.add_field('file', b'# Title', filename='doc.md')
+    headers, body, left = convert(data)
+    assert sorted(read_zip(body)) == ['doc.html', 'doc.plain', 'doc.rst']
+
+
+def test_archive():
+    docs = {'one.md': b'# One\n', 'two.md': b'# Two\n'}
+    headers, body, left = convert(form(tarball(docs), filename='docs.tar.gz', to='html,rst'))
+    assert read_tarball(body) == {
+        'one.html': b'# One\n', 'one.rst': b'# One\n', 'two.html': b'# Two\n', 'two.rst': b'# Two\n'
+    }
+    assert left == []
+
+
+def test_unsupported_compression():
+    async def main():
+        async with serve(make_config()) as client:
+            response = await client.post('/convert', data=form(b'# Title', to='html,rst', compression='xz'))
+            return response.status
+
+    assert asyncio.run(main()) == 400
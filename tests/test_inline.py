@@ -0,0 +1,50 @@
+import asyncio
+import os
+
+import pytest
+
+from pandocserver.services import PandocService
+from pandocserver.worker import DEFAULT_TEMP_DIR, convert_inline
+
+from .utils import form, make_config, serve, tarball
+
+
+def test_convert_inline():
+    assert convert_inline(b'# Title', 'markdown', 'html', service=PandocService()) == b'# Title'
+
+
+def converted(monkeypatch, inline_max_size, data, **kwargs):
+    """Converts `data` slowly, returns the response and whether the temp dir was used meanwhile."""
+    monkeypatch.setenv('PANDOC_STUB_DELAY', '0.5')
+    conf = make_config(workers={'inline_max_size': inline_max_size})
+
+    async def main():
+        async with serve(conf) as client:
+            conversion = asyncio.ensure_future(client.post('/convert', data=form(data, **kwargs)))
+            used = False
+            while not conversion.done():
+                used = used or any(files or dirs for _, dirs, files in os.walk(DEFAULT_TEMP_DIR))
+                await asyncio.sleep(0.02)
+            response = conversion.result()
+            return response.status, await response.read(), used
+
+    return asyncio.run(main())
+
+
+def test_small_upload_in_memory(monkeypatch):
+    status, body, used = converted(monkeypatch, 1024, b'# Title')
+    assert (status, body) == (200, b'# Title')
+    assert not used
+
+
+@pytest.mark.parametrize('inline_max_size, data, kwargs', [
+    (None, b'# Title', {}),
+    (4, b'# Title', {}),
+    (1024 ** 2, b'# Title', {'to': 'docx'}),
+    (1024 ** 2, b'# Title', {'to': 'html,rst'}),
+    (1024 ** 2, tarball({'doc.md': b'# Title'}), {'filename': 'docs.tar.gz'}),
+], ids=['disabled', 'too large', 'binary', 'several formats', 'archive'])
+def test_spooled(monkeypatch, inline_max_size, data, kwargs):
+    status, body, used = converted(monkeypatch, inline_max_size, data, **kwargs)
+    assert status == 200
+    assert used
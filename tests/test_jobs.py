@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from pandocserver.jobs import DONE, FAILED, JobManager, JobQueueFullError
+from pandocserver.uploads import Upload
+
+from .utils import form, make_config, serve
+
+
+async def poll(client, location, timeout=10.0):
+    deadline = asyncio.get_event_loop().time() + timeout
+    while True:
+        response = await client.get(location)
+        job = await response.json()
+        if job['status'] in (DONE, FAILED) or asyncio.get_event_loop().time() > deadline:
+            return job
+        await asyncio.sleep(0.05)
+
+
+def test_job():
+    async def main():
+        async with serve(make_config()) as client:
+            response = await client.post('/jobs', data=form(b'# Title'))
+            assert response.status == 202
+            job = await response.json()
+            location = response.headers['Location']
+            assert location == f"/jobs/{job['id']}"
+            job = await poll(client, location)
+            result = await client.get(f'{location}/result')
+            return job, result.status, await result.read()
+
+    job, status, body = asyncio.run(main())
+    assert job['status'] == DONE and job['filename'] == 'doc.md'
+    assert (status, body) == (200, b'# Title')
+
+
+def test_failed_job():
+    async def main():
+        async with serve(make_config()) as client:
+            response = await client.post('/jobs', data=form(b'PANDOC_STUB_FAIL'))
+            location = response.headers['Location']
+            job = await poll(client, location)
+            result = await client.get(f'{location}/result')
+            return job, result.status
+
+    job, status = asyncio.run(main())
+    assert job['status'] == FAILED and job['error']
+    assert status == 500
+
+
+def test_unknown_job():
+    async def main():
+        async with serve(make_config()) as client:
+            return (await client.get('/jobs/nope')).status, (await client.get('/jobs/nope/result')).status
+
+    assert asyncio.run(main()) == (404, 404)
+
+
+def test_result_not_ready(monkeypatch):
+    monkeypatch.setenv('PANDOC_STUB_DELAY', '1')
+
+    async def main():
+        async with serve(make_config()) as client:
+            response = await client.post('/jobs', data=form(b'# Title'))
+            return (await client.get(f"{response.headers['Location']}/result")).status
+
+    assert asyncio.run(main()) == 409
+
+
+def upload(path):
+    return Upload(filename='doc.md', path=str(path), size=0, digest='', from_format='markdown', to_format='html')
+
+
+def test_expiry(tmp_path):
+    results = []
+
+    async def run(upload):
+        result = tmp_path / f'result-{len(results)}' / 'doc.html'
+        result.parent.mkdir()
+        result.write_text('done')
+        results.append(result)
+        return result, False
+
+    async def main():
+        jobs = JobManager(run, 1, 1, ttl=0.2)
+        await jobs.start()
+        try:
+            source = tmp_path / 'doc.md'
+            source.write_text('# Title')
+            job = jobs.submit(upload(source))
+            while jobs.get(job.id).status != DONE:
+                await asyncio.sleep(0.01)
+            # the upload is removed once converted, the result once expired
+            assert not source.exists() and results[0].exists()
+            await asyncio.sleep(0.4)
+            return jobs.get(job.id), jobs.stats()
+        finally:
+            await jobs.stop()
+
+    job, stats = asyncio.run(main())
+    assert job is None
+    assert stats[DONE] == 0
+    assert not results[0].parent.exists()
+
+
+def test_queue_full(tmp_path):
+    async def never(upload):
+        await asyncio.Event().wait()
+
+    async def main():
+        # not started, nothing takes the jobs off the queue
+        jobs = JobManager(never, 1, 1, ttl=1)
+        jobs.submit(upload(tmp_path / 'one.md'))
+        with pytest.raises(JobQueueFullError):
+            jobs.submit(upload(tmp_path / 'two.md'))
+        await jobs.stop()
+
+    asyncio.run(main())
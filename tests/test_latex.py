@@ -0,0 +1,100 @@
+import pytest
+
+from pandocserver.latex import LatexEngine, LatexError
+
+PREAMBLE = '\\documentclass{article}\n\\usepackage{amsmath}\n'
+
+
+def document(body, preamble=PREAMBLE):
+    return f'{preamble}\\begin{{document}}\n{body}\n\\end{{document}}\n'
+
+
+@pytest.fixture
+def runs(test_filters, monkeypatch, tmp_path):
+    """The command lines of the fake LaTeX engine, one per run."""
+    log = tmp_path / 'runs.log'
+    log.touch()
+    monkeypatch.setenv('FAKE_LATEX_LOG', str(log))
+    return lambda: log.read_text().splitlines()
+
+
+@pytest.fixture
+def engine(runs, tmp_path):
+    engine = LatexEngine('fake-latex', tmp_path / 'latex')
+    engine.start()
+    yield engine
+    engine.stop()
+
+
+def test_not_found(tmp_path):
+    with pytest.raises(LatexError):
+        LatexEngine('no-such-latex', tmp_path).start()
+
+
+def test_not_started(tmp_path):
+    with pytest.raises(LatexError):
+        LatexEngine('fake-latex', tmp_path).compile(document('Text'), tmp_path / 'doc.pdf')
+
+
+def test_compile(engine, runs, tmp_path):
+    out = engine.compile(document('Text'), tmp_path / 'doc.pdf')
+    assert out.read_bytes().startswith(b'%PDF')
+    assert len(runs()) == 1
+    # the aux dir is reused, only emptied
+    engine.compile(document('More'), tmp_path / 'more.pdf')
+    assert engine.aux_dir.exists()
+    assert sorted(path.name for path in engine.aux_dir.iterdir()) == ['document.log', 'document.tex']
+
+
+def test_preamble_dumped_once_it_recurs(engine, runs, tmp_path):
+    for i in range(3):
+        engine.compile(document(f'Text {i}'), tmp_path / f'doc{i}.pdf')
+    first, dump, second, third = runs()
+    assert '-fmt=' not in first
+    assert dump.startswith('-ini ')
+    assert '-fmt=' in second and '-fmt=' in third
+    assert len(list(engine.formats_dir.glob('*.fmt'))) == 1
+
+
+def test_configured_preamble(runs, tmp_path):
+    engine = LatexEngine('fake-latex', tmp_path / 'latex')
+    engine.start(PREAMBLE)
+    try:
+        engine.compile(document('Text'), tmp_path / 'doc.pdf')
+    finally:
+        engine.stop()
+    dump, compiled = runs()
+    assert dump.startswith('-ini ') and '-fmt=' in compiled
+
+    # the formats are kept across restarts
+    engine = LatexEngine('fake-latex', tmp_path / 'latex')
+    engine.start()
+    try:
+        engine.compile(document('Text'), tmp_path / 'doc.pdf')
+    finally:
+        engine.stop()
+    assert '-fmt=' in runs()[-1] and len(runs()) == 3
+
+
+def test_max_formats(runs, tmp_path):
+    engine = LatexEngine('fake-latex', tmp_path / 'latex', max_formats=1)
+    engine.start()
+    try:
+        for preamble in ('\\documentclass{article}\n', '\\documentclass{report}\n'):
+            for i in range(2):
+                engine.compile(document('Text', preamble), tmp_path / 'doc.pdf')
+    finally:
+        engine.stop()
+    assert sum(run.startswith('-ini ') for run in runs()) == 1
+
+
+def test_toc_reruns(engine, runs, tmp_path):
+    engine.compile(document('\\tableofcontents'), tmp_path / 'doc.pdf')
+    assert len(runs()) == 2
+
+
+def test_errors(engine, tmp_path):
+    with pytest.raises(LatexError) as err:
+        engine.compile(document('\\fail'), tmp_path / 'doc.pdf')
+    assert str(err.value) == 'fake-latex failed: ! Undefined control sequence.'
+    assert not (tmp_path / 'doc.pdf').exists()
@@ -0,0 +1,110 @@
+import asyncio
+import sys
+import time
+
+import pytest
+
+from pandocserver import limits
+from pandocserver.executors import LocalExecutor
+from pandocserver.limits import ConversionTimeoutError, ResourceLimits
+from pandocserver.worker import convert_inline
+
+from .utils import make_config
+
+DOCUMENT = make_config().document
+
+
+def test_deadline():
+    start = time.monotonic()
+    with pytest.raises(ConversionTimeoutError):
+        with limits.deadline(0.2):
+            limits.run(['sleep', '5'])
+    assert time.monotonic() - start < 2
+    # disarmed after the block, no alarm goes off later
+    with limits.deadline(0.2):
+        pass
+    time.sleep(0.3)
+
+
+@pytest.fixture
+def child_limits():
+    yield limits.set_limits
+    limits.set_limits(ResourceLimits())
+
+
+def test_child_cpu(child_limits):
+    child_limits(ResourceLimits(cpu=1))
+    process = limits.run([sys.executable, '-c', 'while True: pass'])
+    assert process.returncode < 0
+
+
+def test_child_memory(child_limits):
+    child_limits(ResourceLimits(memory=512 * 1024 ** 2))
+    process = limits.run([sys.executable, '-c', 'x = bytearray(1024 ** 3)'])
+    assert process.returncode == 1
+    # the limits only apply to the children
+    assert len(bytearray(1024 ** 2)) == 1024 ** 2
+
+
+def run_executor(executor, coro):
+    async def main():
+        await executor.start()
+        try:
+            return await coro(executor)
+        finally:
+            await executor.stop()
+
+    return asyncio.run(main())
+
+
+def test_timeout(monkeypatch):
+    monkeypatch.setenv('PANDOC_STUB_DELAY', '5')
+    executor = LocalExecutor(1, DOCUMENT, limits=ResourceLimits(timeout=0.5))
+
+    async def convert(executor):
+        pid = next(iter(executor._workers)).pid
+        start = time.monotonic()
+        with pytest.raises(ConversionTimeoutError):
+            await executor.submit(convert_inline, {}, b'# Title', 'markdown', 'html', None)
+        elapsed = time.monotonic() - start
+        # a fresh worker takes the next task
+        worker = await executor._acquire()
+        executor._release(worker)
+        return elapsed, pid, worker.pid
+
+    elapsed, pid, new_pid = run_executor(executor, convert)
+    assert elapsed < 3
+    assert new_pid != pid
+    assert executor.stats()['recycled'] == {'timeout': 1}
+
+
+def test_recycle_after():
+    executor = LocalExecutor(1, DOCUMENT, recycle_after=2)
+
+    async def convert(executor):
+        pids = []
+        for i in range(5):
+            worker = await executor._acquire()
+            pids.append(worker.pid)
+            executor._release(worker)
+            assert await executor.submit(convert_inline, {}, b'doc', 'markdown', 'html', None) == b'doc'
+        return pids
+
+    pids = run_executor(executor, convert)
+    assert pids[0] == pids[1] != pids[2] == pids[3] != pids[4]
+    assert executor.stats()['recycled'] == {'tasks': 2}
+
+
+def test_recycle_max_rss():
+    # every worker is larger than a byte
+    executor = LocalExecutor(1, DOCUMENT, recycle_max_rss=1)
+
+    async def convert(executor):
+        for i in range(2):
+            await executor.submit(convert_inline, {}, b'doc', 'markdown', 'html', None)
+        # replaced before the next task
+        worker = await executor._acquire()
+        executor._release(worker)
+
+    run_executor(executor, convert)
+    assert executor.stats()['recycled'] == {'memory': 2}
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from pandocserver.options import (ConversionOptions, InvalidOptionError, MAX_METADATA, build_args, option_fields,
+                                  parse_options)
+
+from .utils import form, make_config, serve
+
+TEMPLATES = {'report': '/srv/templates/report.html'}
+FILTERS = {'upper': '/srv/filters/upper.lua', 'links': '/srv/filters/links.py'}
+
+
+def parse(**fields):
+    return parse_options({name: values if isinstance(values, list) else [values] for name, values in fields.items()},
+                         TEMPLATES, FILTERS)
+
+
+def test_parse():
+    options = parse(template='report', toc='true', toc_depth='2', number_sections='on',
+                    metadata=['title=A title', 'lang=en'], filter=['upper', 'links'])
+    assert options == ConversionOptions(template='/srv/templates/report.html', toc=True, toc_depth=2,
+                                        number_sections=True, metadata=(('title', 'A title'), ('lang', 'en')),
+                                        filters=('/srv/filters/upper.lua', '/srv/filters/links.py'))
+    assert parse() == ConversionOptions()
+
+
+@pytest.mark.parametrize('fields', [
+    {'output': '/etc/passwd'},
+    {'lua_filter': 'upper'},
+    {'template': '/srv/templates/report.html'},
+    {'template': '../report'},
+    {'filter': '/bin/sh'},
+    {'toc': 'maybe'},
+    {'toc': ['true', 'false']},
+    {'toc_depth': '7'},
+    {'toc_depth': '-1'},
+    {'metadata': 'title'},
+    {'metadata': '--x=y'},
+    {'metadata': 'title=two\nlines'},
+    {'metadata': [f'key{i}=value' for i in range(MAX_METADATA + 1)]},
+    {'compression': 'rar'},
+])
+def test_rejected(fields):
+    with pytest.raises(InvalidOptionError):
+        parse(**fields)
+
+
+def test_option_fields_round_trip():
+    options = parse(template='report', standalone='true', toc='true', toc_depth='3', metadata='title=x',
+                    filter='links', compression='gzip')
+    assert parse_options(option_fields(options, TEMPLATES, FILTERS), TEMPLATES, FILTERS) == options
+
+
+def test_build_args():
+    options = parse(template='report', toc='true', toc_depth='2', number_sections='true',
+                    metadata='title=A title', filter=['upper', 'links'])
+    assert build_args(('--standalone',), options) == (
+        '--standalone', '--template=/srv/templates/report.html', '--table-of-contents', '--toc-depth=2',
+        '--number-sections', '--metadata=title:A title', '--lua-filter=/srv/filters/upper.lua',
+        '--filter=/srv/filters/links.py',
+    )
+    assert build_args(('--standalone',), None) == ('--standalone',)
+    assert build_args(('--standalone',), ConversionOptions(standalone=True)) == ('--standalone',)
+
+
+def test_rejected_request():
+    async def main():
+        async with serve(make_config()) as client:
+            unknown = await client.post('/convert', data=form(b'# Title', output='/etc/passwd'))
+            template = await client.post('/convert', data=form(b'# Title', template='/etc/passwd'))
+            return unknown.status, await unknown.text(), template.status
+
+    status, text, template_status = asyncio.run(main())
+    assert status == 400 and "Unknown option 'output'" in text
+    assert template_status == 400
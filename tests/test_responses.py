@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from pandocserver.metrics import SENT_BYTES
+
+from .utils import form, make_config, serve
+
+DOC = b'# Title\n\n' + b'Some text, compressible text. ' * 200
+LABELS = {'from_format': 'markdown', 'to_format': 'html'}
+
+
+def sent():
+    return SENT_BYTES._values.get(SENT_BYTES._key(LABELS), 0)
+
+
+def convert(accept_encoding, **options):
+    async def main():
+        async with serve(make_config()) as client:
+            before = sent()
+            response = await client.post('/convert', data=form(DOC, **options),
+                                         headers={'Accept-Encoding': accept_encoding})
+            assert response.status == 200
+            body = await response.read()
+            # counted once the response was written
+            await asyncio.sleep(0.1)
+            return response.headers.get('Content-Encoding'), body, sent() - before
+
+    return asyncio.run(main())
+
+
+def test_not_negotiated():
+    # sent as is with sendfile
+    encoding, body, count = convert('identity')
+    assert encoding is None
+    assert body == DOC
+    assert count == len(DOC)
+
+
+@pytest.mark.parametrize('coding', ['gzip', 'deflate'])
+def test_negotiated(coding):
+    encoding, body, count = convert(f'{coding}, br')
+    assert encoding == coding
+    assert body == DOC
+    # the encoded bytes
+    assert 0 < count < len(DOC)
+
+
+def test_store():
+    encoding, body, count = convert('gzip', compression='store')
+    assert encoding is None
+    assert count == len(DOC)
+
+
+def test_requested():
+    encoding, body, count = convert('identity', compression='gzip')
+    assert encoding == 'gzip'
+    assert body == DOC
+    assert 0 < count < len(DOC)
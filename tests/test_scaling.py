@@ -0,0 +1,76 @@
+import asyncio
+
+from pandocserver.executors import LocalExecutor
+from pandocserver.worker import convert_inline
+
+from .utils import make_config
+
+DOCUMENT = make_config().document
+
+
+def scaling_executor(**kwargs):
+    return LocalExecutor(3, DOCUMENT, min_workers=1, scale_up_wait=0.1, scale_down_after=0.5, scale_interval=0.1,
+                         **kwargs)
+
+
+def test_scale_up_and_down(monkeypatch):
+    monkeypatch.setenv('PANDOC_STUB_DELAY', '0.5')
+    executor = scaling_executor()
+
+    async def main():
+        await executor.start()
+        try:
+            started = executor.stats()['processes']
+            outputs = await asyncio.gather(*(
+                executor.submit(convert_inline, {}, f'doc {i}'.encode(), 'markdown', 'html', None) for i in range(6)
+            ))
+            grown = executor.stats()
+            # idle workers beyond min_workers are retired
+            for _ in range(50):
+                if executor.stats()['processes'] == 1:
+                    break
+                await asyncio.sleep(0.1)
+            return started, outputs, grown, executor.stats()
+        finally:
+            await executor.stop()
+
+    started, outputs, grown, shrunk = asyncio.run(main())
+    assert started == 1
+    assert outputs == [f'doc {i}'.encode() for i in range(6)]
+    assert 1 < grown['processes'] <= 3
+    assert grown['scaled']['up'] == grown['processes'] - 1
+    assert shrunk['processes'] == 1
+    assert shrunk['scaled']['down'] == shrunk['scaled']['up']
+
+
+def test_idle_pool_not_scaled():
+    executor = scaling_executor()
+
+    async def main():
+        await executor.start()
+        try:
+            for i in range(3):
+                await executor.submit(convert_inline, {}, b'doc', 'markdown', 'html', None)
+            await asyncio.sleep(0.5)
+            return executor.stats()
+        finally:
+            await executor.stop()
+
+    stats = asyncio.run(main())
+    assert stats['processes'] == 1 and stats['scaled'] == {}
+
+
+def test_fixed_pool():
+    executor = LocalExecutor(2, DOCUMENT, min_workers=5)
+    assert executor.min_workers == 2
+
+    async def main():
+        await executor.start()
+        try:
+            return executor.stats(), executor._controller
+        finally:
+            await executor.stop()
+
+    stats, controller = asyncio.run(main())
+    assert stats['processes'] == 2 and stats['max_workers'] == 2
+    assert controller is None
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from pandocserver import tracing
+
+from .utils import form, make_config, serve
+
+
+@pytest.fixture
+def traces(tmp_path):
+    tracing.configure(tmp_path)
+    yield tmp_path
+    tracing.flush(5.0)
+    tracing.configure(None)
+
+
+def spans(path, trace):
+    with (path / trace / 'spans.jsonl').open() as fobj:
+        return [json.loads(line) for line in fobj]
+
+
+def test_nested_spans(traces):
+    with tracing.traced(('trace-of-the-tests', None)):
+        with tracing.span('outer', size=1) as attributes:
+            attributes['extra'] = True
+            with tracing.span('inner'):
+                pass
+        with pytest.raises(ValueError):
+            with tracing.span('failing'):
+                raise ValueError()
+
+    inner, outer, failing = spans(traces, 'trace-of-the-tests')
+    assert inner['parent_id'] == outer['span_id'] and outer['parent_id'] is None
+    assert outer['attributes'] == {'size': 1, 'extra': True}
+    assert failing['error'] == 'ValueError()'
+
+
+def test_written_by_a_thread(traces, monkeypatch):
+    written = []
+    append = tracing._append
+
+    def record(root, records):
+        written.append((threading.current_thread().name, len(records)))
+        append(root, records)
+
+    monkeypatch.setattr(tracing, '_append', record)
+
+    async def main():
+        with tracing.traced(('trace-of-the-loop', None)):
+            for i in range(10):
+                with tracing.span('member', index=i):
+                    await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert tracing.flush(5.0)
+    assert {name for name, _ in written} == {'span-writer'}
+    assert sum(count for _, count in written) == 10
+    assert [span['attributes']['index'] for span in spans(traces, 'trace-of-the-loop')] == list(range(10))
+
+
+def test_not_traced(traces):
+    with tracing.span('outside') as attributes:
+        assert attributes == {}
+    assert list(traces.iterdir()) == []
+
+
+def test_trace_id():
+    assert tracing.trace_id('request-0001') == 'request-0001'
+    for value in (None, 'short', '../../etc/passwd'):
+        assert tracing.trace_id(value) != value
+
+
+def test_remove_expired(traces):
+    old, new = traces / 'old-trace', traces / 'new-trace'
+    old.mkdir()
+    new.mkdir()
+    day_ago = time.time() - 24 * 3600
+    os.utime(str(old), (day_ago, day_ago))
+    assert tracing.remove_expired(3600) == 1
+    assert [path.name for path in traces.iterdir()] == ['new-trace']
+
+
+def test_request_traced(tmp_path):
+    async def main():
+        async with serve(make_config(traces={'path': str(tmp_path)})) as client:
+            response = await client.post('/convert', data=form(b'# Title'),
+                                         headers={'X-Request-Id': 'request-of-the-tests'})
+            assert response.status == 200
+            await response.read()
+            return response.headers['X-Trace-Id']
+
+    try:
+        assert asyncio.run(main()) == 'request-of-the-tests'
+        # flushed with the app
+        names = {span['name'] for span in spans(tmp_path, 'request-of-the-tests')}
+    finally:
+        tracing.configure(None)
+    assert {'request', 'upload', 'convert', 'task'} <= names
@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import io
+
+import pytest
+from aiohttp import web
+
+from pandocserver.uploads import spool
+
+from .utils import form, leftovers, make_config, serve
+
+DOC = b'# Title\n\n' + b'Some text.\n' * 10000
+
+
+class Field:
+    """A multipart field read in chunks."""
+    filename = 'doc.md'
+
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+        self.reads = 0
+
+    async def read_chunk(self, size):
+        self.reads += 1
+        await asyncio.sleep(0)
+        return self._data.read(size)
+
+
+def test_spool():
+    fobj = io.BytesIO()
+    field = Field(DOC)
+    size, digest = asyncio.run(spool(field, fobj, 4096, queue_size=2))
+    assert (size, digest) == (len(DOC), hashlib.sha256(DOC).hexdigest())
+    assert fobj.getvalue() == DOC
+    assert field.reads > len(DOC) // 4096
+
+
+def test_spool_max_size():
+    with pytest.raises(web.HTTPRequestEntityTooLarge):
+        asyncio.run(spool(Field(DOC), io.BytesIO(), 4096, max_size=len(DOC) - 1))
+
+
+def test_spool_write_error():
+    class Full(io.BytesIO):
+        def write(self, data):
+            raise OSError(28, 'No space left on device')
+
+    with pytest.raises(OSError):
+        asyncio.run(spool(Field(DOC), Full(), 4096))
+
+
+def test_upload():
+    # nothing is kept in memory, the upload is spooled to disk
+    conf = make_config(uploads={'chunk_size': 4096}, workers={'inline_max_size': 0})
+
+    async def main():
+        async with serve(conf) as client:
+            response = await client.post('/convert', data=form(DOC))
+            assert response.status == 200
+            return await response.read(), await leftovers()
+
+    body, left = asyncio.run(main())
+    assert body == DOC
+    assert left == []
+
+
+def test_upload_too_large():
+    conf = make_config(uploads={'max_size': 1024}, workers={'inline_max_size': 0})
+
+    async def main():
+        async with serve(conf) as client:
+            response = await client.post('/convert', data=form(DOC))
+            return response.status, await leftovers()
+
+    status, left = asyncio.run(main())
+    assert status == 413
+    assert left == []
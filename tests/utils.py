@@ -0,0 +1,72 @@
+"""Helpers running the app against the stub pandoc."""
+import asyncio
+import io
+import os
+import tarfile
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, Dict, List
+
+from aiohttp import FormData
+from aiohttp.test_utils import TestClient, TestServer
+
+from pandocserver.app import init_app
+from pandocserver.utils import Config, config_from_dict
+
+
+def make_config(**sections: Dict[str, Any]) -> Config:
+    """Returns a config of two workers, updated with the given sections."""
+    d = {'app': {'host': '127.0.0.1', 'port': 0}, 'workers': {'max_workers': 2}, 'document': {}}
+    for name, values in sections.items():
+        d[name] = dict(d.get(name, {}), **values)
+    return config_from_dict(d)
+
+
+@asynccontextmanager
+async def serve(conf: Config, **kwargs: Any):
+    """Runs the app, yields a client of it."""
+    app = await init_app(conf)
+    async with TestClient(TestServer(app, **kwargs)) as client:
+        yield client
+
+
+def form(data: bytes, filename: str = 'doc.md', from_format: str = 'markdown', to: str = 'html',
+         **options: Any) -> FormData:
+    """Returns a conversion request, options are repeated for list values."""
+    fd = FormData()
+    fd.add_field('from', from_format)
+    fd.add_field('to', to)
+    for name, values in options.items():
+        for value in values if isinstance(values, list) else [values]:
+            fd.add_field(name, str(value))
+    fd.add_field('file', data, filename=filename)
+    return fd
+
+
+def tarball(files: Dict[str, bytes], top: str = 'docs') -> bytes:
+    """Returns a tar.gz of the files in a top-level dir."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(f'{top}/{name}')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+async def leftovers(timeout: float = 2.0) -> List[str]:
+    """Returns the files left in the temp dir, once cleaning up after a response had the time to finish."""
+    from pandocserver.worker import DEFAULT_TEMP_DIR
+
+    deadline = asyncio.get_event_loop().time() + timeout
+    while True:
+        left = sorted(os.path.relpath(os.path.join(root, name), DEFAULT_TEMP_DIR)
+                      for root, dirs, files in os.walk(DEFAULT_TEMP_DIR) for name in files + dirs)
+        if not left or asyncio.get_event_loop().time() > deadline:
+            return left
+        await asyncio.sleep(0.05)
+
+
+def read_tarball(data: bytes) -> Dict[str, bytes]:
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:*') as tar:
+        return {Path(member.name).name: tar.extractfile(member).read() for member in tar if member.isfile()}